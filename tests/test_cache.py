@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+# Conversions that come from the cache must be the same as converting without one.
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import vgmconverter
+from vgm_samples import make_vgm, convert
+
+
+# converts with a cache in a new temporary directory
+class CachedConversionTest(unittest.TestCase):
+
+	def setUp(self):
+		cache_dir = tempfile.mkdtemp(prefix = 'vgmconverter_test')
+		self.addCleanup(shutil.rmtree, cache_dir, True)
+		self.cache = vgmconverter.VgmCache(cache_dir)
+		self.data = make_vgm(31, 10000)
+
+	# convert with the cache, returns a tuple of (outputs, log text)
+	def convert_cached(self, rawfile = False, **options):
+		log = vgmconverter.ByteBuffer()
+		outputs = convert(self.data, rawfile = rawfile, cache = self.cache, log = log, **options)
+		return (outputs, log.getvalue())
+
+
+class CacheTest(CachedConversionTest):
+
+	def test_cache_hit(self):
+		for options in ({ 'transpose' : 'bbc', 'quantize' : 50 }, { 'quantize' : 60, 'filter' : '3' }):
+			expected = convert(self.data, rawfile = True, **options)
+
+			outputs, log = self.convert_cached(rawfile = True, **options)
+			self.assertNotIn("Using cached conversion", log)
+			self.assertEqual(expected, outputs)
+
+			outputs, log = self.convert_cached(rawfile = True, **options)
+			self.assertIn("Using cached conversion", log)
+			self.assertEqual(expected, outputs)
+
+	# an entry without a raw output can't be used when one is wanted
+	def test_cache_entry_without_raw(self):
+		options = { 'transpose' : 'bbc', 'quantize' : 50 }
+		outputs, log = self.convert_cached(**options)
+		self.assertEqual(convert(self.data, **options), outputs)
+
+		outputs, log = self.convert_cached(rawfile = True, **options)
+		self.assertNotIn("Using cached conversion", log)
+		self.assertEqual(convert(self.data, rawfile = True, **options), outputs)
+
+	# the cache is kept under its maximum size, with the most recently stored entries kept
+	def test_eviction(self):
+		cache = vgmconverter.VgmCache(self.cache.cache_dir, 20000)
+		for i in range(200):
+			cache.put_data('%040x' % i, b'x' * 1000)
+
+		sizes = []
+		for root, dirs, files in os.walk(cache.cache_dir):
+			sizes.extend(os.path.getsize(os.path.join(root, f)) for f in files)
+		self.assertTrue(sum(sizes) <= 20000)
+		self.assertEqual(sum(sizes), cache.total_size)
+		self.assertEqual(b'x' * 1000, cache.get_data('%040x' % 199))
+		self.assertEqual(None, cache.get_data('%040x' % 0))
+
+
+# Conversions that resume from a checkpoint of an earlier conversion must be the same as converting from the start.
+class CheckpointTest(CachedConversionTest):
+
+	# pairs of options for the first and second conversions, and the checkpoint the second one should resume from
+	RESUMES = [
+		({ 'transpose' : 'bbc', 'quantize' : 50 }, { 'transpose' : 'bbc', 'quantize' : 60 }, "transpose"),
+		({ 'transpose' : 'bbc', 'quantize' : 50 }, { 'transpose' : 'pal', 'quantize' : 50 }, "optimize"),
+		({ 'transpose' : 'bbc', 'filter' : '1' }, { 'transpose' : 'bbc', 'filter' : '2' }, "parse"),
+		({ 'filter' : '1' }, { 'filter' : '1', 'transpose' : 'ntsc', 'quantize' : 100 }, "optimize"),
+	]
+
+	def test_resume(self):
+		for first_options, options, checkpoint in self.RESUMES:
+			self.setUp()
+			self.convert_cached(**first_options)
+
+			outputs, log = self.convert_cached(rawfile = True, **options)
+			self.assertIn("Resuming from " + checkpoint + " checkpoint", log)
+			self.assertEqual(convert(self.data, rawfile = True, **options), outputs, "resuming from " + repr(first_options) + " differs with options " + repr(options))
+
+	# DATA writes that don't follow a tone LATCH write depend on the writes before them, which a checkpoint must keep
+	def test_resume_stray_data_writes(self):
+		self.data = make_vgm(32, 10000, stray = 0.1)
+		self.convert_cached(transpose = 'bbc', quantize = 50)
+		outputs, log = self.convert_cached(rawfile = True, transpose = 'bbc', quantize = 60)
+		self.assertIn("Resuming from transpose checkpoint", log)
+		self.assertEqual(convert(self.data, rawfile = True, transpose = 'bbc', quantize = 60), outputs)
+
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,37 @@
+#!/usr/bin/env python
+# Processing in chunks (-chunk) must give the same output as processing the whole VGM.
+
+import unittest
+
+import vgmconverter
+from vgm_samples import make_vgm, convert
+
+
+class ChunkTest(unittest.TestCase):
+
+	# option sets to compare, each converted to a VGM and a raw file
+	OPTIONS = [
+		{ 'transpose' : 'bbc', 'quantize' : 50 },
+		{ 'transpose' : 'bbc' },
+		{ 'quantize' : 60, 'filter' : '1' },
+		{ 'transpose' : 'ntsc', 'quantize' : 100, 'filter' : '02' },
+	]
+
+	def assert_same_as_serial(self, data, chunked):
+		for options in self.OPTIONS:
+			expected = convert(data, rawfile = True, **options)
+			log = vgmconverter.ByteBuffer()
+			actual = convert(data, rawfile = True, chunk = 1, workers = 2, log = log, **options)
+			self.assertEqual(expected, actual, "chunked output differs with options " + repr(options))
+			self.assertEqual(chunked, "chunks on" in log.getvalue())
+
+	def test_paired_writes(self):
+		self.assert_same_as_serial(make_vgm(11, 20000), True)
+
+	# DATA writes that don't follow a tone LATCH write can't be seeded, so the VGM is processed serially
+	def test_stray_data_writes(self):
+		self.assert_same_as_serial(make_vgm(7, 20000, stray = 0.1), False)
+
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,49 @@
+#!/usr/bin/env python
+# The NumPy version of transpose must give the same output as transpose_stage(), which it replaces when NumPy is installed.
+
+import unittest
+
+import vgmconverter
+from vgm_samples import make_vgm, convert
+
+
+@unittest.skipIf(vgmconverter.numpy is None, "NumPy is not installed")
+class NumpyTransposeTest(unittest.TestCase):
+
+	def setUp(self):
+		# count the conversions transposed by transpose_numpy(), to check it is really used
+		self.numpy_count = 0
+		transpose_numpy = vgmconverter.VgmStream.transpose_numpy
+		def counted_transpose_numpy(vgm_stream):
+			transposed = transpose_numpy(vgm_stream)
+			if transposed:
+				self.numpy_count += 1
+			return transposed
+		vgmconverter.VgmStream.transpose_numpy = counted_transpose_numpy
+		self.addCleanup(setattr, vgmconverter.VgmStream, 'transpose_numpy', transpose_numpy)
+		self.addCleanup(setattr, vgmconverter.VgmStream, 'USE_NUMPY', vgmconverter.VgmStream.USE_NUMPY)
+
+	def assert_same_as_reference(self, data):
+		for transpose in ('bbc', 'ntsc', 'pal', '3546893'):
+			for options in ({ 'quantize' : 50 }, {}):
+				vgmconverter.VgmStream.USE_NUMPY = False
+				expected = convert(data, rawfile = 'quantize' in options, transpose = transpose, **options)
+				vgmconverter.VgmStream.USE_NUMPY = True
+				actual = convert(data, rawfile = 'quantize' in options, transpose = transpose, **options)
+				self.assertEqual(expected, actual, "NumPy transpose differs transposing to " + transpose + " with options " + repr(options))
+
+		# there's nothing to transpose when the target clock is the same as the source clock
+		self.assertTrue(self.numpy_count >= 6)
+
+	def test_transpose(self):
+		self.assert_same_as_reference(make_vgm(21, 10000))
+
+	def test_transpose_stray_data_writes(self):
+		self.assert_same_as_reference(make_vgm(22, 10000, stray = 0.1))
+
+	def test_transpose_pal_source(self):
+		self.assert_same_as_reference(make_vgm(23, 10000, clock = 4433619))
+
+
+if __name__ == '__main__':
+	unittest.main()
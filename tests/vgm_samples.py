@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+# Synthetic SN76489 VGMs for the tests, made from random register writes and waits.
+
+import os
+import random
+import struct
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import vgmconverter
+
+
+# returns the data of a VGM with count random commands, made from the given random seed.
+# stray is the fraction of commands that are DATA writes which don't follow a tone LATCH write
+def make_vgm(seed, count, stray = 0.0, clock = 3579545):
+	r = random.Random(seed)
+	commands = bytearray([0x50, 0x9f, 0x50, 0xbf, 0x50, 0xdf, 0x50, 0xff])
+	total_samples = 0
+	for i in range(count):
+		k = r.random()
+		if k < stray:
+			commands.extend([0x50, r.randint(0, 63)])
+		elif k < 0.4:
+			# volume
+			commands.extend([0x50, 0x90 | (r.randint(0, 3) << 5) | r.randint(0, 15)])
+		elif k < 0.6:
+			# tone, sometimes without the DATA write
+			tone = r.randint(1, 1023)
+			commands.extend([0x50, 0x80 | (r.randint(0, 2) << 5) | (tone & 15)])
+			if r.random() < 0.9:
+				commands.extend([0x50, (tone >> 4) & 63])
+		elif k < 0.65:
+			# noise, including tuned periodic noise
+			commands.extend([0x50, 0xe0 | r.choice([0, 1, 3, 4, 5, 7])])
+		elif k < 0.8:
+			wait = r.randint(1, 3000)
+			commands.extend(b'\x61' + struct.pack('<H', wait))
+			total_samples += wait
+		elif k < 0.9:
+			commands.append(0x62)
+			total_samples += 735
+		else:
+			wait = r.randint(0, 15)
+			commands.append(0x70 | wait)
+			total_samples += wait + 1
+	commands.append(0x66)
+
+	gd3_text = b''.join(field.encode('utf_16_le') + b'\x00\x00' for field in ['Test ' + str(seed), '', 'Tests', '', 'SMS', '', 'vgmconverter', '', '2016', '', ''])
+	gd3 = b'Gd3 ' + struct.pack('<II', 0x100, len(gd3_text)) + gd3_text
+
+	header = bytearray(0x40)
+	struct.pack_into('<4sIII', header, 0, b'Vgm ', 0x40 + len(commands) + len(gd3) - 4, 0x150, clock)
+	struct.pack_into('<II', header, 0x14, 0x40 + len(commands) - 0x14, total_samples)
+	struct.pack_into('<I', header, 0x24, 60)
+	struct.pack_into('<HB', header, 0x28, 9, 16)
+	struct.pack_into('<I', header, 0x34, 0x40 - 0x34)
+	return bytes(header + commands + gd3)
+
+# convert the given VGM data with the given VgmConverter options, returns a tuple of (vgm data, raw data)
+# raw data is None unless rawfile is True. Progress messages are dropped unless a log is given.
+def convert(data, rawfile = False, **options):
+	output_file = vgmconverter.ByteBuffer()
+	raw_file = vgmconverter.ByteBuffer() if rawfile else None
+	options.setdefault('quiet', 'log' not in options)
+	vgmconverter.convert(None, output_file, raw_file, data = data, **options)
+	return (output_file.getvalue(), raw_file.getvalue() if rawfile else None)
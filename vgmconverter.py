@@ -22,17 +22,49 @@
 # http://battleofthebits.org/browser/
 
 
+import bisect
+import glob
 import gzip
+import hashlib
+import json
+import mmap
+import multiprocessing
+import os
+import shutil
+import socket
+import sqlite3
+import stat
 import struct
 import sys
-import binascii
 import math
+import tempfile
+import threading
+import time
+import zlib
+from array import array
+from multiprocessing.queues import SimpleQueue
 from os.path import basename
 
+try:
+	from itertools import izip, islice
+except ImportError:
+	from itertools import islice
+	izip = zip
+
+# NumPy is optional, it's used for a faster transpose if it's installed
+try:
+	import numpy
+except ImportError:
+	numpy = None
+
 if (sys.version_info > (3, 0)):
 	from io import BytesIO as ByteBuffer
+	import queue as Queue
+	import socketserver as SocketServer
 else:
 	from StringIO import StringIO as ByteBuffer
+	import Queue
+	import SocketServer
 
 
 
@@ -43,9 +75,436 @@ class FatalError(Exception):
 	pass
 
 
+#-----------------------------------------------------------------------------
+
+# Number of operand bytes that follow each VGM command byte, indexed by command, as per the VGM spec
+# http://vgmrips.net/wiki/VGM_Specification
+# Reserved ranges are included so that commands we don't understand can still be skipped correctly.
+VGM_COMMAND_DATA_SIZE = (
+	[0] * 0x30 +		# 0x00-0x2f : undefined, assumed no operands
+	[1] * 0x10 +		# 0x30-0x3f dd : dual chip PSG write (0x30), GG stereo (0x3f) or reserved
+	[2] * 0x0f +		# 0x40-0x4e dd dd : reserved
+	[1] * 2 +			# 0x4f dd : Game Gear PSG stereo, 0x50 dd : PSG write
+	[2] * 0x0f +		# 0x51-0x5f aa dd : YM2413, YM2612, YM2151, YM2203, YM2608, YM2610, YM3812, YM3526, Y8950, YMZ280B, YMF262 etc.
+	[0] +				# 0x60 : undefined
+	[2] +				# 0x61 nn nn : WAIT n samples
+	[0] * 2 +			# 0x62 : WAIT 735 samples, 0x63 : WAIT 882 samples
+	[3] +				# 0x64 cc nn nn : override wait length for 0x62/0x63
+	[0] * 2 +			# 0x65 : undefined, 0x66 : END
+	[6] +				# 0x67 0x66 tt ss ss ss ss : data block, followed by ss ss ss ss bytes of data
+	[11] +				# 0x68 0x66 cc oo oo oo dd dd dd ss ss ss : PCM RAM write
+	[0] * 7 +			# 0x69-0x6f : undefined
+	[0] * 0x20 +		# 0x70-0x7f : WAIT n+1 samples, 0x80-0x8f : YM2612 DAC write then WAIT n samples
+	[4, 4, 5, 10, 1, 4] +	# 0x90-0x95 : DAC stream control
+	[0] * 0x0a +		# 0x96-0x9f : undefined
+	[2] * 0x20 +		# 0xa0-0xbf aa dd : AY8910 and other chip writes, or reserved
+	[3] * 0x20 +		# 0xc0-0xdf pp aa dd : Sega PCM, RF5C68 and other chip writes, or reserved
+	[4] * 0x20			# 0xe0-0xff dddddddd : PCM data bank seek, C352 write, or reserved
+)
+
+# Commands that are kept in a parsed command list, indexed by command. Everything else is skipped.
+# We only keep the SN76489 writes and the commands that affect timing.
+VGM_COMMAND_KEEP = bytearray(
+	(1 if command in (0x4f, 0x50, 0x61, 0x62, 0x63, 0x66) or 0x70 <= command <= 0x7f else 0) for command in range(256)
+)
+
+# Precompiled little endian decoders, used to unpack values directly from a VGM buffer
+STRUCT_UINT8 = struct.Struct('<B')
+STRUCT_UINT16 = struct.Struct('<H')
+STRUCT_UINT32 = struct.Struct('<I')
+
+# Number of samples each VGM command waits for, indexed by command. 
+# -1 means the wait is given by the command's operand (0x61 nn nn)
+VGM_COMMAND_WAIT_SAMPLES = (
+	[0] * 0x61 +
+	[-1] +			# 0x61 nn nn : WAIT n samples
+	[735] +			# 0x62 : WAIT 735 samples (1/60 sec)
+	[882] +			# 0x63 : WAIT 882 samples (1/50 sec)
+	[0] * 0x0c +
+	range(1, 17) +	# 0x7n : WAIT n+1 samples
+	[0] * 0x80
+)
+
+# yield the wait commands for the given number of samples as (command, data, time) tuples starting at the given time,
+# using the shortest encoding for each wait.
+def vgm_wait_commands(samples, time):
+	while samples > 0:
+		if samples == 735:
+			command, data, wait = 0x62, 0, 735
+		elif samples == 882:
+			command, data, wait = 0x63, 0, 882
+		elif samples <= 16:
+			command, data, wait = 0x70 + samples - 1, 0, samples
+		else:
+			wait = min(samples, 65535)
+			command, data = 0x61, wait
+		yield (command, data, time)
+		time += wait
+		samples -= wait
+
+# group (command, data, time) tuples into time slots, which are the runs of register writes between two other commands.
+# yields a (writes, item) tuple for each slot, where writes is the list of 0x50 commands in the slot and item is the 
+# command that ends it, or None for any writes after the last command.
+# processing stages that work on whole time slots use this, rather than each finding where the slots end.
+def vgm_time_slots(commands):
+	writes = []
+	for item in commands:
+		if item[0] == 0x50:
+			writes.append(item)
+		else:
+			yield (writes, item)
+			writes = []
+	if len(writes) > 0:
+		yield (writes, None)
+
+# Compact struct-of-arrays store for a stream of VGM commands, shared by all processing passes.
+# Each command is held as its command byte in 'commands', and its operand bytes decoded as a
+# little endian integer in 'data' (0 for commands with no operand).
+# eg. 0x50 0x9f is stored as (0x50, 0x9f) and 0x61 0x44 0xac as (0x61, 44100)
+# 'times' holds the absolute time (in samples) at which each command occurs. It is filled in as the commands are
+# parsed (or can be rebuilt with update_times()), and passes that insert or remove commands carry the times through, 
+# so that any pass can look up the time of a command without decoding the waits before it.
+# Iterating a command list gives (command, data, time) tuples, which is the form used by the processing stages.
+class VgmCommandList(object):
+
+	__slots__ = ('commands', 'data', 'times')
+
+	def __init__(self):
+		self.commands = bytearray()
+		self.data = array('I')
+		self.times = array('I')
+
+	def __len__(self):
+		return len(self.commands)
+
+	def __iter__(self):
+		return izip(self.commands, self.data, self.times)
+
+	def append(self, command, data, time):
+		self.commands.append(command)
+		self.data.append(data)
+		self.times.append(time)
+
+	# append (command, data, time) tuples from an iterable, eg. a processing stage
+	# the tuples are read in chunks, and split into columns with zip, which is much quicker than appending each one
+	def extend(self, items):
+		items = iter(items)
+		while True:
+			chunk = list(islice(items, 65536))
+			if len(chunk) == 0:
+				break
+			commands, data, times = izip(*chunk)
+			self.commands.extend(commands)
+			self.data.extend(data)
+			self.times.extend(times)
+
+	# rebuild the times column by accumulating the waits of every command
+	def update_times(self):
+		commands = self.commands
+		command_data = self.data
+		wait_samples = VGM_COMMAND_WAIT_SAMPLES
+		times = array('I')
+		append_time = times.append
+		time = 0
+		for i in range(len(commands)):
+			append_time(time)
+			wait = wait_samples[commands[i]]
+			if wait < 0:
+				wait = command_data[i]
+			time += wait
+		self.times = times
+
+
+
+
+
+#-----------------------------------------------------------------------------
+
+# Collects the warnings from processing a VGM, so that a tune which gives thousands of them doesn't print thousands of lines.
+# Each warning is counted by its message and channel, and the first few (MAX_EXAMPLES) are kept with their time (in samples)
+# and any detail. report() then prints one line for each message, and get_summary() gives them as JSON friendly dicts.
+# if log is set (in verbose mode), each warning is also printed as it is added.
+# messages that are only wanted in verbose mode are still printed directly, guarded by VERBOSE, so they cost nothing otherwise.
+class VgmDiagnostics(object):
+
+	MAX_EXAMPLES = 3
+
+	def __init__(self):
+		self.counts = {}	# number of each (message, channel)
+		self.examples = {}	# the first (time, channel, detail) tuples of each message
+		self.messages = []	# the messages in the order they first happened
+		self.log = None
+
+	def add(self, message, channel = None, time = 0, detail = None):
+		examples = self.examples.get(message)
+		if examples is None:
+			examples = self.examples[message] = []
+			self.messages.append(message)
+		if len(examples) < self.MAX_EXAMPLES:
+			examples.append((time, channel, detail))
+		key = (message, channel)
+		self.counts[key] = self.counts.get(key, 0) + 1
+
+		if self.log != None:
+			print >>self.log, "  " + message + " at " + self.format_example(float(time) / VgmStream.VGM_FREQUENCY, channel, detail)
+
+	# add the warnings from another collector, which come after these (eg. from the next chunk of a VGM)
+	def merge(self, diagnostics):
+		for message in diagnostics.messages:
+			if message not in self.examples:
+				self.examples[message] = []
+				self.messages.append(message)
+			examples = self.examples[message]
+			examples.extend(diagnostics.examples[message][:self.MAX_EXAMPLES - len(examples)])
+		for key, count in diagnostics.counts.items():
+			self.counts[key] = self.counts.get(key, 0) + count
+
+	# format the time (in seconds), channel and detail of a warning
+	@staticmethod
+	def format_example(seconds, channel, detail):
+		text = format(seconds, '.2f') + "s"
+		notes = [("channel " + str(channel)) if channel != None else None, detail]
+		if notes != [None, None]:
+			text += " (" + ", ".join(note for note in notes if note != None) + ")"
+		return text
+
+	# returns a list of dicts with the message, count, counts for each channel and examples of each warning
+	def get_summary(self):
+		summary = []
+		for message in self.messages:
+			channels = dict((str(channel), count) for (key, channel), count in self.counts.items() if key == message and channel != None)
+			summary.append({
+				'message' : message,
+				'count' : sum(count for (key, channel), count in self.counts.items() if key == message),
+				'channels' : channels,
+				'examples' : [{ 'time' : float(time) / VgmStream.VGM_FREQUENCY, 'channel' : channel, 'detail' : detail } for time, channel, detail in self.examples[message]]
+			})
+		return summary
+
+	# print one line for each warning, with how many times it happened (on each channel) and when it first did
+	def report(self, log):
+		for entry in self.get_summary():
+			text = "  " + entry['message'] + " (" + str(entry['count']) + (" time" if entry['count'] == 1 else " times")
+			for channel in sorted(entry['channels']):
+				text += ", channel " + channel + ": " + str(entry['channels'][channel])
+			text += "), first at " + ", ".join(self.format_example(example['time'], example['channel'], example['detail']) for example in entry['examples'])
+			print >>log, text
+
+#-----------------------------------------------------------------------------
+
+# SN76489 register state, tracked from a stream of register writes.
+# Used to restore the state of the chip at an arbitrary point in a VGM.
+class Sn76489State(object):
+
+	__slots__ = ('registers', 'written', 'latched_register')
+
+	def __init__(self):
+		# register values, indexed by the 3 bit register number from the latch byte
+		# (tone0, vol0, tone1, vol1, tone2, vol2, noise, vol3)
+		self.registers = [0] * 8
+		self.written = [False] * 8
+		self.latched_register = 0
+
+	# update the state with a register write
+	def write(self, w):
+		if w & 0x80:
+			self.latched_register = (w >> 4) & 7
+		r = self.latched_register
+		registers = self.registers
+
+		# volumes and the noise register only have 4 bits, which are set by latch or data bytes
+		if (r & 1) or r == 6:
+			registers[r] = w & 0x0f
+		# tone registers have the low 4 bits set by a latch, and the high 6 bits by a data byte
+		elif w & 0x80:
+			registers[r] = (registers[r] & 0x3f0) | (w & 0x0f)
+		else:
+			registers[r] = (registers[r] & 0x0f) | ((w & 0x3f) << 4)
+		self.written[r] = True
+
+	# return the register writes needed to restore this state.
+	# registers that have never been written are left alone, and the latched register
+	# is restored last, so that any data writes that follow still go to the right register.
+	def get_writes(self):
+		latched_register = self.latched_register
+		writes = []
+		for r in [n for n in range(8) if n != latched_register] + [latched_register]:
+			if self.written[r]:
+				writes.append(0x80 | (r << 4) | (self.registers[r] & 0x0f))
+				if not (r & 1) and r != 6:
+					writes.append((self.registers[r] >> 4) & 0x3f)
+		return writes
+
+
+#-----------------------------------------------------------------------------
+
+# open a new, uniquely named temporary file in the same directory as filename, to replace it with once written
+# returns a tuple of (binary file object, temporary filename)
+# the temporary file gets the permissions of filename, or those of a newly created file if it doesn't exist
+def open_temp_file(filename):
+	fd, temp_filename = tempfile.mkstemp(prefix = basename(filename) + '.', suffix = '.tmp', dir = os.path.dirname(filename) or '.')
+	if os.path.exists(filename):
+		mode = stat.S_IMODE(os.stat(filename).st_mode)
+	else:
+		umask = os.umask(0)
+		os.umask(umask)
+		mode = 0o666 & ~umask
+	os.chmod(temp_filename, mode)
+	return (os.fdopen(fd, 'wb'), temp_filename)
+
+# replace filename with the temporary file from open_temp_file()
+def replace_file(temp_filename, filename):
+	# rename can't replace an existing file on Windows
+	if os.path.exists(filename):
+		os.remove(filename)
+	os.rename(temp_filename, filename)
+
+# Binary output for the VGM writers, which can be a filename, '-' for stdout, or any binary file object.
+# Writers fill in their headers at the end with write_header(), so output to a pipe (or anything
+# else that can't seek) is held in memory and only written out on close().
+class VgmOutput(object):
+
+	# target is a filename, '-' for stdout, or a file object
+	# if source (a VgmStream) is given and target is its source file, the output is written to a temporary file,
+	# which replaces the source file when the output is closed (as write_gd3() does)
+	def __init__(self, target, source = None):
+		self.owned = False
+		self.source = None
+		if target == '-':
+			self.output = sys.stdout
+			self.name = '<stdout>'
+		elif hasattr(target, 'write'):
+			self.output = target
+			self.name = getattr(target, 'name', '<stream>')
+		else:
+			self.name = target
+			self.owned = True
+			if source != None and source.is_source_file(target):
+				self.source = source
+				self.output, self.temp_filename = open_temp_file(target)
+			else:
+				self.output = open(target, 'wb')
+
+		# headers are written relative to where the output started, since a file object may already have data in it
+		try:
+			self.start = self.output.tell()
+			self.output.seek(self.start)
+			self.file = self.output
+		except (EnvironmentError, AttributeError, ValueError):
+			self.start = 0
+			self.file = ByteBuffer()
+
+	def write(self, data):
+		self.file.write(data)
+
+	# overwrite the start of the output with the given header data
+	def write_header(self, data):
+		position = self.file.tell()
+		self.file.seek(self.start)
+		self.file.write(data)
+		self.file.seek(position)
+
+	def close(self):
+		if self.file is not self.output:
+			self.output.write(self.file.getvalue())
+		if self.owned:
+			self.output.close()
+		else:
+			self.output.flush()
+
+		# replace the source file
+		if self.source != None:
+			self.source.close()
+			replace_file(self.temp_filename, self.name)
+
+	# abandon the output, removing the file if we created it
+	def discard(self):
+		if self.owned:
+			self.output.close()
+			os.remove(self.temp_filename if self.source != None else self.name)
+		elif self.file is self.output:
+			self.file.seek(self.start)
+			self.file.truncate()
+
+
 
 
-class VgmStream:
+#-----------------------------------------------------------------------------
+
+# VGM file header
+# The header is decoded with a single unpack, using the precompiled layout for the VGM version.
+# Fields can be read/written as attributes, or by name as header['field'].
+class VgmHeader(object):
+
+	# the gd3_offset and vgm_data_offset fields are relative to their own position in the header
+	GD3_OFFSET_BASE = 0x14
+	VGM_DATA_OFFSET_BASE = 0x34
+
+	# Header layouts, in increasing version order, as (minimum version, struct, field names)
+	LAYOUTS = [
+		# Version 1.01
+		(0x00000101, struct.Struct('<4sIIIIIIIII'), (
+			'vgm_ident', 'eof_offset', 'version', 'sn76489_clock', 'ym2413_clock', 'gd3_offset',
+			'total_samples', 'loop_offset', 'loop_samples', 'rate',
+		)),
+		# Version 1.10 adds SN76489 feedback & shift register width, YM2612 and YM2151 clocks
+		(0x00000110, struct.Struct('<4sIIIIIIIIIHBxII'), (
+			'vgm_ident', 'eof_offset', 'version', 'sn76489_clock', 'ym2413_clock', 'gd3_offset',
+			'total_samples', 'loop_offset', 'loop_samples', 'rate',
+			'sn76489_feedback', 'sn76489_shift_register_width', 'ym2612_clock', 'ym2151_clock',
+		)),
+		# Version 1.50 adds the VGM data offset
+		# we are happy enough to parse v1.51 onwards as if it were 1.50 since the later updates are for other chips and dont apply to us anyway
+		(0x00000150, struct.Struct('<4sIIIIIIIIIHBxIII'), (
+			'vgm_ident', 'eof_offset', 'version', 'sn76489_clock', 'ym2413_clock', 'gd3_offset',
+			'total_samples', 'loop_offset', 'loop_samples', 'rate',
+			'sn76489_feedback', 'sn76489_shift_register_width', 'ym2612_clock', 'ym2151_clock',
+			'vgm_data_offset',
+		)),
+	]
+
+	__slots__ = LAYOUTS[-1][2]
+
+	# decode the header from the start of the given buffer
+	def __init__(self, buf):
+		# values for fields that older versions do not have
+		self.sn76489_feedback = 0x0009
+		self.sn76489_shift_register_width = 16
+		self.ym2612_clock = 0
+		self.ym2151_clock = 0
+		self.vgm_data_offset = 0x40 - self.VGM_DATA_OFFSET_BASE
+
+		version = STRUCT_UINT32.unpack_from(buf, 0x08)[0]
+		for layout_version, layout, fields in reversed(self.LAYOUTS):
+			if version >= layout_version:
+				break
+
+		for field, value in zip(fields, layout.unpack_from(buf)):
+			setattr(self, field, value)
+
+		# VGM 1.50 files can still leave the data offset as zero
+		if self.vgm_data_offset == 0:
+			self.vgm_data_offset = 0x40 - self.VGM_DATA_OFFSET_BASE
+
+	def __getitem__(self, field):
+		return getattr(self, field)
+
+	def __setitem__(self, field, value):
+		setattr(self, field, value)
+
+	# absolute file offset of the GD3 tag, or 0 if there isn't one
+	def get_gd3_position(self):
+		if self.gd3_offset == 0:
+			return 0
+		return self.gd3_offset + self.GD3_OFFSET_BASE
+
+	# absolute file offset of the first VGM command
+	def get_vgm_data_position(self):
+		return self.vgm_data_offset + self.VGM_DATA_OFFSET_BASE
+
+
+
+class VgmStream(object):
 
 
 	# VGM commands:
@@ -96,9 +555,13 @@ class VgmStream:
 	VERBOSE = False
 	STRIP_GD3 = False	
 	LENGTH = 0 # required output length (in seconds)
+	STREAM_LOOKAHEAD = 4096 # max number of commands a processing stage can hold back in streaming mode
+	USE_NUMPY = True # use the NumPy version of transpose (if NumPy is installed), see transpose_numpy()
 	
 	# VGM file identifier
 	vgm_magic_number = b'Vgm '
+	# gzip identifier, for .vgz data
+	gzip_magic_number = b'\x1f\x8b'
 
 	disable_dual_chip = True # [TODO] handle dual PSG a bit better
 
@@ -108,6 +571,21 @@ class VgmStream:
 	vgm_loop_offset = 0
 	vgm_loop_length = 0
 	
+	# GD3 tag fields, in the order they are stored
+	gd3_fields = [
+		'title_eng',
+		'title_jap',
+		'game_eng',
+		'game_jap',
+		'console_eng',
+		'console_jap',
+		'artist_eng',
+		'artist_jap',
+		'date',
+		'vgm_creator',
+		'notes',
+	]
+
 	# Supported VGM versions
 	supported_ver_list = [
 		0x00000101,
@@ -118,216 +596,39 @@ class VgmStream:
 		0x00000161,
 	]
 
-	# VGM metadata offsets
-	metadata_offsets = {
-		# SDM Hacked version number 101 too
-		0x00000101: {
-			'vgm_ident': {'offset': 0x00, 'size': 4, 'type_format': None},
-			'eof_offset': {'offset': 0x04, 'size': 4, 'type_format': '<I'},
-			'version': {'offset': 0x08, 'size': 4, 'type_format': '<I'},
-			'sn76489_clock': {'offset': 0x0c, 'size': 4, 'type_format': '<I'},
-			'ym2413_clock': {'offset': 0x10, 'size': 4, 'type_format': '<I'},
-			'gd3_offset': {'offset': 0x14, 'size': 4, 'type_format': '<I'},
-			'total_samples': {'offset': 0x18, 'size': 4, 'type_format': '<I'},
-			'loop_offset': {'offset': 0x1c, 'size': 4, 'type_format': '<I'},
-			'loop_samples': {'offset': 0x20, 'size': 4, 'type_format': '<I'},
-			'rate': {'offset': 0x24, 'size': 4, 'type_format': '<I'},
-			'sn76489_feedback': {
-				'offset': 0x28,
-				'size': 2,
-				'type_format': '<H',
-			},
-			'sn76489_shift_register_width': {
-				'offset': 0x2a,
-				'size': 1,
-				'type_format': 'B',
-			},
-			'ym2612_clock': {'offset': 0x2c, 'size': 4, 'type_format': '<I'},
-			'ym2151_clock': {'offset': 0x30, 'size': 4, 'type_format': '<I'},
-			'vgm_data_offset': {
-				'offset': 0x34,
-				'size': 4,
-				'type_format': '<I',
-			},
-		},
-
-		# Version 1.10`
-		0x00000110: {
-			'vgm_ident': {'offset': 0x00, 'size': 4, 'type_format': None},
-			'eof_offset': {'offset': 0x04, 'size': 4, 'type_format': '<I'},
-			'version': {'offset': 0x08, 'size': 4, 'type_format': '<I'},
-			'sn76489_clock': {'offset': 0x0c, 'size': 4, 'type_format': '<I'},
-			'ym2413_clock': {'offset': 0x10, 'size': 4, 'type_format': '<I'},
-			'gd3_offset': {'offset': 0x14, 'size': 4, 'type_format': '<I'},
-			'total_samples': {'offset': 0x18, 'size': 4, 'type_format': '<I'},
-			'loop_offset': {'offset': 0x1c, 'size': 4, 'type_format': '<I'},
-			'loop_samples': {'offset': 0x20, 'size': 4, 'type_format': '<I'},
-			'rate': {'offset': 0x24, 'size': 4, 'type_format': '<I'},
-			'sn76489_feedback': {
-				'offset': 0x28,
-				'size': 2,
-				'type_format': '<H',
-			},
-			'sn76489_shift_register_width': {
-				'offset': 0x2a,
-				'size': 1,
-				'type_format': 'B',
-			},
-			'ym2612_clock': {'offset': 0x2c, 'size': 4, 'type_format': '<I'},
-			'ym2151_clock': {'offset': 0x30, 'size': 4, 'type_format': '<I'},
-			'vgm_data_offset': {
-				'offset': 0x34,
-				'size': 4,
-				'type_format': '<I',
-			},
-		},
-		# Version 1.50`
-		0x00000150: {
-			'vgm_ident': {'offset': 0x00, 'size': 4, 'type_format': None},
-			'eof_offset': {'offset': 0x04, 'size': 4, 'type_format': '<I'},
-			'version': {'offset': 0x08, 'size': 4, 'type_format': '<I'},
-			'sn76489_clock': {'offset': 0x0c, 'size': 4, 'type_format': '<I'},
-			'ym2413_clock': {'offset': 0x10, 'size': 4, 'type_format': '<I'},
-			'gd3_offset': {'offset': 0x14, 'size': 4, 'type_format': '<I'},
-			'total_samples': {'offset': 0x18, 'size': 4, 'type_format': '<I'},
-			'loop_offset': {'offset': 0x1c, 'size': 4, 'type_format': '<I'},
-			'loop_samples': {'offset': 0x20, 'size': 4, 'type_format': '<I'},
-			'rate': {'offset': 0x24, 'size': 4, 'type_format': '<I'},
-			'sn76489_feedback': {
-				'offset': 0x28,
-				'size': 2,
-				'type_format': '<H',
-			},
-			'sn76489_shift_register_width': {
-				'offset': 0x2a,
-				'size': 1,
-				'type_format': 'B',
-			},
-			'ym2612_clock': {'offset': 0x2c, 'size': 4, 'type_format': '<I'},
-			'ym2151_clock': {'offset': 0x30, 'size': 4, 'type_format': '<I'},
-			'vgm_data_offset': {
-				'offset': 0x34,
-				'size': 4,
-				'type_format': '<I',
-			},
-		},
-		# SDM Hacked version number, we are happy enough to parse v1.51 as if it were 1.50 since the 1.51 updates dont apply to us anyway
-		0x00000151: {
-			'vgm_ident': {'offset': 0x00, 'size': 4, 'type_format': None},
-			'eof_offset': {'offset': 0x04, 'size': 4, 'type_format': '<I'},
-			'version': {'offset': 0x08, 'size': 4, 'type_format': '<I'},
-			'sn76489_clock': {'offset': 0x0c, 'size': 4, 'type_format': '<I'},
-			'ym2413_clock': {'offset': 0x10, 'size': 4, 'type_format': '<I'},
-			'gd3_offset': {'offset': 0x14, 'size': 4, 'type_format': '<I'},
-			'total_samples': {'offset': 0x18, 'size': 4, 'type_format': '<I'},
-			'loop_offset': {'offset': 0x1c, 'size': 4, 'type_format': '<I'},
-			'loop_samples': {'offset': 0x20, 'size': 4, 'type_format': '<I'},
-			'rate': {'offset': 0x24, 'size': 4, 'type_format': '<I'},
-			'sn76489_feedback': {
-				'offset': 0x28,
-				'size': 2,
-				'type_format': '<H',
-			},
-			'sn76489_shift_register_width': {
-				'offset': 0x2a,
-				'size': 1,
-				'type_format': 'B',
-			},
-			'ym2612_clock': {'offset': 0x2c, 'size': 4, 'type_format': '<I'},
-			'ym2151_clock': {'offset': 0x30, 'size': 4, 'type_format': '<I'},
-			'vgm_data_offset': {
-				'offset': 0x34,
-				'size': 4,
-				'type_format': '<I',
-			},
-		},
-		# SDM Hacked version number, we are happy enough to parse v1.60 as if it were 1.50 since the 1.51 updates dont apply to us anyway
-		0x00000160: {
-			'vgm_ident': {'offset': 0x00, 'size': 4, 'type_format': None},
-			'eof_offset': {'offset': 0x04, 'size': 4, 'type_format': '<I'},
-			'version': {'offset': 0x08, 'size': 4, 'type_format': '<I'},
-			'sn76489_clock': {'offset': 0x0c, 'size': 4, 'type_format': '<I'},
-			'ym2413_clock': {'offset': 0x10, 'size': 4, 'type_format': '<I'},
-			'gd3_offset': {'offset': 0x14, 'size': 4, 'type_format': '<I'},
-			'total_samples': {'offset': 0x18, 'size': 4, 'type_format': '<I'},
-			'loop_offset': {'offset': 0x1c, 'size': 4, 'type_format': '<I'},
-			'loop_samples': {'offset': 0x20, 'size': 4, 'type_format': '<I'},
-			'rate': {'offset': 0x24, 'size': 4, 'type_format': '<I'},
-			'sn76489_feedback': {
-				'offset': 0x28,
-				'size': 2,
-				'type_format': '<H',
-			},
-			'sn76489_shift_register_width': {
-				'offset': 0x2a,
-				'size': 1,
-				'type_format': 'B',
-			},
-			'ym2612_clock': {'offset': 0x2c, 'size': 4, 'type_format': '<I'},
-			'ym2151_clock': {'offset': 0x30, 'size': 4, 'type_format': '<I'},
-			'vgm_data_offset': {
-				'offset': 0x34,
-				'size': 4,
-				'type_format': '<I',
-			},
-			
-		},		
-		# SDM Hacked version number, we are happy enough to parse v1.61 as if it were 1.50 since the 1.51 updates dont apply to us anyway
-		0x00000161: {
-			'vgm_ident': {'offset': 0x00, 'size': 4, 'type_format': None},
-			'eof_offset': {'offset': 0x04, 'size': 4, 'type_format': '<I'},
-			'version': {'offset': 0x08, 'size': 4, 'type_format': '<I'},
-			'sn76489_clock': {'offset': 0x0c, 'size': 4, 'type_format': '<I'},
-			'ym2413_clock': {'offset': 0x10, 'size': 4, 'type_format': '<I'},
-			'gd3_offset': {'offset': 0x14, 'size': 4, 'type_format': '<I'},
-			'total_samples': {'offset': 0x18, 'size': 4, 'type_format': '<I'},
-			'loop_offset': {'offset': 0x1c, 'size': 4, 'type_format': '<I'},
-			'loop_samples': {'offset': 0x20, 'size': 4, 'type_format': '<I'},
-			'rate': {'offset': 0x24, 'size': 4, 'type_format': '<I'},
-			'sn76489_feedback': {
-				'offset': 0x28,
-				'size': 2,
-				'type_format': '<H',
-			},
-			'sn76489_shift_register_width': {
-				'offset': 0x2a,
-				'size': 1,
-				'type_format': 'B',
-			},
-			'ym2612_clock': {'offset': 0x2c, 'size': 4, 'type_format': '<I'},
-			'ym2151_clock': {'offset': 0x30, 'size': 4, 'type_format': '<I'},
-			'vgm_data_offset': {
-				'offset': 0x34,
-				'size': 4,
-				'type_format': '<I',
-			},
-		}
-	}
-
-	
 	# constructor - pass in the filename of the VGM
-	def __init__(self, vgm_filename):
-
-		self.vgm_filename = vgm_filename
-		print "  VGM file loaded : '" + vgm_filename + "'"
-		
-		# open the vgm file and parse it
-		vgm_file = open(vgm_filename, 'rb')
-		vgm_data = vgm_file.read()
-		
-		# Store the VGM data and validate it
-		self.data = ByteBuffer(vgm_data)
-		
-		vgm_file.close()
+	# if header_only is True, only the header is decoded (and GD3 tag on demand), commands are not parsed
+	# start and length (in seconds) select a time window of the VGM to load, a length of 0 means until the end
+	# if stream is True, commands are not parsed up front. Instead each processing pass is chained onto a pipeline
+	# of generators, which runs when finish() is called, so the full command list is never held in memory.
+	# source is a VGM filename, '-' for stdin, a binary file object, or the VGM (or .vgz) data itself as a bytearray or memoryview
+	# a file object's name (if it has one) is taken to be the VGM filename
+	# the VGM data can also be given as data (eg. as bytes), and source is then only the VGM filename, or None
+	# log is the file object that progress messages are printed to, defaults to stdout
+	def __init__(self, source, header_only = False, start = 0, length = 0, stream = False, log = None, data = None):
+
+		if log is None:
+			log = sys.stdout
+		self.log = log
+
+		# vgm_filename is None if the source is not a named file
+		self.vgm_filename = None
+		self.load(source, data)
+		if not header_only:
+			print >>self.log, "  VGM file loaded : '" + self.source_name + "'"
 		
 		# parse
 		self.validate_vgm_data()
 
 		# Set up the variables that will be populated
-		self.command_list = []
+		self.command_list = VgmCommandList()
+		self.diagnostics = VgmDiagnostics()
+		self.command_stream = None
 		self.data_block = None
-		self.gd3_data = {}
-		self.metadata = {}
+		self.metadata = None
+
+		# GD3 tag is only parsed when first used
+		self._gd3_data = None
 
 		# Parse the VGM metadata and validate the VGM version
 		self.parse_metadata()
@@ -335,13 +636,17 @@ class VgmStream:
 		# Display info about the file
 		self.vgm_loop_offset = self.metadata['loop_offset']
 		self.vgm_loop_length = self.metadata['loop_samples']
+
+		if header_only:
+			self.validate_vgm_version()
+			return
 		
-		print "      VGM Version : " + "%x" % int(self.metadata['version'])
-		print "VGM SN76489 clock : " + str(float(self.metadata['sn76489_clock'])/1000000) + " MHz"
-		print "         VGM Rate : " + str(float(self.metadata['rate'])) + " Hz"
-		print "      VGM Samples : " + str(int(self.metadata['total_samples'])) + " (" + str(int(self.metadata['total_samples'])/self.VGM_FREQUENCY) + " seconds)"
-		print "  VGM Loop Offset : " + str(self.vgm_loop_offset)
-		print "  VGM Loop Length : " + str(self.vgm_loop_length)
+		print >>self.log, "      VGM Version : " + "%x" % int(self.metadata['version'])
+		print >>self.log, "VGM SN76489 clock : " + str(float(self.metadata['sn76489_clock'])/1000000) + " MHz"
+		print >>self.log, "         VGM Rate : " + str(float(self.metadata['rate'])) + " Hz"
+		print >>self.log, "      VGM Samples : " + str(int(self.metadata['total_samples'])) + " (" + str(int(self.metadata['total_samples'])/self.VGM_FREQUENCY) + " seconds)"
+		print >>self.log, "  VGM Loop Offset : " + str(self.vgm_loop_offset)
+		print >>self.log, "  VGM Loop Length : " + str(self.vgm_loop_length)
 
 
 
@@ -349,9 +654,16 @@ class VgmStream:
 		# Validation to check we can parse it
 		self.validate_vgm_version()
 
-		# Sanity check this VGM is suitable for this script - must be SN76489 only
-		if self.metadata['sn76489_clock'] == 0 or self.metadata['ym2413_clock'] !=0 or self.metadata['ym2413_clock'] !=0 or self.metadata['ym2413_clock'] !=0:
+		# Sanity check this VGM is suitable for this script - must contain SN76489 data
+		if self.metadata['sn76489_clock'] == 0:
 			raise FatalError("This script only supports VGM's for SN76489 PSG")		
+
+		# any other chips are stripped out, since only SN76489 commands are kept when parsing
+		if self.metadata['ym2413_clock'] != 0 or self.metadata['ym2612_clock'] != 0 or self.metadata['ym2151_clock'] != 0:
+			print >>self.log, "WARNING: VGM uses other sound chips, only SN76489 data will be kept"
+			self.metadata['ym2413_clock'] = 0
+			self.metadata['ym2612_clock'] = 0
+			self.metadata['ym2151_clock'] = 0
 		
 		# see if this VGM uses Dual Chip mode
 		if (self.metadata['sn76489_clock'] & 0x40000000) == 0x40000000:
@@ -359,7 +671,7 @@ class VgmStream:
 		else:
 			self.dual_chip_mode_enabled = False
 			
-		print "    VGM Dual Chip : " + str(self.dual_chip_mode_enabled)
+		print >>self.log, "    VGM Dual Chip : " + str(self.dual_chip_mode_enabled)
 		
 
 		# override/disable dual chip commands in the output stream if required
@@ -367,120 +679,177 @@ class VgmStream:
 			# remove the clock flag that enables dual chip mode
 			self.metadata['sn76489_clock'] = self.metadata['sn76489_clock'] & 0xbfffffff
 			self.dual_chip_mode_enabled = False
-			print "Dual Chip Mode Disabled - DC Commands will be removed"
+			print >>self.log, "Dual Chip Mode Disabled - DC Commands will be removed"
 
 		# take a copy of the clock speed for the VGM processor functions
 		self.vgm_source_clock = self.metadata['sn76489_clock']
 		self.vgm_target_clock = self.vgm_source_clock
 		
-		# Parse GD3 data and the VGM commands
-		self.parse_gd3()
-		self.parse_commands()
-		
-		print "   VGM Commands # : " + str(len(self.command_list))
-		print ""
-
+		# Parse the VGM commands, stopping at the end of the time window if there is one
+		start_time = int(start * self.VGM_FREQUENCY)
+		end_time = 0
+		if length > 0:
+			end_time = start_time + int(length * self.VGM_FREQUENCY)
+
+		if start_time > 0 or end_time > 0:
+			# the loop point is not preserved
+			self.metadata['loop_offset'] = 0
+			self.metadata['loop_samples'] = 0
+			self.vgm_loop_offset = 0
+			self.vgm_loop_length = 0
+
+		if stream:
+			# in streaming mode stages can only look ahead (or hold back commands) a limited amount
+			self.lookahead = self.STREAM_LOOKAHEAD
+			self.command_list = None
+			self.command_stream = self.iter_commands(end_time)
+
+			if start_time > 0 or end_time > 0:
+				# the real length of the window is only known when the stream has been read, so go by the header until then
+				total_samples = self.metadata['total_samples']
+				if end_time > 0:
+					total_samples = min(total_samples, end_time)
+				self.metadata['total_samples'] = max(total_samples - start_time, 0)
+				self.command_stream = self.clip_stage(self.command_stream, start_time, end_time)
+
+			print >>self.log, "   VGM Commands # : streamed"
+		else:
+			self.lookahead = None
+			self.parse_commands(end_time)
+
+			if start_time > 0 or end_time > 0:
+				self.clip(start_time, end_time)
+
+			print >>self.log, "   VGM Commands # : " + str(len(self.command_list))
+
+		print >>self.log, ""
+
+
+	# read the VGM data from the given source (or data, if given) into self.buffer
+	# a str source is always a filename, as VGM data held in a str can't be told apart from one
+	def load(self, source, data = None):
+		if data != None:
+			self.buffer = bytes(data)
+			self.vgm_filename = source
+			self.source_name = source if source != None else '<memory>'
+		elif isinstance(source, memoryview):
+			self.buffer = source.tobytes()
+			self.source_name = '<memory>'
+		elif isinstance(source, bytearray):
+			self.buffer = bytes(source)
+			self.source_name = '<memory>'
+		elif source == '-':
+			self.buffer = sys.stdin.read()
+			self.source_name = '<stdin>'
+		elif hasattr(source, 'read'):
+			self.buffer = source.read()
+			self.vgm_filename = getattr(source, 'name', None)
+			self.source_name = getattr(source, 'name', '<stream>')
+		else:
+			# open the vgm file and map it into memory, so that it can be decoded in place without copying
+			vgm_file = open(source, 'rb')
+			try:
+				self.buffer = mmap.mmap(vgm_file.fileno(), 0, access=mmap.ACCESS_READ)
+			except (ValueError, EnvironmentError):
+				# empty or unmappable files (eg. pipes) are read the old fashioned way
+				self.buffer = vgm_file.read()
+			
+			vgm_file.close()
+			self.vgm_filename = source
+			self.source_name = source
 
 	def validate_vgm_data(self):
-		# Save the current position of the VGM data
-		original_pos = self.data.tell()
-
-		# Seek to the start of the file
-		self.data.seek(0)
-
 		# Perform basic validation on the given file by checking for the VGM
 		# magic number ('Vgm ')
-		if self.data.read(4) != self.vgm_magic_number:
+		if self.buffer[0:4] != self.vgm_magic_number:
 			# Could not find the magic number. The file could be gzipped (e.g.
 			# a vgz file). Try un-gzipping the file and trying again.
-			self.data.seek(0)
-			self.data = gzip.GzipFile(fileobj=self.data, mode='rb')
-
+			# The whole file is inflated in one go into a contiguous buffer, so that 
+			# all further parsing works on uncompressed data rather than through a gzip stream.
 			try:
-				if self.data.read(4) != self.vgm_magic_number:
-					print "Error: Data does not appear to be a valid VGM file"
-					raise ValueError('Data does not appear to be a valid VGM file')
-			except IOError:
-				print "Error: Data does not appear to be a valid VGM file"
-				# IOError will be raised if the file is not a valid gzip file
+				self.buffer = self.inflate(self.buffer)
+			except zlib.error:
+				print >>self.log, "Error: Data does not appear to be a valid VGM file"
+				# zlib.error will be raised if the file is not a valid gzip file
 				raise ValueError('Data does not appear to be a valid VGM file')
 
-		# Seek back to the original position in the VGM data
-		self.data.seek(original_pos)
-		
-	def parse_metadata(self):
-		# Save the current position of the VGM data
-		original_pos = self.data.tell()
-
-		# Create the list to store the VGM metadata
-		self.metadata = {}
-
-		# Iterate over the offsets and parse the metadata
-		for version, offsets in self.metadata_offsets.items():
-			for value, offset_data in offsets.items():
-
-				# Seek to the data location and read the data
-				self.data.seek(offset_data['offset'])
-				data = self.data.read(offset_data['size'])
-
-				# Unpack the data if required
-				if offset_data['type_format'] is not None:
-					self.metadata[value] = struct.unpack(
-						offset_data['type_format'],
-						data,
-					)[0]
-				else:
-					self.metadata[value] = data
+			if self.buffer[0:4] != self.vgm_magic_number:
+				print >>self.log, "Error: Data does not appear to be a valid VGM file"
+				raise ValueError('Data does not appear to be a valid VGM file')
+
+		# must at least contain a full header
+		if len(self.buffer) < 0x40:
+			print >>self.log, "Error: VGM file is truncated"
+			raise ValueError('VGM file is truncated')
+
+	# decompress a gzipped (.vgz) buffer, returns the inflated data
+	@staticmethod
+	def inflate(gzip_data, chunk_size = 1024*1024):
+		# feed the compressed data through in chunks so that a mapped .vgz is never copied whole
+		# wbits offset of 16 tells zlib to expect (and skip) a gzip header and trailer
+		inflater = zlib.decompressobj(16 + zlib.MAX_WBITS)
+		output = []
+		for offset in range(0, len(gzip_data), chunk_size):
+			output.append(inflater.decompress(gzip_data[offset:offset+chunk_size]))
+		output.append(inflater.flush())
+		return b''.join(output)
 
-		# Seek back to the original position in the VGM data
-		self.data.seek(original_pos)
+	def parse_metadata(self):
+		self.metadata = VgmHeader(self.buffer)
 
 	def validate_vgm_version(self):
 		if self.metadata['version'] not in self.supported_ver_list:
-			print "VGM version is not supported"
+			print >>self.log, "VGM version is not supported"
 			raise FatalError('VGM version is not supported')
 
-	def parse_gd3(self):
-		# Save the current position of the VGM data
-		original_pos = self.data.tell()
-
-		# Seek to the start of the GD3 data
-		self.data.seek(
-			self.metadata['gd3_offset'] +
-			self.metadata_offsets[self.metadata['version']]['gd3_offset']['offset']
-		)
-
-		# Skip 8 bytes ('Gd3 ' string and 4 byte version identifier)
-		self.data.seek(8, 1)
+	# the GD3 tag data, parsed on first use
+	@property
+	def gd3_data(self):
+		if self._gd3_data is None:
+			self.parse_gd3()
+		return self._gd3_data
 
-		# Get the length of the GD3 data, then read it
-		gd3_length = struct.unpack('<I', self.data.read(4))[0]
-		gd3_data = ByteBuffer(self.data.read(gd3_length))
+	@gd3_data.setter
+	def gd3_data(self, gd3_data):
+		self._gd3_data = gd3_data
 
-		# Parse the GD3 data
+	def parse_gd3(self):
+		# Find the GD3 data
 		gd3_fields = []
-		current_field = b''
-		while True:
-			# Read two bytes. All characters (English and Japanese) in the GD3
-			# data use two byte encoding
-			char = gd3_data.read(2)
+		gd3_position = self.metadata.get_gd3_position()
+		if gd3_position != 0 and gd3_position + 12 <= len(self.buffer):
+
+			# Skip 8 bytes ('Gd3 ' string and 4 byte version identifier)
+			# then get the length of the GD3 data, then read it
+			gd3_length = STRUCT_UINT32.unpack_from(self.buffer, gd3_position + 8)[0]
+			gd3_position += 12
+			gd3_data = self.buffer[gd3_position:gd3_position+gd3_length]
+
+			# Parse the GD3 data into fields
+			# All characters (English and Japanese) in the GD3 data use two byte encoding, 
+			# and each field ends with a two byte zero terminator
+			field_start = 0
+			field_end = 0
+			while True:
+				field_end = gd3_data.find(b'\x00\x00', field_end)
+				if field_end < 0:
+					break
 
-			# Break if we are at the end of the GD3 data
-			if char == b'':
-				break
+				# terminators only count if they are aligned to a character
+				if field_end & 1:
+					field_end += 1
+					continue
 
-			# Check if we are at the end of a field, if not then continue to
-			# append to "current_field"
-			if char == b'\x00\x00':
-				gd3_fields.append(current_field)
-				current_field = b''
-			else:
-				current_field += char
+				gd3_fields.append(gd3_data[field_start:field_end])
+				field_end += 2
+				field_start = field_end
 
 		# Once all the fields have been parsed, create a dict with the data
 		# some Gd3 tags dont have notes section
 		gd3_notes = ''
-		gd3_title_eng = basename(self.vgm_filename).encode("utf_16")
+		gd3_title_eng = b''
+		if self.vgm_filename is not None:
+			gd3_title_eng = basename(self.vgm_filename).encode("utf_16_le")
 		if len(gd3_fields) > 10:
 			gd3_notes = gd3_fields[10]
 			
@@ -490,7 +859,7 @@ class VgmStream:
 				gd3_title_eng = gd3_fields[0]
 
 				
-			self.gd3_data = {
+			self._gd3_data = {
 				'title_eng': gd3_title_eng,
 				'title_jap': gd3_fields[1],
 				'game_eng': gd3_fields[2],
@@ -504,213 +873,402 @@ class VgmStream:
 				'notes': gd3_notes
 			}		
 		else:
-			print "WARNING: Malformed/missing GD3 tag"
-			self.gd3_data = {
+			print >>self.log, "WARNING: Malformed/missing GD3 tag"
+			self._gd3_data = {
 				'title_eng': gd3_title_eng,
 				'title_jap': '',
 				'game_eng': '',
 				'game_jap': '',
 				'console_eng': '',
 				'console_jap': '',
-				'artist_eng': 'Unknown'.encode("utf_16"),
+				'artist_eng': 'Unknown'.encode("utf_16_le"),
 				'artist_jap': '',
 				'date': '',
 				'vgm_creator': '',
 				'notes': ''
 			}				
 
+	#-------------------------------------------------------------------------------------------------
+
+	# if end_time is non zero, parsing stops at the first command at or after end_time (in samples),
+	# so that the rest of the file is never decoded
+	def parse_commands(self, end_time = 0):
+		self.command_list.extend(self.iter_commands(end_time))
 
-		# Seek back to the original position in the VGM data
-		self.data.seek(original_pos)
+	# generator that decodes the VGM commands we keep from the VGM buffer, yielding (command, data, time) tuples
+	# if end_time is non zero, decoding stops at the first command at or after end_time (in samples)
+	def iter_commands(self, end_time = 0):
+		# decode directly from the VGM buffer, which avoids allocating a new string for every byte read
+		buf = self.buffer
 
+		# Seek to the start of the VGM data
+		pos = self.metadata.get_vgm_data_position()
+		end = len(buf)
+
+		unpack_uint8 = STRUCT_UINT8.unpack_from
+		unpack_uint16 = STRUCT_UINT16.unpack_from
+
+		# the time of each command is tracked as we go, so that we know when to stop
+		wait_samples = VGM_COMMAND_WAIT_SAMPLES
+		time = 0
+
+		# one lookup per command tells us how many operand bytes it has, and whether we keep it
+		command_data_size = VGM_COMMAND_DATA_SIZE
+		command_keep = bytearray(VGM_COMMAND_KEEP)
+		# 0x30 dd - dual chip command
+		command_keep[0x30] = 1 if self.dual_chip_mode_enabled else 0
+
+		try:
+			while pos < end:
+				# Read a byte, this will be a VGM command
+				command = unpack_uint8(buf, pos)[0]
+				size = command_data_size[command]
+				pos += 1
+
+				if command_keep[command]:
+					# stop once we reach the end of the required time window
+					if end_time and time >= end_time:
+						break
+
+					wait = wait_samples[command]
+
+					# 0x50 dd - PSG (SN76489/SN76496) write value dd
+					# 0x4f dd - Game Gear PSG stereo, write dd to port 0x06
+					# 0x30 dd - dual chip PSG write
+					if size == 1:
+						data = unpack_uint8(buf, pos)[0]
+					# 0x61 nn nn - Wait n samples, n can range from 0 to 65535
+					elif size == 2:
+						data = wait = unpack_uint16(buf, pos)[0]
+					# 0x62 - Wait 735 samples (60th of a second)
+					# 0x63 - Wait 882 samples (50th of a second)
+					# 0x66 - End of sound data
+					# 0x7n - Wait n+1 samples, n can range from 0 to 15
+					else:
+						data = 0
+					yield (command, data, time)
+					time += wait
+					pos += size
+
+					# Stop processing commands if we are at the end of the music
+					# data
+					if command == 0x66:
+						break
+
+				# 0x8n - YM2612 port 0 address 2A write from the data bank, then
+				#        wait n samples; n can range from 0 to 15
+				# the write is dropped, but we keep the wait as an equivalent 0x7n command
+				elif 0x81 <= command <= 0x8f:
+					if end_time and time >= end_time:
+						break
+					yield (command - 0x11, 0, time)
+					time += command - 0x80
+
+				# 0x67 0x66 tt ss ss ss ss - Data block
+				elif command == 0x67:
+					# Skip the compatibility and type bytes (0x66 tt) and read the size of the data block
+					data_block_size = STRUCT_UINT32.unpack_from(buf, pos + 2)[0]
+					pos += size
+
+					# Store the data block for later use
+					self.data_block = ByteBuffer(buf[pos:pos+data_block_size])
+					pos += data_block_size
+
+				# any other chip or reserved command is skipped along with its operands
+				else:
+					pos += size
+
+		except struct.error:
+			# the final command was truncated, so just stop here
+			print >>self.log, "WARNING: VGM command stream is truncated"
+		
+		
 	#-------------------------------------------------------------------------------------------------
 
-	def parse_commands(self):
-		# Save the current position of the VGM data
-		original_pos = self.data.tell()
+	# return the SN76489 register state (as an Sn76489State) just before command 'index'
+	def get_register_state(self, index):
+		command_data = self.command_list.data
+		state = Sn76489State()
+		i = self.find_next_command(0x50)
+		while 0 <= i < index:
+			state.write(command_data[i])
+			i = self.find_next_command(0x50, i + 1)
+		return state
 
-		# Seek to the start of the VGM data
-		self.data.seek(
-			self.metadata['vgm_data_offset'] +
-			self.metadata_offsets[self.metadata['version']]['vgm_data_offset']['offset']
-		)
+	#-------------------------------------------------------------------------------------------------
 
-		while True:
-			# Read a byte, this will be a VGM command, we will then make
-			# decisions based on the given command
-			command = self.data.read(1)
+	# clip the command stream to the time window [start_time, end_time) (in samples), an end_time of 0 means until the end.
+	# the start of the window is found by a binary search of the time index, and the register state at 
+	# that point is restored by writes at the start of the output.
+	def clip(self, start_time, end_time = 0):
 
-			# Break if we are at the end of the file
-			if command == '':
+		times = self.command_list.times
+
+		if end_time > 0:
+			print >>self.log, "   VGM Processing : Clipping VGM to " + str(float(start_time) / self.VGM_FREQUENCY) + "s - " + str(float(end_time) / self.VGM_FREQUENCY) + "s"
+			last = bisect.bisect_left(times, end_time)
+		else:
+			print >>self.log, "   VGM Processing : Clipping VGM from " + str(float(start_time) / self.VGM_FREQUENCY) + "s"
+			last = len(times)
+
+		first = bisect.bisect_left(times, start_time)
+		state = self.get_register_state(first)
+		self.run_stage(self.clip_stage, start_time, end_time, state, first, last)
+
+	# processing stage for clip()
+	# the register state at start_time is tracked from the writes before it, unless it is given.
+	# if first/last are given, only those commands are read from the input.
+	def clip_stage(self, commands, start_time, end_time = 0, state = None, first = 0, last = None):
+
+		if state is None:
+			state = Sn76489State()
+		restored = False
+
+		# time of the next output command, and the time at which the input stream ends
+		time = start_time
+		stream_time = start_time
+
+		for command, data, t in islice(commands, first, last):
+			if command == 0x66 or (end_time and t >= end_time):
+				stream_time = t
 				break
 
-			# 0x4f dd - Game Gear PSG stereo, write dd to port 0x06
-			# 0x50 dd - PSG (SN76489/SN76496) write value dd
-			if command in [b'\x4f', b'\x50']:
-				self.command_list.append({
-					'command': command,
-					'data': self.data.read(1),
-				})
-
-			# 0x51 aa dd - YM2413, write value dd to register aa
-			# 0x52 aa dd - YM2612 port 0, write value dd to register aa
-			# 0x53 aa dd - YM2612 port 1, write value dd to register aa
-			# 0x54 aa dd - YM2151, write value dd to register aa
-			elif command in [b'\x51', b'\x52', b'\x53', b'\x54']:
-				self.command_list.append({
-					'command': command,
-					'data': self.data.read(2),
-				})
-
-			# 0x61 nn nn - Wait n samples, n can range from 0 to 65535
-			elif command == b'\x61':
-				self.command_list.append({
-					'command': command,
-					'data': self.data.read(2),
-				})
-
-			# 0x62 - Wait 735 samples (60th of a second)
-			# 0x63 - Wait 882 samples (50th of a second)
-			# 0x66 - End of sound data
-			elif command in [b'\x62', b'\x63', b'\x66']:
-				self.command_list.append({'command': command, 'data': None})
-
-				# Stop processing commands if we are at the end of the music
-				# data
-				if command == b'\x66':
-					break
+			wait = VGM_COMMAND_WAIT_SAMPLES[command]
+			if wait < 0:
+				wait = data
+			stream_time = t + wait
 
-			# 0x67 0x66 tt ss ss ss ss - Data block
-			elif command == b'\x67':
-				# Skip the compatibility and type bytes (0x66 tt)
-				self.data.seek(2, 1)
-
-				# Read the size of the data block
-				data_block_size = struct.unpack('<I', self.data.read(4))[0]
-
-				# Store the data block for later use
-				self.data_block = ByteBuffer(self.data.read(data_block_size))
-
-			# 0x7n - Wait n+1 samples, n can range from 0 to 15
-			# 0x8n - YM2612 port 0 address 2A write from the data bank, then
-			#        wait n samples; n can range from 0 to 15
-			elif b'\x70' <= command <= b'\x8f':
-				self.command_list.append({'command': command, 'data': None})
-
-			# 0xe0 dddddddd - Seek to offset dddddddd (Intel byte order) in PCM
-			#                 data bank
-			elif command == b'\xe0':
-				self.command_list.append({
-					'command': command,
-					'data': self.data.read(4),
-				})
-				
-			# 0x30 dd - dual chip command
-			elif command == b'\x30':
-				if self.dual_chip_mode_enabled:
-					self.command_list.append({
-						'command': command,
-						'data': self.data.read(1),
-					})
-			
+			if t < start_time:
+				if command == 0x50:
+					state.write(data)
+				continue
+
+			if not restored:
+				for w in state.get_writes():
+					yield (0x50, w, 0)
+				restored = True
+
+			# re-encode the waits from the command times so that the waits straddling
+			# the start and end of the window are cut to fit
+			if wait == 0:
+				for item in vgm_wait_commands(t - time, time - start_time):
+					yield item
+				time = t
+				yield (command, data, t - start_time)
+
+		if not restored:
+			for w in state.get_writes():
+				yield (0x50, w, 0)
+
+		end = stream_time
+		if end_time and end > end_time:
+			end = end_time
+		end = max(end, start_time)
+
+		for item in vgm_wait_commands(end - time, time - start_time):
+			yield item
+		yield (0x66, 0, end - start_time)
+
+		self.metadata['total_samples'] = end - start_time
+
+	#-------------------------------------------------------------------------------------------------
+
+	# Chunks
+	# A long VGM can be split into chunks that are processed separately (see VgmConverter.process_chunks).
+	# Chunks are split just after a wait and before a LATCH write, so that no time slot (or tone write) is split 
+	# between two chunks. If the chunks are to be quantized, the wait must also cross a quantize interval boundary,
+	# so that each quantize interval falls wholly in one chunk.
+	# Each chunk starts with the register writes that restore the state of the chip at its start, at time 0, 
+	# followed by waits up to the start of the chunk, so the processing stages carry on from the same register 
+	# state as they would have in the whole VGM, and the commands of the chunk keep their times.
+
+	# the time before which the commands only restore the register state at the start of a chunk
+	seed_time = 0
+	# the retuned channel 2 tone for the last channel 2 tone write before the chunk, if transpose() had to correct it
+	seed_tone2 = None
+	# the channel volumes that transpose() has at the start of the chunk (which can be set, to carry on 
+	# from the chunk before), and at the end
+	seed_volumes = None
+	end_volumes = None
+
+	# split the command list into chunks of about chunk_samples each, aligned to quantize intervals of the given number of samples.
+	# returns a list of (first, last, start_time, boundary) tuples, where first & last are the range of command indexes,
+	# start_time is the time of the first command and boundary is the quantize interval boundary the chunk starts from.
+	def get_chunks(self, chunk_samples, interval = 1):
+		commands = self.command_list.commands
+		command_data = self.command_list.data
+		times = self.command_list.times
+
+		chunks = []
+		first = 0
+		start_time = 0
+		boundary = 0
+		i = bisect.bisect_left(times, chunk_samples, 1)
+		while i < len(commands):
+			# the first quantize interval boundary at or after the wait before this command
+			time_boundary = -(-times[i-1] // interval) * interval
+			if interval <= time_boundary < times[i]:
+				n = self.find_next_command(0x50, i)
+				if n < 0 or command_data[n] & 128:
+					chunks.append((first, i, start_time, boundary))
+					first = i
+					start_time = times[i]
+					boundary = time_boundary
+					i = bisect.bisect_left(times, start_time + chunk_samples, i + 1)
+					continue
+			i += 1
+		chunks.append((first, len(commands), start_time, boundary))
+		return chunks
+
+	# returns a checkpoint of the chunk of commands from first to last, starting at start_time,
+	# with the given register writes to restore the register state at the start of the chunk
+	def get_chunk(self, first, last, writes, start_time):
+		chunk = VgmCommandList()
+		for w in writes:
+			chunk.append(0x50, w, 0)
+		chunk.extend(vgm_wait_commands(start_time, 0))
+		chunk.commands.extend(self.command_list.commands[first:last])
+		chunk.data.extend(self.command_list.data[first:last])
+		chunk.times.extend(self.command_list.times[first:last])
+		return self.get_checkpoint(chunk)
+
+	# returns True if any DATA write doesn't directly follow a tone LATCH write for channels 0-2.
+	# The chip applies such writes to whichever register was last latched (see Sn76489State), but the processing
+	# stages only pair a DATA write with the tone LATCH write just before it, so they track a different state.
+	def has_unpaired_data_writes(self):
+		commands = self.command_list.commands
+		command_data = self.command_list.data
+		i = self.find_next_command(0x50)
+		while i >= 0:
+			if (command_data[i] & 128) == 0:
+				if i == 0 or commands[i-1] != 0x50:
+					return True
+				w = command_data[i-1]
+				if (w & (128+16)) != 128 or ((w>>5)&3) == 3:
+					return True
+			i = self.find_next_command(0x50, i + 1)
+		return False
+
+	#-------------------------------------------------------------------------------------------------
+
+	# run a processing stage over the current commands.
+	# stage is a generator function that takes an iterable of (command, data, time) tuples (and any extra args), 
+	# and yields the processed (command, data, time) tuples.
+	# normally the stage is run over the whole command list straight away. In streaming mode it is 
+	# chained onto the pipeline instead, and runs when finish() is called.
+	def run_stage(self, stage, *args):
+		if self.command_list is None:
+			self.command_stream = stage(self.command_stream, *args)
+		else:
+			command_list = VgmCommandList()
+			command_list.extend(stage(self.command_list, *args))
+			self.command_list = command_list
+
+	# run a writer stage, which passes the commands through unchanged
+	def run_writer(self, stage, *args):
+		if self.command_list is None:
+			self.command_stream = stage(self.command_stream, *args)
+		else:
+			for item in stage(self.command_list, *args):
+				pass
+
+	# run the streaming pipeline to completion. Does nothing if not in streaming mode.
+	def finish(self):
+		if self.command_list is None:
+			for item in self.command_stream:
+				pass
+			self.command_stream = iter(())
 
-		# Seek back to the original position in the VGM data
-		self.data.seek(original_pos)
-		
-		
 	#-------------------------------------------------------------------------------------------------
 
 			
 			
-	def write_vgm(self, filename):
-			
-		print "   VGM Processing : Writing output VGM file '" + filename + "'"
+	# output can be a filename, '-' for stdout or a binary file object
+	def write_vgm(self, output):
+		vgm_file = self.open_output(output)
+		print >>self.log, "   VGM Processing : Writing output VGM file '" + vgm_file.name + "'"
+		self.run_writer(self.write_vgm_stage, vgm_file)
+
+	# open an output file for a writer stage, returns a VgmOutput
+	# the output can be the source file, which is replaced once the output is written, apart from in streaming mode,
+	# where the source is still being read while the output is written
+	def open_output(self, output):
+		if self.command_list is None and self.is_source_file(output):
+			raise FatalError("Cannot write over the source VGM file '" + output + "' when streaming")
+
+		# the GD3 tag is read from the source now, before the source can be replaced
+		self.gd3_data
+
+		return VgmOutput(output, self)
+
+	# returns True if filename is the source VGM file
+	def is_source_file(self, filename):
+		if self.vgm_filename is None or not isinstance(filename, basestring) or filename == '-':
+			return False
+		return os.path.realpath(filename) == os.path.realpath(self.vgm_filename)
+
+	# returns the processed VGM file data
+	def get_vgm_data(self):
+		vgm_data = ByteBuffer()
+		self.write_vgm(vgm_data)
+		self.finish()
+		return vgm_data.getvalue()
+
+	# writer stage for write_vgm(), writes to a VgmOutput
+	# the VGM data is written as it is received, and the header is filled in at the end.
+	def write_vgm_stage(self, commands, vgm_file):
+
+		vgm_file.write(bytes(bytearray(64)))
+
 		vgm_stream = bytearray()
-		vgm_time = 0
-		
-		# convert the VGM command list to a byte array
-		for elem in self.command_list:
-			command = elem['command']
-			data = elem['data']
-			
+		vgm_stream_length = 0
 
-			# track time offset for debug purposes
-			if b'\x70' <= command <= b'\x7f':	
-				pdata = binascii.hexlify(command)
-				t = int(pdata, 16)
-				t &= 15
-				t += 1
-				vgm_time += t
-				scommand = "WAITn"
-				#if self.VERBOSE: print " WAITN=" + str(t)
-			else:
-				pcommand = binascii.hexlify(command)
-			
-				if pcommand == "61":
-					scommand = "WAIT"
-					pdata = binascii.hexlify(data)
-					t = int(pdata, 16)
-					# sdm: swap bytes to LSB
-					lsb = t & 255
-					msb = (t / 256)
-					t = (lsb * 256) + msb
-					vgm_time += t		
-					#if self.VERBOSE: print " WAIT=" + str(t)
-				else:			
-					if pcommand == "62":	#wait60
-						vgm_time += 735
-					else:
-						if pcommand == "63":	#wait50
-							vgm_time += 882				
-			
-			
-			
-			if (data != None):
-				if self.VERBOSE: print "command=" + str(binascii.hexlify(command)) + ", data=" + str(binascii.hexlify(data)) + ", time=" + str(float(vgm_time)/44100.0) + " secs"
-				
-			# filter dual chip
-			if b'\x30' == command:
-				if self.VERBOSE: print "DUAL CHIP COMMAND"
-				#continue
-				#command = b'\x50'
+		for item in commands:
+			command, data, time = item
 
-			
-			vgm_stream.extend(command)
-			if (data != None):
-				vgm_stream.extend(data)
-		
-		vgm_stream_length = len(vgm_stream)		
+			# track time offset for debug purposes
+			if self.VERBOSE:
+				if VGM_COMMAND_DATA_SIZE[command] != 0:
+					print >>self.log, "command=" + format(command, '02x') + ", data=" + format(data, 'x') + ", time=" + str(float(time)/44100.0) + " secs"
+
+				# filter dual chip
+				if command == 0x30:
+					print >>self.log, "DUAL CHIP COMMAND"
+
+			# convert the VGM command to bytes
+			vgm_stream.append(command)
+			size = VGM_COMMAND_DATA_SIZE[command]
+			if size == 1:
+				vgm_stream.append(data)
+			elif size == 2:
+				vgm_stream.extend(STRUCT_UINT16.pack(data))
+			elif size == 4:
+				vgm_stream.extend(STRUCT_UINT32.pack(data))
+
+			if len(vgm_stream) >= 65536:
+				vgm_file.write(bytes(vgm_stream))
+				vgm_stream_length += len(vgm_stream)
+				vgm_stream = bytearray()
+
+			yield item
+
+		vgm_file.write(bytes(vgm_stream))
+		vgm_stream_length += len(vgm_stream)
 
 		# build the GD3 data block
-		gd3_data = bytearray()
 		gd3_stream = bytearray()	
 		gd3_stream_length = 0
 		
 		gd3_offset = 0
 		if self.STRIP_GD3 == False:
-			gd3_data.extend(self.gd3_data['title_eng'] + b'\x00\x00')
-			gd3_data.extend(self.gd3_data['title_jap'] + b'\x00\x00')
-			gd3_data.extend(self.gd3_data['game_eng'] + b'\x00\x00')
-			gd3_data.extend(self.gd3_data['game_jap'] + b'\x00\x00')
-			gd3_data.extend(self.gd3_data['console_eng'] + b'\x00\x00')
-			gd3_data.extend(self.gd3_data['console_jap'] + b'\x00\x00')
-			gd3_data.extend(self.gd3_data['artist_eng'] + b'\x00\x00')
-			gd3_data.extend(self.gd3_data['artist_jap'] + b'\x00\x00')
-			gd3_data.extend(self.gd3_data['date'] + b'\x00\x00')
-			gd3_data.extend(self.gd3_data['vgm_creator'] + b'\x00\x00')
-			gd3_data.extend(self.gd3_data['notes'] + b'\x00\x00')
-			
-			gd3_stream.extend('Gd3 ')
-			gd3_stream.extend(struct.pack('I', 0x100))				# GD3 version
-			gd3_stream.extend(struct.pack('I', len(gd3_data)))		# GD3 length		
-			gd3_stream.extend(gd3_data)		
+			gd3_stream = self.build_gd3()
 			
 			gd3_offset = (64-20) + vgm_stream_length
 			gd3_stream_length = len(gd3_stream)
 		else:
-			print "   VGM Processing : GD3 tag was stripped"
+			print >>self.log, "   VGM Processing : GD3 tag was stripped"
 		
-		# build the full VGM output stream		
+		# build the VGM header
 		vgm_data = bytearray()
 		vgm_data.extend(self.vgm_magic_number)
 		vgm_data.extend(struct.pack('I', 64 + vgm_stream_length + gd3_stream_length - 4))				# EoF offset
@@ -731,44 +1289,245 @@ class VgmStream:
 		vgm_data.extend(struct.pack('I', 0))				# SEGA PCM clock	
 		vgm_data.extend(struct.pack('I', 0))				# SPCM interface	
 
-		# attach the vgm data
-		vgm_data.extend(vgm_stream)
-
 		# attach the vgm gd3 tag if required
 		if self.STRIP_GD3 == False:
-			vgm_data.extend(gd3_stream)
-		
-		# write to output file
-		vgm_file = open(filename, 'wb')
-		vgm_file.write(vgm_data)
+			vgm_file.write(bytes(gd3_stream))
+
+		# and go back to fill in the header
+		vgm_file.write_header(bytes(vgm_data))
 		vgm_file.close()
 		
-		print "   VGM Processing : Written " + str(int(len(vgm_data))) + " bytes, GD3 tag used " + str(gd3_stream_length) + " bytes"
+		print >>self.log, "   VGM Processing : Written " + str(64 + vgm_stream_length + gd3_stream_length) + " bytes, GD3 tag used " + str(gd3_stream_length) + " bytes"
 		
-		print "All done."
+		print >>self.log, "All done."
+
+	#-------------------------------------------------------------------------------------------------
+
+	# build a GD3 tag block from self.gd3_data, returns a bytearray
+	def build_gd3(self):
+		gd3_data = bytearray()
+		for field in self.gd3_fields:
+			gd3_data.extend(self.gd3_data[field] + b'\x00\x00')
+
+		gd3_stream = bytearray()
+		gd3_stream.extend('Gd3 ')
+		gd3_stream.extend(struct.pack('I', 0x100))				# GD3 version
+		gd3_stream.extend(struct.pack('I', len(gd3_data)))		# GD3 length		
+		gd3_stream.extend(gd3_data)		
+		return gd3_stream
+
+	#-------------------------------------------------------------------------------------------------
+
+	# set a GD3 tag field to the given (unicode or ascii) text
+	def set_gd3_field(self, field, text):
+		if field not in self.gd3_fields:
+			raise FatalError("Unknown GD3 field '" + field + "', must be one of " + ", ".join(self.gd3_fields))
+		self.gd3_data[field] = text.decode('utf_8').encode('utf_16_le') if isinstance(text, str) else text.encode('utf_16_le')
+
+	#-------------------------------------------------------------------------------------------------
+
+	# write a copy of the source VGM file with the current GD3 tag (from self.gd3_data)
+	# Only the GD3 tag, and the EoF & GD3 offsets in the header are changed. Everything else, including
+	# the command stream, is copied as-is from the source buffer without being decoded.
+	# filename can be the source file, to retag it in place, in which case this VgmStream is closed afterwards.
+	# The output is gzipped if filename has a .vgz extension
+	def write_gd3(self, filename):
+
+		buf = self.buffer
+
+		# find where the existing GD3 tag is, if there is one
+		# an offset that doesn't point at a whole GD3 header within the file is taken to mean there is no tag
+		gd3_position = self.metadata.get_gd3_position()
+		if gd3_position != 0 and gd3_position + 12 <= len(buf) and buf[gd3_position:gd3_position+4] == b'Gd3 ':
+			gd3_length = STRUCT_UINT32.unpack_from(buf, gd3_position + 8)[0]
+			data_end = gd3_position
+			tail_start = min(gd3_position + 12 + gd3_length, len(buf))
+		else:
+			# the tag is added after everything in the file, as the EoF offset may not cover all of the data
+			data_end = len(buf)
+			tail_start = data_end
+
+		gd3_stream = self.build_gd3()
+		total_length = data_end + len(gd3_stream) + len(buf) - tail_start
+
+		# patch the header fields that have changed
+		header = bytearray(buf[0:VgmHeader.GD3_OFFSET_BASE + 4])
+		struct.pack_into('<I', header, 0x04, total_length - 4)									# EoF offset
+		struct.pack_into('<I', header, VgmHeader.GD3_OFFSET_BASE, data_end - VgmHeader.GD3_OFFSET_BASE)	# GD3 offset
+
+		# write to a temporary file first, since we may be replacing the source file
+		temp_file, temp_filename = open_temp_file(filename)
+		try:
+			if filename.lower().endswith('.vgz'):
+				# the gzip header records the name of the file, which would otherwise be the temporary one
+				vgm_file = gzip.GzipFile(filename = basename(filename), mode = 'wb', fileobj = temp_file)
+			else:
+				vgm_file = temp_file
+
+			vgm_file.write(bytes(header))
+
+			# copy the rest of the header & the command stream in chunks, straight from the source buffer
+			chunk_size = 1024*1024
+			for offset in range(len(header), data_end, chunk_size):
+				vgm_file.write(buf[offset:min(offset+chunk_size, data_end)])
+
+			vgm_file.write(bytes(gd3_stream))
+
+			# keep anything that followed the original GD3 tag
+			if tail_start < len(buf):
+				vgm_file.write(buf[tail_start:])
+			vgm_file.close()
+			temp_file.close()
+		except:
+			temp_file.close()
+			os.remove(temp_filename)
+			raise
+
+		# replace the output file
+		if self.is_source_file(filename):
+			self.close()
+		replace_file(temp_filename, filename)
+
+		print >>self.log, "   VGM Processing : Written " + str(total_length) + " bytes to '" + filename + "', GD3 tag used " + str(len(gd3_stream)) + " bytes"
+
+	#-------------------------------------------------------------------------------------------------
+
+	# release the source VGM buffer
+	def close(self):
+		if isinstance(self.buffer, mmap.mmap):
+			self.buffer.close()
+		self.buffer = None
+
+	#-------------------------------------------------------------------------------------------------
+
+	# Checkpoints
+	# The processed command list and the state that goes with it can be saved after any processing pass,
+	# and restored into a header only VgmStream of the same source to carry on from that point.
+	# A checkpoint is a JSON frame of the state, followed by frames of the command list columns.
+	# Each frame is a 4 byte length followed by the data. Not available in streaming mode.
+
+	# attributes saved in a checkpoint, along with the header fields
+	CHECKPOINT_STATE = ('vgm_source_clock', 'vgm_target_clock', 'dual_chip_mode_enabled', 'vgm_loop_offset', 'vgm_loop_length')
+
+	# returns a checkpoint of the current state as a string, with the given command list instead of the current one if there is one
+	def get_checkpoint(self, command_list = None):
+		if command_list is None:
+			command_list = self.command_list
+		state = dict((name, getattr(self, name)) for name in self.CHECKPOINT_STATE)
+		state['metadata'] = dict((field, self.metadata[field]) for field in VgmHeader.__slots__ if field != 'vgm_ident')
+
+		checkpoint = bytearray()
+		for data in (json.dumps(state), bytes(command_list.commands), command_list.data.tostring(), command_list.times.tostring()):
+			checkpoint.extend(STRUCT_UINT32.pack(len(data)))
+			checkpoint.extend(data)
+		return bytes(checkpoint)
+
+	# restore the state from a checkpoint
+	def restore_checkpoint(self, checkpoint):
+		frames = []
+		position = 0
+		for i in range(4):
+			size = STRUCT_UINT32.unpack_from(checkpoint, position)[0]
+			position += 4
+			frames.append(checkpoint[position:position+size])
+			position += size
+
+		state = json.loads(frames[0])
+		for name in self.CHECKPOINT_STATE:
+			setattr(self, name, state[name])
+		for field, value in state['metadata'].items():
+			self.metadata[str(field)] = value
+
+		self.command_list = VgmCommandList()
+		self.command_list.commands.extend(frames[1])
+		self.command_list.data.fromstring(frames[2])
+		self.command_list.times.fromstring(frames[3])
+		self.command_stream = None
+		self.lookahead = None
 
 	#-------------------------------------------------------------------------------------------------
 			
-	# clock_type can be NTSC, PAL or BBC (case insensitive)
+	# target chip parameters for set_target_clock(), as (clock, feedback, shift register width)
+	TARGET_CLOCKS = {
+		'ntsc' : (3579545, 0x0006, 16),	# usually 3.579545 MHz (NTSC) for Sega-based PSG tunes, 0x0006 feedback for SN76494, SN76496
+		'pal' : (4433619, 0x0006, 16),	# 4.43361875 Mz for PAL
+		'bbc' : (4000000, 0x0003, 15),	# 4.0 Mhz on Beeb, 0x0003 feedback for BBC configuration of SN76489, which taps bit 15 on the SR
+	}
+
+	# clock_type can be NTSC, PAL or BBC (case insensitive), or any clock speed in Hz (or MHz if less than 1000)
+	# for a clock speed, the source VGM's noise feedback and shift register width are kept
 	def set_target_clock(self, clock_type):
-		if clock_type.lower() == 'ntsc':
-			self.metadata['sn76489_feedback'] = 0x0006	# 0x0006 for	SN76494, SN76496
-			self.metadata['sn76489_clock'] = 3579545	# usually 3.579545 MHz (NTSC) for Sega-based PSG tunes
-			self.metadata['sn76489_shift_register_width'] = 16	# 	
-			self.vgm_target_clock = self.metadata['sn76489_clock']	
+		clock_type = str(clock_type).lower()
+		if clock_type in self.TARGET_CLOCKS:
+			clock, feedback, shift_register_width = self.TARGET_CLOCKS[clock_type]
+			self.metadata['sn76489_feedback'] = feedback
+			self.metadata['sn76489_shift_register_width'] = shift_register_width
 		else:
-			if clock_type.lower() == 'pal':
-				self.metadata['sn76489_feedback'] = 0x0006	# 0x0006 for	SN76494, SN76496
-				self.metadata['sn76489_clock'] = 4433619	# 4.43361875 Mz for PAL
-				self.metadata['sn76489_shift_register_width'] = 16	# 	
-				self.vgm_target_clock = self.metadata['sn76489_clock']	
+			try:
+				clock = float(clock_type)
+				if clock < 1000:
+					clock *= 1000000
+				clock = int(round(clock))
+			except (ValueError, OverflowError):
+				clock = 0
+			# the top bits of the clock are flags in the VGM header
+			if clock <= 0 or clock >= 0x40000000:
+				raise FatalError("Unknown clock type '" + clock_type + "', must be 'ntsc', 'pal', 'bbc' or a clock speed in Hz")
+		self.metadata['sn76489_clock'] = clock
+		self.vgm_target_clock = clock
+
+	# retune tables from get_retune_table(), for each (source clock, target clock, periodic noise) 
+	# they are kept for the life of the process, so the workers of a batch or server only compute them once
+	retune_tables = {}
+
+	# returns the table to retune tone register values from the source clock to the target clock, 
+	# which is a list of (retuned value, error in Hz) for each of the 1024 tone register values
+	# is_periodic_noise_tone selects the table for channel 2 tones that drive tuned periodic noise on channel 3
+	def get_retune_table(self, is_periodic_noise_tone = False):
+		key = (self.vgm_source_clock, self.vgm_target_clock, is_periodic_noise_tone)
+		table = self.retune_tables.get(key)
+		if table != None:
+			return table
+
+		source_clock = float(self.vgm_source_clock)
+		target_clock = float(self.vgm_target_clock)
+
+		# 0 is an illegal value, and is left as it is
+		table = [(0, 0.0)]
+		for tone_frequency in range(1, 1024):
+			# compute correct hz frequency of current tone from formula:
+			#
+			# hz =     Clock        Or for periodic noise:  hz =   Clock              where SR is 15 or 16 depending on chip
+			#      -------------                                 ------------------
+			#      ( 2 x N x 16)                                 ( 2 x N x 16 x SR)
+			
+			if is_periodic_noise_tone:	
+				noise_ratio = (15.0 / 16.0) * (source_clock / target_clock)
+				v = float(tone_frequency) / noise_ratio
 			else:
-				if clock_type.lower() == 'bbc':
-					self.metadata['sn76489_feedback'] = 0x0003	# 0x0003 for BBC configuration of SN76489
-					self.metadata['sn76489_clock'] = 4000000	# 4.0 Mhz on Beeb, 
-					self.metadata['sn76489_shift_register_width'] = 15	# BBC taps bit 15 on the SR	
-					self.vgm_target_clock = self.metadata['sn76489_clock']			
-	
+				# compute corrected tone register value for generating the same frequency using the target chip's clock rate
+				hz = source_clock / ( 2.0 * float(tone_frequency) * 16.0)
+				v = target_clock / (2.0 * hz * 16.0 )
+			
+			# due to the integer maths, some precision is lost at the lower end
+			output_freq = int(round(v))	# using round minimizes error margin at lower precision
+			# clamp range to 10 bits
+			if output_freq > 1023:
+				output_freq = 1023
+			if output_freq < 1:
+				output_freq = 1
+			
+			if is_periodic_noise_tone:
+				hz1 = source_clock / (2.0 * float(tone_frequency) * 16.0 * 15.0) # target frequency
+				hz2 = target_clock / (2.0 * float(output_freq) * 16.0 * 15.0)					
+			else:
+				hz1 = source_clock / (2.0 * float(tone_frequency) * 16.0) # target frequency
+				hz2 = target_clock / (2.0 * float(output_freq) * 16.0)
+
+			table.append((output_freq, hz2 - hz1))
+
+		self.retune_tables[key] = table
+		return table
 
 
 	#-------------------------------------------------------------------------------------------------
@@ -784,70 +1543,92 @@ class VgmStream:
 		
 	# helper function
 	# given a start offset (default 0) into the command list, find the next index where
-	# the command matches search_command or return -1 if no more of these commands can be found.
+	# the command byte matches search_command or return -1 if no more of these commands can be found.
 	def find_next_command(self, search_command, offset = 0):
-		for j in range(offset, len(self.command_list)):
-			c = self.command_list[j]["command"]
-			
-			# only process write data commands
-			if c == search_command:
-				return j
-		else:
-			return -1
+		return self.command_list.commands.find(chr(search_command), offset)
 	
 	#-------------------------------------------------------------------------------------------------
 	
 	# iterate through the command list, removing any write commands that are destined for filter_channel_id
 	def filter_channel(self, filter_channel_id):
-		print "   VGM Processing : Filtering channel " + str(filter_channel_id)
-	
-		filtered_command_list = []
-		j = 0
+		print >>self.log, "   VGM Processing : Filtering channel " + str(filter_channel_id)
+		self.run_stage(self.filter_channel_stage, filter_channel_id)
+
+	# processing stage for filter_channel()
+	def filter_channel_stage(self, commands, filter_channel_id):
 		latched_channel = 0
-		for q in self.command_list:
+		for item in commands:
+			command, qw, time = item
 			
 			# only process write data commands
-			if q["command"] != struct.pack('B', 0x50):
-				filtered_command_list.append(q)
+			if command != 0x50:
+				yield item
 			else:
 				# Check if LATCH/DATA write 								
-				qdata = q["data"]
-				qw = int(binascii.hexlify(qdata), 16)
 				if qw & 128:					
 					# Get channel id and latch it
 					latched_channel = (qw>>5)&3
 					
 				if latched_channel != filter_channel_id:
-					filtered_command_list.append(q)
-		
-		self.command_list = filtered_command_list
+					yield item
 
 	#-------------------------------------------------------------------------------------------------
 	# iterate through the command list, unpacking any single tone writes on a channel
 	def unpack_tones(self):
-		print "   VGM Processing : Unpacking tones "
-	
-		filtered_command_list = []
-		j = 0
+		print >>self.log, "   VGM Processing : Unpacking tones "
+		self.run_stage(self.unpack_tones_stage)
+
+	# processing stage for unpack_tones()
+	def unpack_tones_stage(self, commands):
 		latched_channel = 0
 		latched_tone_frequencies = [0, 0, 0, 0]
+
+		# a tone LATCH write is held as pending until the next write command is seen, to see if it is followed
+		# by a DATA write (in which case it is a full tone write). Any non-write commands between the two are held back.
+		pending_latch = None
+		held_commands = []
+		lookahead = self.lookahead or sys.maxsize
 		
-		for n in range(len(self.command_list)):
-			q = self.command_list[n]
+		for item in commands:
+			command, qw, time = item
+
+			if pending_latch is not None:
+				if command != 0x50 and len(held_commands) < lookahead:
+					held_commands.append(item)
+					continue
+
+				# found the next VGM write command
+				# Check if next this is a DATA write, and capture frequency if so
+				# otherwise, its a LATCH/DATA write, so no additional frequency to process
+				multi_write = False
+				if command == 0x50 and (qw & 128) == 0:
+					multi_write = True
+					nfreq = (qw & 0b00111111)
+					latched_tone_frequencies[latched_channel] = (latched_tone_frequencies[latched_channel] & 0b0000001111) | (nfreq << 4)	
+
+				# if we detected a single register tone write, we need as unpack it, to make sure transposing works correctly
+				if multi_write == False and latched_channel != 3:
+					if self.VERBOSE: print >>self.log, " UNPACKING SINGLE REGISTER TONE WRITE on CHANNEL " + str(latched_channel)
+					# inject additional tone write to prevent any more single register tone writes
+					hi_data = (latched_tone_frequencies[latched_channel]>>4) & 0b00111111
+					yield (0x50, hi_data, pending_latch[2])
+
+				for held_item in held_commands:
+					yield held_item
+				held_commands = []
+				pending_latch = None
 			
 			# we always output at least the same data stream, but we might inject a new tone write if needed
-			filtered_command_list.append(q)	
+			yield item
+
 			# only process write data commands
-			if q["command"] == struct.pack('B', 0x50):
+			if command == 0x50:
 			
 				# Check if LATCH/DATA write 								
-				qdata = q["data"]
-				qw = int(binascii.hexlify(qdata), 16)
 				if qw & 128:					
 					# Get channel id and latch it
 					latched_channel = (qw>>5)&3
 					
-							
 					# Check if TONE update				
 					if (qw & 16) == 0:
 												
@@ -855,45 +1636,18 @@ class VgmStream:
 						qfreq = (qw & 0b00001111)
 						latched_tone_frequencies[latched_channel] = (latched_tone_frequencies[latched_channel] & 0b1111110000) | qfreq
 
-							
 						# look ahead, and see if the next command is a DATA write as if so, this will be part of the same tone commmand
 						# so load this into our register as well so that we have the correct tone frequency to work with
-						
-						multi_write = False
-						nindex = n
-						while (nindex < (len(self.command_list)-1)):# check we dont overflow the array, bail if we do, since it means we didn't find any further DATA writes.
-							nindex += 1
-
-							ncommand = self.command_list[nindex]["command"]
-							# skip any non-VGM-write commands
-							if ncommand != struct.pack('B', 0x50):
-								continue
-							else:
-								# found the next VGM write command
-								ndata = self.command_list[nindex]["data"]
-
-								# Check if next this is a DATA write, and capture frequency if so
-								# otherwise, its a LATCH/DATA write, so no additional frequency to process
-								nw = int(binascii.hexlify(ndata), 16)
-								if (nw & 128) == 0:
-									multi_write = True
-									nfreq = (nw & 0b00111111)
-									latched_tone_frequencies[latched_channel] = (latched_tone_frequencies[latched_channel] & 0b0000001111) | (nfreq << 4)	
-							
-								break					
-					
-						# if we detected a single register tone write, we need as unpack it, to make sure transposing works correctly
-						if multi_write == False and latched_channel != 3:
-							if self.VERBOSE: print " UNPACKING SINGLE REGISTER TONE WRITE on CHANNEL " + str(latched_channel)
-							# inject additional tone write to prevent any more single register tone writes
-							# re-program q and re-cycle it
-							
-							hi_data = (latched_tone_frequencies[latched_channel]>>4) & 0b00111111
-							new_q = { "command" : q["command"], "data" : struct.pack('B', hi_data) }
-							filtered_command_list.append(new_q)
-
-		
-		self.command_list = filtered_command_list			
+						pending_latch = item
+
+		# no further DATA writes were found after the last tone LATCH write
+		if pending_latch is not None:
+			if latched_channel != 3:
+				if self.VERBOSE: print >>self.log, " UNPACKING SINGLE REGISTER TONE WRITE on CHANNEL " + str(latched_channel)
+				hi_data = (latched_tone_frequencies[latched_channel]>>4) & 0b00111111
+				yield (0x50, hi_data, pending_latch[2])
+			for held_item in held_commands:
+				yield held_item
 	
 	#-------------------------------------------------------------------------------------------------
 	
@@ -908,401 +1662,568 @@ class VgmStream:
 		# setup the correct target chip parameters
 		self.set_target_clock(clock_type)
 		
-		# total number of commands in the vgm stream
-		num_commands = len(self.command_list)
-
 		# re-tune any tone commands if target clock is different to source clock
 		# i think it's safe to do this in the quantized packets we've created, as they tend to be completed within a single time slot
 		# (eg. little or no chance of a multi-tone LATCH+DATA write being split by a wait command)
 
 		if (self.vgm_source_clock != self.vgm_target_clock):
+
+			# warnings are reported at the end, unless every one is wanted
+			if self.VERBOSE:
+				self.diagnostics.log = self.log
 		
-			print "   VGM Processing : Re-tuning VGM to new clock speed"
-			print "   VGM Processing : Original clock " + str(float(self.vgm_source_clock)/1000000.0) + " MHz, Target Clock " + str(float(self.vgm_target_clock)/1000000.0) + " MHz"
-		
-			# used by the clock retuning code, initialized once at the start of the song, so that latched register states are preserved across the song
-			latched_tone_frequencies = [0, 0, 0, 0]
-			latched_volumes = [0, 0, 0, 0]
-			tone2_offsets = [-1, -1]
-			latched_channel = 0		
-			vgm_time = 0
-		
-			# helper function
-			# calculates a retuned tone frequency based on given frequency & periodic noise indication
-			# returns retuned frequency. 
-			# does not change any external state
-			def recalc_frequency(tone_frequency, is_periodic_noise_tone = False):
-			
-				if self.VERBOSE: print " recalc_frequency(), vgm_time=" + str(vgm_time) + " clock time=" + str(float(vgm_time)/44100.0) + " secs"
+			print >>self.log, "   VGM Processing : Re-tuning VGM to new clock speed"
+			print >>self.log, "   VGM Processing : Original clock " + str(float(self.vgm_source_clock)/1000000.0) + " MHz, Target Clock " + str(float(self.vgm_target_clock)/1000000.0) + " MHz"
+			if not self.transpose_numpy():
+				self.run_stage(self.transpose_stage)
+		else:
+			print >>self.log, "transpose() - No transposing necessary as target clock matches source clock"
 
-			
-				# compute the correct frequency
-				# first check it is not 0 (illegal value)
-				output_freq = 0
+	# processing stage for transpose()
+	# commands are buffered so that tone writes can be updated by looking ahead to their DATA writes, 
+	# and back to the last channel 2 tone write (for tuned periodic noise).
+	def transpose_stage(self, commands):
+		# used by the clock retuning code, initialized once at the start of the song, so that latched register states are preserved across the song
+		latched_tone_frequencies = [0, 0, 0, 0]
+		latched_volumes = [0, 0, 0, 0]
+		tone2_offsets = [-1, -1]
+		latched_channel = 0		
+		vgm_time = 0
+	
+		# the retune tables for normal tones and tuned periodic noise
+		retune_tables = (self.get_retune_table(False), self.get_retune_table(True))
+
+		# helper function
+		# adds a warning for the latched channel to the diagnostics, apart from those for the seed of a chunk,
+		# since the chunk before gives those
+		def warn(message, detail = None):
+			if not seeding:
+				self.diagnostics.add(message, latched_channel, vgm_time, detail)
+
+		# helper function
+		# looks up a retuned tone frequency based on given frequency & periodic noise indication
+		# returns retuned frequency. 
+		# does not change any external state
+		def recalc_frequency(tone_frequency, is_periodic_noise_tone = False):
+			output_freq, hz_err = retune_tables[is_periodic_noise_tone][tone_frequency]
+
+			if self.VERBOSE:
+				print >>self.log, " recalc_frequency(), vgm_time=" + str(vgm_time) + " clock time=" + str(float(vgm_time)/44100.0) + " secs"
 				if tone_frequency == 0:
-					if self.VERBOSE: print "Zero frequency tone detected on channel "# + str(latched_channel)
+					print >>self.log, "Zero frequency tone detected on channel "# + str(latched_channel)
 				else:
-				
-					# compute correct hz frequency of current tone from formula:
-					#
-					# hz =     Clock        Or for periodic noise:  hz =   Clock              where SR is 15 or 16 depending on chip
-					#      -------------                                 ------------------
-					#      ( 2 x N x 16)                                 ( 2 x N x 16 x SR)
-					
-					if is_periodic_noise_tone:	
-						if self.VERBOSE: print "Periodic noise tone"
-						noise_ratio = (15.0 / 16.0) * (float(self.vgm_source_clock) / float(self.vgm_target_clock))
-						v = float(tone_frequency) / noise_ratio
-						if self.VERBOSE: print "noise_ratio=" + str(noise_ratio)
-						if self.VERBOSE: print "original freq=" + str(tone_frequency) + ", new freq=" + str(v)
-						if self.VERBOSE: print "retuned periodic noise effect on channel 2"										
+					print >>self.log, "channel=" + str(latched_channel) + ", old frequency=" + str(tone_frequency) + ", new frequency=" + str(output_freq) + ", source_clock=" + str(self.vgm_source_clock) + ", target_clock=" + str(self.vgm_target_clock) + ", PN=" + str(is_periodic_noise_tone) + ", hz_err =" + str(hz_err)
 
-					else:
-						if self.VERBOSE: print "Normal tone"				
-						# compute corrected tone register value for generating the same frequency using the target chip's clock rate
-						hz = float(self.vgm_source_clock) / ( 2.0 * float(tone_frequency) * 16.0)
-						if self.VERBOSE: print "hz=" + str(hz)
-						v = float(self.vgm_target_clock) / (2.0 * hz * 16.0 )
-						if self.VERBOSE: print "v=" + str(v)
-					
-					# due to the integer maths, some precision is lost at the lower end
-					output_freq = int(round(v))	# using round minimizes error margin at lower precision
-					# clamp range to 10 bits
-					if output_freq > 1023:
-						output_freq = 1023
-					if output_freq < 1:
-						output_freq = 1
-					
-					if is_periodic_noise_tone:
-						hz1 = float(self.vgm_source_clock) / (2.0 * float(tone_frequency) * 16.0 * 15.0) # target frequency
-						hz2 = float(self.vgm_target_clock) / (2.0 * float(output_freq) * 16.0 * 15.0)					
-					else:
-						hz1 = float(self.vgm_source_clock) / (2.0 * float(tone_frequency) * 16.0) # target frequency
-						hz2 = float(self.vgm_target_clock) / (2.0 * float(output_freq) * 16.0)
-
-					hz_err = hz2-hz1
-					if self.VERBOSE: print "channel=" + str(latched_channel) + ", old frequency=" + str(tone_frequency) + ", new frequency=" + str(output_freq) + ", source_clock=" + str(self.vgm_source_clock) + ", target_clock=" + str(self.vgm_target_clock) + ", src_hz=" + str(hz1) + ", tgt_hz=" + str(hz2) + ", hz_err =" + str(hz_err)
-					if hz_err > 2.0 or hz_err < -2.0:
-						print "  WARNING: Large error transposing tone! [" + str(hz_err) + " Hz ] (channel="+str(latched_channel)+", PN="+str(is_periodic_noise_tone)+")"
-					#if self.VERBOSE: print ""
-				
-				return output_freq		
+			if hz_err > 2.0 or hz_err < -2.0:
+				warn("WARNING: Large error transposing tone!", str(hz_err) + " Hz, PN=" + str(is_periodic_noise_tone))
+			
+			return output_freq		
 
 
-			TEST_OUTPUT = False # show additional test output in this section
+		TEST_OUTPUT = False # show additional test output in this section
+	
+		# iterate through write commands looking for tone writes and recalculate their frequencies
+		## first create a reference copy of the command list (just for a tuning hack below)
+		#command_list_copy = list(self.command_list)
 		
-			# iterate through write commands looking for tone writes and recalculate their frequencies
-			## first create a reference copy of the command list (just for a tuning hack below)
-			#command_list_copy = list(self.command_list)
-			
-			for n in range(len(self.command_list)):
-				command = self.command_list[n]["command"]
-				
-				# track time offset for debug purposes
-				data = self.command_list[n]["data"]
-				if b'\x70' <= command <= b'\x7f':	
-					pdata = binascii.hexlify(command)
-					t = int(pdata, 16)
-					t &= 15
-					t += 1
-					vgm_time += t
-					scommand = "WAITn"
-					#if self.VERBOSE: print " WAITN=" + str(t)
+		# commands are buffered so that they can be updated
+		# buffer[0] is command number 'base', and commands before 'flushed' have been output
+		source = iter(commands)
+		buffer = []
+		base = 0
+		flushed = 0
+		next_flush = 1024
+		lookahead = self.lookahead or sys.maxsize
+
+		# make sure command number 'index' is in the buffer, returns False if there are no more commands
+		# commands are read in small batches, to keep the overhead down
+		# every command fetched is also added to the pairing index, which has the offset from each tone LATCH write 
+		# to the DATA write that belongs to it (the next write command, if it's a DATA write), or 0 if there isn't one.
+		# it is kept alongside the buffer, so commands inserted into the buffer are inserted into it too
+		pairs = []
+		pending_latch = [-1] # the last tone LATCH write that hasn't been followed by a write command yet
+		def fetch(index):
+			while index - base >= len(buffer):
+				length = len(buffer)
+				buffer.extend(islice(source, 256))
+				if len(buffer) == length:
+					return False
+				pairs.extend([0] * (len(buffer) - length))
+				for i in range(length, len(buffer)):
+					item = buffer[i]
+					if item[0] == 0x50:
+						latch = pending_latch[0]
+						if latch >= 0 and (item[1] & 128) == 0 and base + i - latch <= lookahead:
+							pairs[latch - base] = base + i - latch
+						pending_latch[0] = base + i if (item[1] & (128+16)) == 128 else -1
+			return True
+
+		# returns the number of the DATA write that belongs to the tone LATCH write with number 'index', or -1
+		# if there isn't one, looking no more than 'lookahead' commands ahead
+		def get_data_write(index):
+			while pending_latch[0] == index and base + len(buffer) <= index + lookahead and fetch(base + len(buffer)):
+				pass
+			offset = pairs[index - base]
+			if offset == 0:
+				return -1
+			return index + offset
+
+		# update the data of command number 'index'
+		def set_data(index, data):
+			command, old_data, time = buffer[index - base]
+			buffer[index - base] = (command, data, time)
+
+		seeding = True
+
+		n = 0
+		while n - base < len(buffer) or fetch(n):
+			# fetch the next command, the time is tracked for debug purposes (and to find the end of the seed of a chunk)
+			command, qw, vgm_time = buffer[n - base]
+
+			# the volumes can differ from the register state, since channel 2 may have been muted,
+			# so at the start of a chunk carry on from the volumes of the chunk before if they are known
+			if seeding and vgm_time >= self.seed_time:
+				seeding = False
+				if self.seed_volumes != None:
+					latched_volumes[:] = self.seed_volumes
 				else:
-					pcommand = binascii.hexlify(command)
-				
-					if pcommand == "61":
-						scommand = "WAIT"
-						pdata = binascii.hexlify(data)
-						t = int(pdata, 16)
-						# sdm: swap bytes to LSB
-						lsb = t & 255
-						msb = (t / 256)
-						t = (lsb * 256) + msb
-						vgm_time += t		
-						#if self.VERBOSE: print " WAIT=" + str(t)
-					else:			
-						if pcommand == "62":	#wait60
-							vgm_time += 735
-						else:
-							if pcommand == "63":	#wait50
-								vgm_time += 882								
+					self.seed_volumes = list(latched_volumes)
+			
+			if TEST_OUTPUT:
+				print >>self.log, "TEST: vgm frame (1/60ths) = " + str( (vgm_time/735) )
+			
+			# only process write data commands
+			if command == 0x50:
 				
-				if TEST_OUTPUT:
-					print "TEST: vgm frame (1/60ths) = " + str( (vgm_time/735) )
+				# Check if LATCH/DATA write 								
+				if qw & 128:
 				
-				# only process write data commands
-				if command == struct.pack('B', 0x50):
-					qdata = self.command_list[n]["data"]
-					
-					# Check if LATCH/DATA write 								
-					qw = int(binascii.hexlify(qdata), 16)
-					if qw & 128:
+					# low tone values (min 0x001) generate high frequency 
+					# high tone values (max 0x3ff) generate low frequency 
 					
-						# low tone values (min 0x001) generate high frequency 
-						# high tone values (max 0x3ff) generate low frequency 
-						
-						# Get channel id and latch it
-						latched_channel = (qw>>5)&3
-							
-						# Check if TONE or VOLUME update				
-						if (qw & 16) != 0:
-							# track volumes so we can apply the periodic noise retune if necessary
-							
-							# hack to force channel 2 volume high (so we can test periodic noise channel tuning)
-							#if latched_channel == 2:
-							#	qw = qw & 0xf0
-							#	quantized_command_list[n]["data"] = struct.pack('B', qw)
-
-							#------------------------------------------------------------------------------------------------------------
-							# extra test for scenarios where channel 2 and channel 3 volumes are audible together during tuned PN
-							#  AND we are targetting an SN76489 chip with 15 bit duty cycle (SR) because these are not harmonious
-							# Explanation:
-							#  On some SN76489 chips the periodic noise cycle is 16 bits and on some it is 15 bits.
-							#  SN tone generators output continuous squarewaves at the given frequency, whereas the periodic noise generator
-							#  emits a squarewave at the given frequency on channel 2 *every duty cycle* - 
-							#  which is either every 1/16 clocks or every 1/15 clocks (depending on chip config)
-							#  At 1/16, the output frequency is in harmony with channel 2. So 440Hz on tone2 
-							#   will be 27.5Hz on PN channel3 (exactly 4 octaves lower). 
-							#  With the BBC, 440Hz on tone2 will deliver 29.33Hz on PN channel3 (*almost* 4 octaves lower - but out of tune).
-							#
-							# So some tunes are able to play all 4 channels with channel 3 in tuned PN mode, in harmony.
-							# Such tunes are not compatible with SN chip variants with 15-bit LFSR registers. 
-							#
-							# Our coping strategy here is to detect and prioritize any currently playing tuned periodic noise, and ignore
-							#  any volume changes on channel 2.
-							# We could attempt to stop the PN from playing if we detect volume changes on channel 2, but that would lead
-							#  to much more complexity in how the registers are updated.
-							#
-							# remember that on SN chip, volume 15 is silent, and 0 is full
-
-							# UPDATE: there is an issue with this approach. If channel 2 keys on with a volume setting BEFORE channel 3
-							# has keyed off a previously playing tuned periodic noise, it will mistakenly think this is a quad tone.
-
-
-
-							new_volume = qw & 15
-							if TEST_OUTPUT:
-								print "TEST: channel " + str(latched_channel) + " volume set to " + str(new_volume)
-
-							# True/False to enable detection & correction of "quad tones"
-							if True:
-								if latched_channel == 2:
-									if new_volume != 15:
-										if latched_volumes[3] != 15:
-											if (latched_tone_frequencies[3]) & 3 == 3:
-												print "WARNING: Volume non zero on channel 2 when channel 3 is playing periodic noise, analysing..."
-												
-												# ok, to make doubly sure we arent muting channel 2 unnecessarily, look ahead
-												# to see if any other volume writes (to set volume 0) on channel 3 are incoming for this time slot
-												volume_channel3_will_be_zeroed = False
-												nindex = n
-												while (nindex < (len(self.command_list)-1)):# check we dont overflow the array, bail if we do, since it means we didn't find any further DATA writes.
-													nindex += 1
-
-													ncommand = self.command_list[nindex]["command"]
-													# interpret any non-VGM-write commands to mean end of time slot
-													if ncommand != struct.pack('B', 0x50):
-														if TEST_OUTPUT:
-															print " INFO: end of time slot (command " + str(binascii.hexlify(ncommand)) + ")"
-														break
-													else:
-														if TEST_OUTPUT:
-															print " INFO: found command in same time slot"
-														# found the next VGM write command
-														ndata = self.command_list[nindex]["data"]
-
-														# Check if next this is a DATA write, and check if a channel 3 volume
-														nw = int(binascii.hexlify(ndata), 16)
-														if (nw & 128):	# check for data
+					# Get channel id and latch it
+					latched_channel = (qw>>5)&3
 						
-															# Check incoming channel id and if volume command 
-															incoming_channel_id = (nw>>5)&3
-															if TEST_OUTPUT:
-																print "  INFO: is a data command on channel " + str(incoming_channel_id)
-															if (incoming_channel_id == 3) and (nw & 16) != 0:	
-																if TEST_OUTPUT:
-																	print "  INFO: is a volume setting of " + str(nw & 15)
-																
-																# Yes, it's a volume command on channel 3
-																if (nw & 15) == 15:	# silent
-																	print " INFO: detected incoming volume off on channel 3, overrides correction"
-																	volume_channel3_will_be_zeroed = True
-																	break	
-
-												# so only mute channel 2 if we know channel 3 isnt going to be set to volume 15 this frame
-												if not volume_channel3_will_be_zeroed:
-													print " INFO: corrected volume, channel 2 was auto-muted due to active channel 3 periodic noise"
-													new_volume = 15
-
-													lo_data = (qw & 0b11110000) | (new_volume & 0b00001111)
-													self.command_list[n]["data"] = struct.pack('B', lo_data)
-								
-							latched_volumes[latched_channel] = new_volume		
-						else:
+					# Check if TONE or VOLUME update				
+					if (qw & 16) != 0:
+						# track volumes so we can apply the periodic noise retune if necessary
 						
-							# save the index of this tone write if it's channel 2 (used below)
-							# since that might be influencing the frequency on channel 3
+						# hack to force channel 2 volume high (so we can test periodic noise channel tuning)
+						#if latched_channel == 2:
+						#	qw = qw & 0xf0
+						#	command_data[n] = qw
+
+						#------------------------------------------------------------------------------------------------------------
+						# extra test for scenarios where channel 2 and channel 3 volumes are audible together during tuned PN
+						#  AND we are targetting an SN76489 chip with 15 bit duty cycle (SR) because these are not harmonious
+						# Explanation:
+						#  On some SN76489 chips the periodic noise cycle is 16 bits and on some it is 15 bits.
+						#  SN tone generators output continuous squarewaves at the given frequency, whereas the periodic noise generator
+						#  emits a squarewave at the given frequency on channel 2 *every duty cycle* - 
+						#  which is either every 1/16 clocks or every 1/15 clocks (depending on chip config)
+						#  At 1/16, the output frequency is in harmony with channel 2. So 440Hz on tone2 
+						#   will be 27.5Hz on PN channel3 (exactly 4 octaves lower). 
+						#  With the BBC, 440Hz on tone2 will deliver 29.33Hz on PN channel3 (*almost* 4 octaves lower - but out of tune).
+						#
+						# So some tunes are able to play all 4 channels with channel 3 in tuned PN mode, in harmony.
+						# Such tunes are not compatible with SN chip variants with 15-bit LFSR registers. 
+						#
+						# Our coping strategy here is to detect and prioritize any currently playing tuned periodic noise, and ignore
+						#  any volume changes on channel 2.
+						# We could attempt to stop the PN from playing if we detect volume changes on channel 2, but that would lead
+						#  to much more complexity in how the registers are updated.
+						#
+						# remember that on SN chip, volume 15 is silent, and 0 is full
+
+						# UPDATE: there is an issue with this approach. If channel 2 keys on with a volume setting BEFORE channel 3
+						# has keyed off a previously playing tuned periodic noise, it will mistakenly think this is a quad tone.
+
+
+
+						new_volume = qw & 15
+						if TEST_OUTPUT:
+							print >>self.log, "TEST: channel " + str(latched_channel) + " volume set to " + str(new_volume)
+
+						# True/False to enable detection & correction of "quad tones"
+						if True:
 							if latched_channel == 2:
-								tone2_offsets[0] = n
-								tone2_offsets[1] = -1
-								
-							# get low 4 bits and merge with latched channel's frequency register
-							qfreq = (qw & 0b00001111)
-							latched_tone_frequencies[latched_channel] = (latched_tone_frequencies[latched_channel] & 0b1111110000) | qfreq
-							
-							if TEST_OUTPUT:
-								print "TEST: channel " + str(latched_channel) + " pitch set to " + str(qfreq)
-
-							# check for non-tuned periodic noise (might sound out of tune when converted, because clock speed drives this)
-							# bit 2 of frequency on noise channel =0 for PN, or =1 for white noise
-							if latched_channel == 3 and (latched_tone_frequencies[3] < 3):
-								print "WARNING: Non-tuned periodic noise detected, may not sound in tune due to different clock speed."
+								if new_volume != 15:
+									if latched_volumes[3] != 15:
+										if (latched_tone_frequencies[3]) & 3 == 3:
+											warn("WARNING: Volume non zero on channel 2 when channel 3 is playing periodic noise")
+											
+											# ok, to make doubly sure we arent muting channel 2 unnecessarily, look ahead
+											# to see if any other volume writes (to set volume 0) on channel 3 are incoming for this time slot
+											volume_channel3_will_be_zeroed = False
+											nindex = n
+											while nindex - n < lookahead and fetch(nindex + 1):# bail if there are no more commands, since it means we didn't find any further writes.
+												nindex += 1
+
+												ncommand = buffer[nindex - base][0]
+												# interpret any non-VGM-write commands to mean end of time slot
+												if ncommand != 0x50:
+													if TEST_OUTPUT:
+														print >>self.log, " INFO: end of time slot (command " + format(ncommand, '02x') + ")"
+													break
+												else:
+													if TEST_OUTPUT:
+														print >>self.log, " INFO: found command in same time slot"
+													# found the next VGM write command
+													# Check if next this is a DATA write, and check if a channel 3 volume
+													nw = buffer[nindex - base][1]
+													if (nw & 128):	# check for data
+					
+														# Check incoming channel id and if volume command 
+														incoming_channel_id = (nw>>5)&3
+														if TEST_OUTPUT:
+															print >>self.log, "  INFO: is a data command on channel " + str(incoming_channel_id)
+														if (incoming_channel_id == 3) and (nw & 16) != 0:	
+															if TEST_OUTPUT:
+																print >>self.log, "  INFO: is a volume setting of " + str(nw & 15)
+															
+															# Yes, it's a volume command on channel 3
+															if (nw & 15) == 15:	# silent
+																warn("INFO: detected incoming volume off on channel 3, overrides correction")
+																volume_channel3_will_be_zeroed = True
+																break	
+
+											# so only mute channel 2 if we know channel 3 isnt going to be set to volume 15 this frame
+											if not volume_channel3_will_be_zeroed:
+												warn("INFO: corrected volume, channel 2 was auto-muted due to active channel 3 periodic noise")
+												new_volume = 15
+
+												lo_data = (qw & 0b11110000) | (new_volume & 0b00001111)
+												set_data(n, lo_data)
 							
-							# sanity check - detect if ratio of DATA writes is 1:1 with LATCH writes
-							if False:
-								nindex = n
-								dcount = 0
-								while (nindex < (len(self.command_list)-1)):# check we dont overflow the array, bail if we do, since it means we didn't find any further DATA writes.
-									nindex += 1
-
-									ncommand = self.command_list[nindex]["command"]
-									# skip any non-VGM-write commands
-									if ncommand != struct.pack('B', 0x50):
-										continue
-									else:
-										# found the next VGM write command
-										ndata = self.command_list[nindex]["data"]
-
-										# Check if next this is a DATA write, and capture frequency if so
-										# otherwise, its a LATCH/DATA write, so no additional frequency to process
-										nw = int(binascii.hexlify(ndata), 16)
-										if (nw & 128) == 0:
-											dcount += 1
-										else:
-											#if dcount > 1:
-											print "WARNING: DCOUNT=" + str(dcount) #DANGER WILL ROBINSON"
-											break
-								
-							# look ahead, and see if the next command is a DATA write as if so, this will be part of the same tone commmand
-							# so load this into our register as well so that we have the correct tone frequency to work with
+						latched_volumes[latched_channel] = new_volume		
+					else:
+					
+						# save the index of this tone write if it's channel 2 (used below)
+						# since that might be influencing the frequency on channel 3
+						if latched_channel == 2:
+							tone2_offsets[0] = n
+							tone2_offsets[1] = -1
 							
-							multi_write = False
+						# get low 4 bits and merge with latched channel's frequency register
+						qfreq = (qw & 0b00001111)
+						latched_tone_frequencies[latched_channel] = (latched_tone_frequencies[latched_channel] & 0b1111110000) | qfreq
+						
+						if TEST_OUTPUT:
+							print >>self.log, "TEST: channel " + str(latched_channel) + " pitch set to " + str(qfreq)
+
+						# check for non-tuned periodic noise (might sound out of tune when converted, because clock speed drives this)
+						# bit 2 of frequency on noise channel =0 for PN, or =1 for white noise
+						if latched_channel == 3 and (latched_tone_frequencies[3] < 3):
+							warn("WARNING: Non-tuned periodic noise detected, may not sound in tune due to different clock speed.")
+						
+						# sanity check - detect if ratio of DATA writes is 1:1 with LATCH writes
+						if False:
 							nindex = n
-							while (nindex < (len(self.command_list)-1)):# check we dont overflow the array, bail if we do, since it means we didn't find any further DATA writes.
+							dcount = 0
+							while fetch(nindex + 1):# bail if there are no more commands, since it means we didn't find any further DATA writes.
 								nindex += 1
 
-								ncommand = self.command_list[nindex]["command"]
 								# skip any non-VGM-write commands
-								if ncommand != struct.pack('B', 0x50):
+								if buffer[nindex - base][0] != 0x50:
 									continue
 								else:
 									# found the next VGM write command
-									ndata = self.command_list[nindex]["data"]
-
 									# Check if next this is a DATA write, and capture frequency if so
 									# otherwise, its a LATCH/DATA write, so no additional frequency to process
-									nw = int(binascii.hexlify(ndata), 16)
+									nw = buffer[nindex - base][1]
 									if (nw & 128) == 0:
-										multi_write = True
-										nfreq = (nw & 0b00111111)
-										latched_tone_frequencies[latched_channel] = (latched_tone_frequencies[latched_channel] & 0b0000001111) | (nfreq << 4)	
-
-										# cache offset of the last tone2 channel write
-										if latched_channel == 2:
-											tone2_offsets[1] = nindex										
-									break
+										dcount += 1
+									else:
+										#if dcount > 1:
+										print >>self.log, "WARNING: DCOUNT=" + str(dcount) #DANGER WILL ROBINSON"
+										break
 							
+						# see if this is followed by a DATA write, as if so, this will be part of the same tone commmand
+						# so load this into our register as well so that we have the correct tone frequency to work with
+						
+						multi_write = False
+						nindex = get_data_write(n)
+						if nindex >= 0:
+							multi_write = True
+							nw = buffer[nindex - base][1]
+							nfreq = (nw & 0b00111111)
+							latched_tone_frequencies[latched_channel] = (latched_tone_frequencies[latched_channel] & 0b0000001111) | (nfreq << 4)	
+
+							# cache offset of the last tone2 channel write
+							if latched_channel == 2:
+								tone2_offsets[1] = nindex										
 
-								
-							
-							# calculate the correct retuned frequncy for this channel						
-
-							# leave channel 3 (noise channel) alone mostly.. it's not a frequency, unless its a tuned white/periodic noise
-							if latched_channel == 3:
-								new_freq = latched_tone_frequencies[latched_channel]	
-
-								# if we're starting a tuned periodic or white noise, we may need to do further adjustments
-								# We check if volume on channel 2 is 15 (zero volume) because that indicates
-								# a tuned noise effect
-								# this is detected by bit0 and bit1 being set (bit2 being white(1) or periodic noise(0))
-								if True:
-									if (new_freq & 3 == 3) and latched_volumes[2] == 15:
-										
-										if tone2_offsets[0] < 0:
-											# Likely cause of this is that the tuned PN is started, and the pitch is set on channel2 afterwards
-											print "WARNING: Unexpected scenario - tone2 offset is not set"
-										else:
+						# calculate the correct retuned frequncy for this channel						
 
-											#print "POTENTIAL RETUNE REQUIRED"
-											# ok we've detected a tuned noise on ch3, which is slightly more involved to correct. 
-											# some tunes setup ch2 tone THEN ch2 vol THEN start the periodic noise, so we have to detect this case.
-											# we record the index in the command stream of when tone on ch2 was last set
-											# then we refer backwards to find the last ch2 tone write & correct it
-											# the current latched_tone_frequency is captured though, so transpose that as usual
-											f = recalc_frequency(latched_tone_frequencies[2], True)
-																
-											# now write back to the previous channel 2 tone command(s) with the newly corrected frequency
-											zdata = self.command_list[tone2_offsets[0]]["data"]
-											zw = int(binascii.hexlify(zdata), 16)
-											lo_data = (zw & 0b11110000) | (f & 0b00001111)
-											
+						# leave channel 3 (noise channel) alone mostly.. it's not a frequency, unless its a tuned white/periodic noise
+						if latched_channel == 3:
+							new_freq = latched_tone_frequencies[latched_channel]	
 
-											self.command_list[tone2_offsets[0]]["data"] = struct.pack('B', lo_data)
-											
-											# if this was part of a multi-write command (eg. one LATCH/DATA followed by one DATA write)
-											# update the second command too, with the correct frequency
-											if tone2_offsets[1] >= 0:
-												hi_data = (f>>4) & 0b00111111
-												self.command_list[tone2_offsets[1]]["data"] = struct.pack('B', hi_data)		
-												tone2_offsets[1] = -1 # reset offset
-									
+							# if we're starting a tuned periodic or white noise, we may need to do further adjustments
+							# We check if volume on channel 2 is 15 (zero volume) because that indicates
+							# a tuned noise effect
+							# this is detected by bit0 and bit1 being set (bit2 being white(1) or periodic noise(0))
+							if True:
+								if (new_freq & 3 == 3) and latched_volumes[2] == 15:
 									
+									if tone2_offsets[0] < 0:
+										# Likely cause of this is that the tuned PN is started, and the pitch is set on channel2 afterwards
+										warn("WARNING: Unexpected scenario - tone2 offset is not set")
+									else:
+
+										#print "POTENTIAL RETUNE REQUIRED"
+										# ok we've detected a tuned noise on ch3, which is slightly more involved to correct. 
+										# some tunes setup ch2 tone THEN ch2 vol THEN start the periodic noise, so we have to detect this case.
+										# we record the index in the command stream of when tone on ch2 was last set
+										# then we refer backwards to find the last ch2 tone write & correct it
+										# the current latched_tone_frequency is captured though, so transpose that as usual
+										f = recalc_frequency(latched_tone_frequencies[2], True)
+
+										# in streaming mode the channel 2 tone write may have been output already,
+										# in which case we write the corrected tone again just before this command
+										if tone2_offsets[0] < flushed:
+											buffer[n - base:n - base] = [(0x50, 0xc0 | (f & 0b00001111), vgm_time), (0x50, (f>>4) & 0b00111111, vgm_time)]
+											pairs[n - base:n - base] = [1, 0]
+											if pending_latch[0] >= n:
+												pending_latch[0] += 2
+											tone2_offsets[0] = n
+											tone2_offsets[1] = n + 1
+											n += 2
+											if nindex >= 0:
+												nindex += 2
+															
+										# now write back to the previous channel 2 tone command(s) with the newly corrected frequency
+										zw = buffer[tone2_offsets[0] - base][1]
+										lo_data = (zw & 0b11110000) | (f & 0b00001111)
+										
+
+										set_data(tone2_offsets[0], lo_data)
 
-							else:					
-								# to use the periodic noise effect as a bass line, it uses the tone on channel 2 to drive PN frequency on channel 3
-								# when the clock is different, the PN is different, so we have to apply a further correction
-								# typically tracks that use this effect will disable the volume of channel 2
-								# we detect this case and detune channel 2 tone by a further amount to correct for this
-								is_periodic_noise_tone = self.RETUNE_PERIODIC == True and latched_channel == 2 and latched_volumes[2] == 15 and (latched_tone_frequencies[3] & 3 == 3)
+										# a tone write that only seeds the state at the start of a chunk is not output, 
+										# so the tone write it stands for is corrected in the chunk before
+										if not seeding and buffer[tone2_offsets[0] - base][2] < self.seed_time:
+											self.seed_tone2 = f
+										
+										# if this was part of a multi-write command (eg. one LATCH/DATA followed by one DATA write)
+										# update the second command too, with the correct frequency
+										if tone2_offsets[1] >= 0:
+											hi_data = (f>>4) & 0b00111111
+											set_data(tone2_offsets[1], hi_data)
+											tone2_offsets[1] = -1 # reset offset
+								
 								
-								#if latched_channel == 2 and latched_volumes[2] != 15 and (latched_tone_frequencies[3] & 3 == 3):
-								#	print "Found non-muted channel 2 with tuned channel 3 periodic noise "
 
-								new_freq = recalc_frequency(latched_tone_frequencies[latched_channel], is_periodic_noise_tone)
+						else:					
+							# to use the periodic noise effect as a bass line, it uses the tone on channel 2 to drive PN frequency on channel 3
+							# when the clock is different, the PN is different, so we have to apply a further correction
+							# typically tracks that use this effect will disable the volume of channel 2
+							# we detect this case and detune channel 2 tone by a further amount to correct for this
+							is_periodic_noise_tone = self.RETUNE_PERIODIC == True and latched_channel == 2 and latched_volumes[2] == 15 and (latched_tone_frequencies[3] & 3 == 3)
 							
-							# write back the command(s) with the correct frequency
-							lo_data = (qw & 0b11110000) | (new_freq & 0b00001111)
-							self.command_list[n]["data"] = struct.pack('B', lo_data)
-							
-							# if this was part of a multi-write command (eg. one LATCH/DATA followed by one DATA write)
-							# update the second command too, with the correct frequency
-							hi_data = -1
-							if multi_write == True:
-								hi_data = (new_freq>>4) & 0b00111111
-								self.command_list[nindex]["data"] = struct.pack('B', hi_data)	
-							else:
-								if self.VERBOSE: print "SINGLE REGISTER TONE WRITE on CHANNEL " + str(latched_channel)
+							#if latched_channel == 2 and latched_volumes[2] != 15 and (latched_tone_frequencies[3] & 3 == 3):
+							#	print "Found non-muted channel 2 with tuned channel 3 periodic noise "
+
+							new_freq = recalc_frequency(latched_tone_frequencies[latched_channel], is_periodic_noise_tone)
+						
+						# write back the command(s) with the correct frequency
+						lo_data = (qw & 0b11110000) | (new_freq & 0b00001111)
+						set_data(n, lo_data)
+						
+						# if this was part of a multi-write command (eg. one LATCH/DATA followed by one DATA write)
+						# update the second command too, with the correct frequency
+						hi_data = -1
+						if multi_write == True:
+							hi_data = (new_freq>>4) & 0b00111111
+							set_data(nindex, hi_data)
+						else:
+							if self.VERBOSE: print >>self.log, "SINGLE REGISTER TONE WRITE on CHANNEL " + str(latched_channel)
+
+						if self.VERBOSE: print >>self.log, "new_freq=0x" + format(new_freq, 'x') + ", lo_data=0x" + format(lo_data, '02x') + ", hi_data=0x" + format(hi_data, '02x')
+						if self.VERBOSE: print >>self.log, ""
+
+			n += 1
+
+			# every so often, output the commands that can no longer change, which is everything before this one, 
+			# apart from the last channel 2 tone write onwards (in case it needs retuning), unless we have held that back too long
+			if n >= next_flush:
+				next_flush = n + 1024
+				flush_to = n
+				if 0 <= tone2_offsets[0] < n:
+					flush_to = max(tone2_offsets[0], n - lookahead)
+				if flush_to > flushed:
+					for item in buffer[flushed - base:flush_to - base]:
+						yield item
+					flushed = flush_to
+					del buffer[:flushed - base]
+					del pairs[:flushed - base]
+					base = flushed
+
+		# output whatever is left
+		for item in buffer[flushed - base:]:
+			yield item
+
+		self.end_volumes = list(latched_volumes)
+		self.diagnostics.report(self.log)
+		
+	# vectorised version of transpose_stage(), which is used if NumPy is installed (and USE_NUMPY is set), giving the same output.
+	# the register writes are decoded into arrays of the channel, tone register values, volumes and tuned noise state at each write, 
+	# the tones are retuned with lookups in the retune tables, and the new values are written back to the command list.
+	# streams, and verbose output, are left to transpose_stage()
+	# returns True if the commands were transposed
+	def transpose_numpy(self):
+		if numpy is None or not self.USE_NUMPY or self.command_list is None or self.VERBOSE:
+			return False
+
+		command_list = self.command_list
+		commands = numpy.frombuffer(command_list.commands, dtype = numpy.uint8)
+		command_data = numpy.frombuffer(command_list.data, dtype = 'u' + str(command_list.data.itemsize))
+		times = numpy.frombuffer(command_list.times, dtype = 'u' + str(command_list.times.itemsize))
+
+		# the register writes, and the time slot of each (the number of other commands before it)
+		write_index = numpy.flatnonzero(commands == 0x50)
+		writes = command_data[write_index].astype(numpy.int32)
+		num_writes = len(writes)
+		positions = numpy.arange(num_writes)
+		slots = numpy.append(write_index - positions, -1)
+		channels = (writes >> 5) & 3
+		is_tone = (writes & (128+16)) == 128
+		is_volume = (writes & (128+16)) == (128+16)
+
+		# at the start of a chunk, the volumes can be set to seed_volumes (see transpose_stage())
+		seed_command = numpy.searchsorted(times, self.seed_time)
+		seeded = seed_command < len(commands)
+		seed_position = numpy.searchsorted(write_index, seed_command)
+		seeding = positions < seed_position if seeded else numpy.ones(num_writes, dtype = bool)
+
+		# returns the value of the last of the writes in mask before each write, and at the end, or initial if there isn't one
+		def last_before(mask, values, initial):
+			last = numpy.maximum.accumulate(numpy.where(mask, positions, -1)) if num_writes > 0 else positions
+			return numpy.append(initial, numpy.where(last >= 0, values[numpy.maximum(last, 0)], initial))
+
+		# returns the volumes of the channel before each write, and at the end, given the volume each volume write sets
+		def volumes_before(channel, values):
+			mask = is_volume & (channels == channel)
+			volumes = last_before(mask, values, 0)
+			if seeded and self.seed_volumes != None:
+				override = (numpy.arange(num_writes + 1) >= seed_position) & (last_before(mask, positions, -1) < seed_position)
+				volumes[override] = self.seed_volumes[channel]
+			return volumes
+
+		# the tone register values after each tone LATCH write and the DATA write that follows it (as the next write), 
+		# and before the DATA write
+		next_writes = numpy.append(writes[1:], 128)
+		paired = is_tone & ((next_writes & 128) == 0)
+		hi = next_writes & 0b00111111
+		lo = writes & 0b00001111
+		values = numpy.zeros(num_writes, dtype = numpy.int32)
+		latch_values = numpy.zeros(num_writes, dtype = numpy.int32)
+		for channel in range(4):
+			mask = is_tone & (channels == channel)
+			previous_hi = last_before(mask & paired, hi, 0)[:-1]
+			values = numpy.where(mask, lo | (numpy.where(paired, hi, previous_hi) << 4), values)
+			latch_values = numpy.where(mask, lo | (previous_hi << 4), latch_values)
+
+		# whether channel 3 is set to tuned noise before each write
+		tuned = last_before(is_tone & (channels == 3), (lo & 3) == 3, False)[:-1]
+
+		# channel 2 volume writes while channel 3 is playing tuned periodic noise, which are muted,
+		# unless channel 3 is silenced later in the same time slot
+		volumes3 = volumes_before(3, lo)
+		quad_tones = is_volume & (channels == 2) & (lo != 15) & (volumes3[:-1] != 15) & tuned
+		silences = numpy.where(writes == 0xff, positions, num_writes)
+		if num_writes > 0:
+			silences = numpy.minimum.accumulate(silences[::-1])[::-1]
+		next_silence = numpy.append(silences[1:], num_writes)
+		silenced = slots[next_silence] == slots[:-1]
+		muted = quad_tones & ~silenced
+		volumes2 = volumes_before(2, numpy.where(muted, 15, lo))
+
+		# retune the tones, channel 2 tones that drive tuned noise on channel 3 (with channel 2 muted) are retuned as periodic noise
+		table = self.get_retune_table(False)
+		periodic_table = self.get_retune_table(True)
+		retuned, hz_errors = numpy.array(table).T
+		periodic_retuned, periodic_hz_errors = numpy.array(periodic_table).T
+		retuned = retuned.astype(numpy.int32)
+		periodic_retuned = periodic_retuned.astype(numpy.int32)
+
+		periodic = is_tone & (channels == 2) & (volumes2[:-1] == 15) & tuned & self.RETUNE_PERIODIC
+		new_values = numpy.where(periodic, periodic_retuned[values], retuned[values])
+		new_values = numpy.where(channels == 3, values, new_values)
+		large_errors = is_tone & (channels != 3) & (numpy.abs(numpy.where(periodic, periodic_hz_errors[values], hz_errors[values])) > 2.0)
+
+		# starting tuned noise on channel 3 while channel 2 is muted retunes the last channel 2 tone write as periodic noise
+		tone2 = last_before(is_tone & (channels == 2), positions, -1)[:-1]
+		tuned_noise = is_tone & (channels == 3) & ((values & 3) == 3) & (volumes2[:-1] == 15)
+		retuned_tone2 = tone2[tuned_noise & (tone2 >= 0)]
+		new_values[retuned_tone2] = periodic_retuned[values[retuned_tone2]]
+
+		# a channel 2 tone write in the seed of a chunk stands for one in the chunk before, which needs the retune too
+		seed_retunes = tone2[tuned_noise & (tone2 >= 0) & ~seeding]
+		seed_retunes = seed_retunes[times[write_index[seed_retunes]] < self.seed_time]
+		if len(seed_retunes) > 0:
+			self.seed_tone2 = int(periodic_retuned[values[seed_retunes[-1]]])
+
+		# warnings, in the same order as transpose_stage(), apart from those for the seed of a chunk
+		non_tuned_noise = is_tone & (channels == 3) & (latch_values < 3)
+		warnings = numpy.flatnonzero((quad_tones | non_tuned_noise | tuned_noise | large_errors) & ~seeding)
+		add = self.diagnostics.add
+		for n, time in zip(warnings, times[write_index[warnings]]):
+			channel = int(channels[n])
+			if quad_tones[n]:
+				add("WARNING: Volume non zero on channel 2 when channel 3 is playing periodic noise", channel, time)
+				if silenced[n]:
+					add("INFO: detected incoming volume off on channel 3, overrides correction", channel, time)
+				else:
+					add("INFO: corrected volume, channel 2 was auto-muted due to active channel 3 periodic noise", channel, time)
+			elif non_tuned_noise[n]:
+				add("WARNING: Non-tuned periodic noise detected, may not sound in tune due to different clock speed.", channel, time)
+			elif tuned_noise[n]:
+				if tone2[n] < 0:
+					add("WARNING: Unexpected scenario - tone2 offset is not set", channel, time)
+				else:
+					hz_err = periodic_table[values[tone2[n]]][1]
+					if hz_err > 2.0 or hz_err < -2.0:
+						add("WARNING: Large error transposing tone!", channel, time, str(hz_err) + " Hz, PN=True")
+			else:
+				hz_err = (periodic_table if periodic[n] else table)[values[n]][1]
+				add("WARNING: Large error transposing tone!", channel, time, str(hz_err) + " Hz, PN=" + str(bool(periodic[n])))
+
+		# write back the command(s) with the correct frequency and volume
+		new_writes = numpy.where(is_tone, (writes & 0b11110000) | (new_values & 0b00001111), writes)
+		new_writes = numpy.where(muted, writes | 15, new_writes)
+		pairs = numpy.flatnonzero(paired)
+		new_writes[pairs + 1] = (new_values[pairs] >> 4) & 0b00111111
+		new_data = command_data.copy()
+		new_data[write_index] = new_writes
+		command_list.data = array('I')
+		command_list.data.fromstring(new_data.tostring())
+
+		# the volumes that transpose_stage() would have at the start of the chunk and at the end
+		volumes = [volumes_before(channel, lo) for channel in (0, 1)] + [volumes2, volumes3]
+		if seeded and self.seed_volumes == None:
+			self.seed_volumes = [int(v[seed_position]) for v in volumes]
+		self.end_volumes = [int(v[-1]) for v in volumes]
+
+		self.diagnostics.report(self.log)
+		return True
 
-							if self.VERBOSE: print "new_freq=0x" + format(new_freq, 'x') + ", lo_data=0x" + format(lo_data, '02x') + ", hi_data=0x" + format(hi_data, '02x')
-							if self.VERBOSE: print ""
-		else:
-			print "transpose() - No transposing necessary as target clock matches source clock"
-			
 	#-------------------------------------------------------------------------------------------------
 	# iterate through the command list, removing any duplicate volume or tone writes
 	def optimize(self):
-		print "   VGM Processing : Optimizing VGM Stream "
+		print >>self.log, "   VGM Processing : Optimizing VGM Stream "
+		self.run_stage(self.optimize_stage)
 
-		# total number of commands in the vgm stream
-		num_commands = len(self.command_list)
+	# processing stage for optimize()
+	def optimize_stage(self, commands):
+
+		# total number of commands in the vgm stream, and in the output
+		num_commands = 0
+		num_output_commands = 0
 
 		latched_tone_frequencies = [-1, -1, -1, -1]
 		latched_volumes = [-1, -1, -1, -1]
 		latched_channel = 0		
 			
-		optimized_command_list = []
-
 		removed_volume_count = 0
 		removed_tone_count = 0
 		
@@ -1310,7 +2231,13 @@ class VgmStream:
 		
 		first_command = True
 		
-		for i in range(num_commands):
+		# commands are read one ahead, so we can see if a tone write is followed by a data write
+		source = iter(commands)
+		next_item = next(source, None)
+		while next_item is not None:
+			item = next_item
+			next_item = next(source, None)
+			num_commands += 1
 			
 			# check if previous command has detected a redundant tone data write
 			# and move along if so.
@@ -1319,17 +2246,13 @@ class VgmStream:
 				continue
 				
 			# fetch next command & associated data
-			command = self.command_list[i]["command"]
-			data = self.command_list[i]["data"]
+			command, w, time = item
 			
 			# process the command
 	
-			pcommand = binascii.hexlify(command)
 			# write command - add to optimized command list
-			if pcommand == "50":
+			if command == 0x50:
 
-				pdata = binascii.hexlify(data)
-				w = int(pdata, 16)	
 				
 				# capture current channel
 				last_latched_channel = latched_channel
@@ -1359,18 +2282,12 @@ class VgmStream:
 						tone_hi = latched_tone_frequencies[latched_channel] & 0b1111110000
 						
 						# look ahead to see if next command is a tone data write
-						if i < num_commands-1:
-						
-							# fetch next command & associated data
-							c = self.command_list[i+1]
-							
-							ncommand = c["command"]
-							ndata = c["data"]
+						if next_item is not None:
 						
 							# write command - add to optimized command list
-							if ncommand == struct.pack('B', 0x50):
+							if next_item[0] == 0x50:
 
-								nw = int(binascii.hexlify(ndata), 16)	
+								nw = next_item[1]
 								if nw & 128 == 0:
 									tone_hi = (nw & 0b0000111111) << 4
 									skip_next_data_write = True
@@ -1397,22 +2314,21 @@ class VgmStream:
 
 					
 				# add the latest command to the list
-				optimized_command_list.append( { 'command' : command, 'data' : data } )				
+				num_output_commands += 1
+				yield item
 			else:
 				# for all other commands, add to  optimized_command_list
-				optimized_command_list.append( { 'command' : command, 'data' : data } )		
-
+				num_output_commands += 1
+				yield item
 
-		print "- Removed " + str(removed_volume_count) + " duplicate volume commands"
-		print "- Removed " + str(removed_tone_count) + " duplicate tone commands"
-		print "- originally contained " + str(num_commands) + " commands, now contains " + str(len(optimized_command_list)) + " commands"
 
-		# replace internal command list with optimized command list
-		self.command_list = optimized_command_list
+		print >>self.log, "- Removed " + str(removed_volume_count) + " duplicate volume commands"
+		print >>self.log, "- Removed " + str(removed_tone_count) + " duplicate tone commands"
+		print >>self.log, "- originally contained " + str(num_commands) + " commands, now contains " + str(num_output_commands) + " commands"
 
 	#-------------------------------------------------------------------------------------------------
-	# given a subset command list, sort the commands so that volumes come before tones
-	# returns a new list object containing the sorted command list
+	# given a list of register write values (the data of a run of 0x50 commands), sort them so that volumes come before tones
+	# returns a new list object containing the sorted register writes
 	def sort_command_list(self, input_commands):
 		#return input_commands
 		
@@ -1422,26 +2338,13 @@ class VgmStream:
 		
 		
 		
-		for c in input_commands:
+		for w in input_commands:
 			
-			# fetch next command & associated data
-			command = c["command"]
-			data = c["data"]
-			
-			pcommand = binascii.hexlify(command)
-			# write command - add to optimized command list, removing any it replaces
-			if pcommand == "50":
-
-				pdata = binascii.hexlify(data)
-				w = int(pdata, 16)		
-				# Check if LATCH/DATA write enabled - since this is the start of a write command
-				if (w & (128+16)) == (128+16):
-					volume_list.append( c )
-				else:
-					tone_list.append( c )
-					
+			# Check if LATCH/DATA write enabled - since this is the start of a write command
+			if (w & (128+16)) == (128+16):
+				volume_list.append( w )
 			else:
-				print "ERROR - WAS NOT EXPECTING non register data in command list"
+				tone_list.append( w )
 		
 		
 		##### EXPERIMENTAL CODE TO SORT COMMANDS INTO CHANNEL ORDER ####
@@ -1454,36 +2357,24 @@ class VgmStream:
 
 			# sort volumes into channel order
 			for channel in range(0,4):
-				for c in volume_list:
-					# fetch next command & associated data
-					command = c["command"]
-					data = c["data"]
-					
-					if binascii.hexlify(command) == "50":
-						w = int(binascii.hexlify(data), 16)		
-						# already know its a volume command, so just check channel
-						if ((w >> 5) & 3) == channel:
-							volume_channel_list.append( c )
+				for w in volume_list:
+					# already know its a volume command, so just check channel
+					if ((w >> 5) & 3) == channel:
+						volume_channel_list.append( w )
 				
 			# sort tones into channel order
 			for channel in range(0,4):
 				next_tone_write = False
-				for c in tone_list:
-					# fetch next command & associated data
-					command = c["command"]
-					data = c["data"]
-					
-					if binascii.hexlify(command) == "50":
-						w = int(binascii.hexlify(data), 16)		
-						# already know its a tone command, so just check channel
-						if (w & 128):
-							if ((w >> 5) & 3) == channel:
-								tone_channel_list.append( c )	
-								next_tone_write = True
-						else:
-							if next_tone_write:
-								tone_channel_list.append( c )
-								next_tone_write = False
+				for w in tone_list:
+					# already know its a tone command, so just check channel
+					if (w & 128):
+						if ((w >> 5) & 3) == channel:
+							tone_channel_list.append( w )	
+							next_tone_write = True
+					else:
+						if next_tone_write:
+							tone_channel_list.append( w )
+							next_tone_write = False
 			
 			# replace original lists with sorted lists
 			volume_list = volume_channel_list
@@ -1505,33 +2396,35 @@ class VgmStream:
 	# this allows for better frequency correction - some tunes set tones before volumes which makes it tricky
 	# to detect tuned noise effects and compensate accordingly. Sorting register updates makes this more accurate.
 	def optimize2(self):
-		print "   VGM Processing : Optimizing VGM Packets "
+		print >>self.log, "   VGM Processing : Optimizing VGM Packets "
+		self.run_stage(self.optimize2_stage)
 
-		# total number of commands in the vgm stream
-		num_commands = len(self.command_list)	
+	# processing stage for optimize2()
+	def optimize2_stage(self, commands):
+
+		# total number of commands in the vgm stream, and in the output
+		num_commands = 0
+		num_output_commands = 0
 			
+		# register writes pending in the current time slot
 		optimized_command_list = []
-		output_command_list = []
 
 		redundant_count = 0
-		
-		for i in range(num_commands):
-			
-			# fetch next command & associated data
-			command = self.command_list[i]["command"]
-			data = self.command_list[i]["data"]
-			
-			# process the command
-			# writes get accumulated into time slots
 
+		# the number of the current command
+		i = -1
+		
+		for writes, item in vgm_time_slots(commands):
+			num_commands += len(writes)
 
-			pcommand = binascii.hexlify(command)
-			# write command - add to optimized command list, removing any it replaces
-			if pcommand == "50":
-
-				pdata = binascii.hexlify(data)
-				w = int(pdata, 16)		
-				
+			# any writes after the last command are dropped
+			if item is None:
+				break
+			
+			# process the writes of the time slot
+			# writes get accumulated, removing any they replace
+			for command, w, time in writes:
+				i += 1
 
 				if (len(optimized_command_list) > 0):					
 
@@ -1547,9 +2440,7 @@ class VgmStream:
 							# scan previous commands to see if same channel volume has been set
 							# if so, remove the previous one
 							temp_command_list = []
-							for c in optimized_command_list:
-								qdata = c["data"]
-								qw = int(binascii.hexlify(qdata), 16)
+							for qw in optimized_command_list:
 								redundant = False
 								
 								# Check if LATCH/DATA write enabled 
@@ -1565,9 +2456,9 @@ class VgmStream:
 								# we cant remove the item directly from optimized_command_list since we are iterating through it
 								# so we build a second optimized list
 								if (not redundant):
-									temp_command_list.append(c)								
+									temp_command_list.append(qw)
 								else:
-									if self.VERBOSE: print "Command#" + str(i) + " Removed redundant volume write"
+									if self.VERBOSE: print >>self.log, "Command#" + str(i) + " Removed redundant volume write"
 									
 							# replace command list with optimized command list
 							optimized_command_list = temp_command_list
@@ -1579,9 +2470,7 @@ class VgmStream:
 							# if so, remove the previous one
 							temp_command_list = []
 							redundant_tone_data = False	# set to true if 
-							for c in optimized_command_list:
-								qdata = c["data"]
-								qw = int(binascii.hexlify(qdata), 16)
+							for qw in optimized_command_list:
 
 								redundant = False
 								
@@ -1606,33 +2495,36 @@ class VgmStream:
 								# we cant remove the item directly from quantized_command_list since we are iterating through it
 								# so we build a second optimized list
 								if (not redundant):
-									temp_command_list.append(c)
+									temp_command_list.append(qw)
 								else:
 									redundant_count += 1
-									if self.VERBOSE: print "Command#" + str(i) + " Removed redundant tone write"
+									if self.VERBOSE: print >>self.log, "Command#" + str(i) + " Removed redundant tone write"
 									
 								# replace command list with optimized command list
 								optimized_command_list = temp_command_list							
 				
 				# add the latest command to the list
-				optimized_command_list.append( { 'command' : command, 'data' : data } )				
-			else:
-				# for all other commands, output any pending optimized_command_list
-				
-				# first, sort the optimized command list so that volumes are set before tones
-				optimized_command_list = self.sort_command_list(optimized_command_list)
-			
-					
-				# now output the optmized command list
-				output_command_list += optimized_command_list
-				optimized_command_list = []
-				output_command_list.append( { 'command' : command, 'data' : data } )	
+				optimized_command_list.append(w)
+
+			# the command that ends the time slot
+			num_commands += 1
+			i += 1
+			command, w, time = item
 
-		print "- Removed " + str(redundant_count) + " redundant commands"
-		print "- originally contained " + str(num_commands) + " commands, now contains " + str(len(output_command_list)) + " commands"
+			# first, sort the optimized command list so that volumes are set before tones
+			optimized_command_list = self.sort_command_list(optimized_command_list)
+		
+				
+			# now output the optmized command list
+			# (writes in a time slot all occur at the same time as the command that ends the slot)
+			for qw in optimized_command_list:
+				yield (0x50, qw, time)
+			num_output_commands += len(optimized_command_list) + 1
+			optimized_command_list = []
+			yield (command, w, time)
 
-		# replace internal command list with optimized command list
-		self.command_list = output_command_list
+		print >>self.log, "- Removed " + str(redundant_count) + " redundant commands"
+		print >>self.log, "- originally contained " + str(num_commands) + " commands, now contains " + str(num_output_commands) + " commands"
 
 
 		
@@ -1640,38 +2532,47 @@ class VgmStream:
 	
 	def quantize(self, play_rate):
 				
-		print "   VGM Processing : Quantizing VGM to " + str(play_rate) + " Hz"
+		print >>self.log, "   VGM Processing : Quantizing VGM to " + str(play_rate) + " Hz"
 
 		if self.VGM_FREQUENCY % play_rate != 0:
-			print " ERROR - Cannot quantize to a fractional interval, must be an integer factor of 44100"
+			print >>self.log, " ERROR - Cannot quantize to a fractional interval, must be an integer factor of 44100"
 			return
-		
-		# total number of commands in the vgm stream
-		num_commands = len(self.command_list)
+
+		self.run_stage(self.quantize_stage, play_rate)
+		self.metadata['rate'] = play_rate
+
+	# processing stage for quantize()
+	def quantize_stage(self, commands, play_rate):
+
+		# total number of commands in the vgm stream, and in the output
+		num_commands = 0
+		num_output_commands = 0
 
 		# total number of samples in the vgm stream
 		total_samples = int(self.metadata['total_samples'])
 
-		vgm_time = 0
 		playback_time = 0
 
+		# time of the next command in the output command list
+		output_time = 0
+
 		interval_time = self.VGM_FREQUENCY/play_rate	
 		
-		vgm_command_index = 0
+		# the next command in the vgm stream
+		source = iter(commands)
+		item = next(source, None)
 
 		unhandled_commands = 0
 
 		# first step is to quantize the command stream to the playback rate rather than the sample rate
 
-		output_command_list = []
-
 		# clip the output to the desired length if specified as non zero number of 'play_rate' frames
 		total_frames = self.LENGTH
 		if total_frames > 0:
-			print "Limiting total frames to " + str(total_frames)
-			print "original total_samples " + str(total_samples)
+			print >>self.log, "Limiting total frames to " + str(total_frames)
+			print >>self.log, "original total_samples " + str(total_samples)
 			total_samples = (self.VGM_FREQUENCY * total_frames)
-			print "new total_samples " + str(total_samples)
+			print >>self.log, "new total_samples " + str(total_samples)
 			self.metadata['total_samples'] = total_samples
 
 						
@@ -1682,60 +2583,31 @@ class VgmStream:
 			quantized_command_list = []
 			playback_time += interval_time
 			
-			# if playback time has caught up with vgm_time, process the commands
-			while vgm_time <= playback_time and vgm_command_index < len(self.command_list): 
+			# if playback time has caught up with the time of the next command, process the commands
+			while item is not None and item[2] <= playback_time: 
 			
 				# fetch next command & associated data
-				command = self.command_list[vgm_command_index]["command"]
-				data = self.command_list[vgm_command_index]["data"]
+				command = item[0]
 				
 				# process the command
 				# writes get accumulated in this time slot
-				# waits get accumulated to vgm_time
-				
-				if b'\x70' <= command <= b'\x7f':	
-					pdata = binascii.hexlify(command)
-					t = int(pdata, 16)
-					t &= 15
-					t += 1
-					vgm_time += t
-					scommand = "WAITn"
-					if self.VERBOSE: print "WAITN=" + str(t)
-				else:
-					pcommand = binascii.hexlify(command)
+				# waits are already accounted for by the command times
 				
-					if pcommand == "50":
-						# add the latest command to the list
-						quantized_command_list.append( { 'command' : command, 'data' : data } )
-					else:
-						if pcommand == "61":
-							scommand = "WAIT"
-							pdata = binascii.hexlify(data)
-							t = int(pdata, 16)
-							# sdm: swap bytes to LSB
-							lsb = t & 255
-							msb = (t / 256)
-							t = (lsb * 256) + msb
-							vgm_time += t		
-							if self.VERBOSE: print "WAIT=" + str(t)
-						else:			
-							if pcommand == "66":	#end
-								# send the end command
-								output_command_list.append( { 'command' : command, 'data' : data } )
-								# end
-							else:
-								if pcommand == "62":	#wait60
-									vgm_time += 735
-								else:
-									if pcommand == "63":	#wait50
-										vgm_time += 882								
-									else:
-										unhandled_commands += 1		
+				if command == 0x50:
+					# add the latest command to the list
+					quantized_command_list.append( item[1] )
+				elif command == 0x66:	#end
+					# send the end command
+					yield (command, 0, output_time)
+					num_output_commands += 1
+				elif VGM_COMMAND_WAIT_SAMPLES[command] == 0:
+					unhandled_commands += 1		
 				
-				if self.VERBOSE: print "vgm_time=" + str(vgm_time) + ", playback_time=" + str(playback_time) + ", vgm_command_index=" + str(vgm_command_index) + ", output_command_list=" + str(len(output_command_list)) + ", command=" + pcommand
-				vgm_command_index += 1
+				if self.VERBOSE: print >>self.log, "vgm_time=" + str(item[2]) + ", playback_time=" + str(playback_time) + ", vgm_command_index=" + str(num_commands) + ", output_command_list=" + str(num_output_commands) + ", command=" + format(command, '02x')
+				num_commands += 1
+				item = next(source, None)
 			
-			if self.VERBOSE: print "vgm_time has caught up with playback_time"
+			if self.VERBOSE: print >>self.log, "vgm_time has caught up with playback_time"
 			
 
 			
@@ -1746,61 +2618,78 @@ class VgmStream:
 			
 				# flush any pending wait commands before data writes, to optimize redundant wait commands
 
-				if self.VERBOSE: print "Flushing " + str(len(quantized_command_list)) + " commands, accumulated_time=" + str(accumulated_time)
+				if self.VERBOSE: print >>self.log, "Flushing " + str(len(quantized_command_list)) + " commands, accumulated_time=" + str(accumulated_time)
 				
-				# make sure we limit the max time delay to be the nearest value under 65535
-				# that is wholly divisible by the quantization interval
-				max_accumulated_time = 65535 / (self.VGM_FREQUENCY/play_rate)
-				max_accumulated_time = max_accumulated_time * (self.VGM_FREQUENCY/play_rate)
-				while (accumulated_time > 0):
-					
-					# ensure no wait commands exceed the 16-bit limit
-					t = accumulated_time
-					if (t > max_accumulated_time):
-						t = max_accumulated_time
-					
-					# optimization: if quantization time step is 1/50 or 1/60 of a second use the single byte wait
-					if t == 882: # 50Hz
-						if self.VERBOSE: print "Outputting WAIT50"
-						output_command_list.append( { 'command' : b'\x63', 'data' : None } )
-					else:
-						if t == 882*2: # 25Hz
-							if self.VERBOSE: print "Outputting 2x WAIT50 "
-							output_command_list.append( { 'command' : b'\x63', 'data' : None } )	
-							output_command_list.append( { 'command' : b'\x63', 'data' : None } )	
-						else:
-							if t == 735: # 60Hz
-								if self.VERBOSE: print "Outputting WAIT60"
-								output_command_list.append( { 'command' : b'\x62', 'data' : None } )	
-							else:
-								if t == 735*2: # 30Hz
-									if self.VERBOSE: print "Outputting WAIT60 x 2"
-									output_command_list.append( { 'command' : b'\x62', 'data' : None } )	
-									output_command_list.append( { 'command' : b'\x62', 'data' : None } )	
-								else:
-									if self.VERBOSE: print "Outputting WAIT " + str(t) + " (" + str(float(t)/float(interval_time)) + " intervals)"
-									# else emit the full 16-bit wait command (3 bytes)
-									output_command_list.append( { 'command' : b'\x61', 'data' : struct.pack('H', t) } )	
-
-					accumulated_time -= t
+				for wait in self.quantize_waits(accumulated_time, output_time, play_rate):
+					yield wait
+					num_output_commands += 1
+				output_time += accumulated_time
+				accumulated_time = 0
 						
 				# output pending commands
-				output_command_list += quantized_command_list
+				for w in quantized_command_list:
+					yield (0x50, w, output_time)
+				num_output_commands += len(quantized_command_list)
 
 
 			# accumulate time to next quantized time period
 			next_w = (self.VGM_FREQUENCY/play_rate)
 			accumulated_time += next_w
-			if self.VERBOSE: print "next_w=" + str(next_w)
+			if self.VERBOSE: print >>self.log, "next_w=" + str(next_w)
 
 
+		# anything left over is past the end of the output
+		if item is not None:
+			num_commands += 1
+			for item in source:
+				num_commands += 1
+
 		# report
-		print "Processed VGM stream, quantized to " + str(play_rate) + "Hz playback intervals" 
-		print "- originally contained " + str(num_commands) + " commands, now contains " + str(len(output_command_list)) + " commands"
+		print >>self.log, "Processed VGM stream, quantized to " + str(play_rate) + "Hz playback intervals" 
+		print >>self.log, "- originally contained " + str(num_commands) + " commands, now contains " + str(num_output_commands) + " commands"
 
-		self.command_list = output_command_list
-		num_commands = len(output_command_list)	
-		self.metadata['rate'] = play_rate
+	# yield the wait commands for accumulated_time samples (a whole number of quantize intervals) starting at output_time, 
+	# as (command, data, time) tuples
+	def quantize_waits(self, accumulated_time, output_time, play_rate):
+
+		interval_time = self.VGM_FREQUENCY/play_rate	
+
+		# make sure we limit the max time delay to be the nearest value under 65535
+		# that is wholly divisible by the quantization interval
+		max_accumulated_time = 65535 / (self.VGM_FREQUENCY/play_rate)
+		max_accumulated_time = max_accumulated_time * (self.VGM_FREQUENCY/play_rate)
+		while (accumulated_time > 0):
+			
+			# ensure no wait commands exceed the 16-bit limit
+			t = accumulated_time
+			if (t > max_accumulated_time):
+				t = max_accumulated_time
+			
+			# optimization: if quantization time step is 1/50 or 1/60 of a second use the single byte wait
+			if t == 882: # 50Hz
+				if self.VERBOSE: print >>self.log, "Outputting WAIT50"
+				yield (0x63, 0, output_time)
+			else:
+				if t == 882*2: # 25Hz
+					if self.VERBOSE: print >>self.log, "Outputting 2x WAIT50 "
+					yield (0x63, 0, output_time)
+					yield (0x63, 0, output_time + 882)
+				else:
+					if t == 735: # 60Hz
+						if self.VERBOSE: print >>self.log, "Outputting WAIT60"
+						yield (0x62, 0, output_time)
+					else:
+						if t == 735*2: # 30Hz
+							if self.VERBOSE: print >>self.log, "Outputting WAIT60 x 2"
+							yield (0x62, 0, output_time)
+							yield (0x62, 0, output_time + 735)
+						else:
+							if self.VERBOSE: print >>self.log, "Outputting WAIT " + str(t) + " (" + str(float(t)/float(interval_time)) + " intervals)"
+							# else emit the full 16-bit wait command (3 bytes)
+							yield (0x61, t, output_time)
+
+			output_time += t
+			accumulated_time -= t
 
 	
 
@@ -1819,8 +2708,11 @@ class VgmStream:
 			
 			
 			
+		commands = self.command_list.commands
+		command_data = self.command_list.data
+
 		# total number of commands in the vgm stream
-		num_commands = len(self.command_list)
+		num_commands = len(commands)
 
 		# total number of samples in the vgm stream
 		total_samples = int(self.metadata['total_samples'])			
@@ -1860,15 +2752,15 @@ class VgmStream:
 		tonechannel = 0
 
 		for n in range(num_commands):
-			command = self.command_list[n]["command"]
-			data = self.command_list[n]["data"]
+			command = commands[n]
+			data = command_data[n]
 			pdata = "NONE"
 			
 			# process command
-			if b'\x70' <= command <= b'\x7f':		
+			if 0x70 <= command <= 0x7f:		
 				pcommand = "WAITn"
 			else:
-				pcommand = binascii.hexlify(command)
+				pcommand = format(command, '02x')
 				
 			
 				if pcommand == "50":
@@ -1917,9 +2809,8 @@ class VgmStream:
 					event = { "wait" : 0, "t0" : -1, "v0" : -1, "t1" : -1, "v1" : -1, "t2" : -1, "v2" : -1, "t3" : -1,  "v3" : - 1 }	
 					
 				# process the write data
-				pdata = binascii.hexlify(data)
-				w = int(pdata, 16)
-				s = pdata
+				w = data
+				s = format(w, '02x')
 				pdata = s + " (" + str(w) + ")"
 				if w & 128:
 					tonechannel = (w&96)>>5
@@ -1986,12 +2877,8 @@ class VgmStream:
 						waitdictionary.append(t)	
 
 				if pcommand == "WAIT ":
-					pdata = binascii.hexlify(data)
-					t = int(pdata, 16)
-					# sdm: swap bytes to LSB
-					lsb = t & 255
-					msb = (t / 256)
-					t = (lsb * 256) + msb
+					t = data
+					pdata = format(t, '04x')
 					waittime += t
 					if t < minwait:
 						minwait = t
@@ -2003,9 +2890,8 @@ class VgmStream:
 
 				if pcommand == "WAITn":
 					# data will be "None" for this but thats ok.
-					pdata = binascii.hexlify(command)
-					t = int(pdata, 16)
-					t &= 15
+					pdata = format(command, '02x')
+					t = command & 15
 					waittime += t
 					if t < minwaitn:
 						minwaitn = t
@@ -2019,7 +2905,7 @@ class VgmStream:
 
 				
 
-			print "#" + str(n) + " Command:" + pcommand + " Data:" + pdata # '{:02x}'.format(data)
+			print >>self.log, "#" + str(n) + " Command:" + pcommand + " Data:" + pdata # '{:02x}'.format(data)
 
 		# NOTE: multiple register writes happen instantaneously
 		# ideas:
@@ -2037,15 +2923,15 @@ class VgmStream:
 
 
 		#--------------------------------
-		print "--------------------------------------------------------------------------"
-		print "Number of sampled events: " + str(len(eventlist))
+		print >>self.log, "--------------------------------------------------------------------------"
+		print >>self.log, "Number of sampled events: " + str(len(eventlist))
 
 		for n in range(len(eventlist)):
 			event = eventlist[n]
-			print "%6d" % n + " " + str(event)
+			print >>self.log, "%6d" % n + " " + str(event)
 			
 
-		print "--------------------------------------------------------------------------"
+		print >>self.log, "--------------------------------------------------------------------------"
 
 		# compile volume channel 0 stream
 
@@ -2060,11 +2946,11 @@ class VgmStream:
 		eventlist_t3 = []
 
 		def printEvents(eventlistarray, arrayname):
-			print ""
-			print "Total " + arrayname + " events: " + str(len(eventlistarray))
+			print >>self.log, ""
+			print >>self.log, "Total " + arrayname + " events: " + str(len(eventlistarray))
 			for n in range(len(eventlistarray)):
 				event = eventlistarray[n]
-				print "%6d" % n + " " + str(event)
+				print >>self.log, "%6d" % n + " " + str(event)
 
 		def processEvents(eventsarray_in, eventsarray_out, tag_in, tag_out):
 			waittime = 0
@@ -2095,47 +2981,47 @@ class VgmStream:
 		# ----------------------- analysis
 
 
-		print "Number of commands in data file: " + str(num_commands)
-		print "Total samples in data file: " + str(total_samples) + " (" + str(total_samples*1000/self.VGM_FREQUENCY) + " ms)"
-		print "Smallest wait time was: " + str(minwait) + " samples"
-		print "Smallest waitN time was: " + str(minwaitn) + " samples"
-		print "ClockSpeed:" + str(clockspeed) + " SampleRate:" + str(samplerate) + " CyclesPerSample:" + str(cyclespersample) + " CyclesPerWrite:" + str(cyclespersample*minwait)
-		print "Updates Per Second:" + str(clockspeed/(cyclespersample*minwait))
-		print "Total register writes:" + str(totalwritecount) + " Max Sequential Writes:" + str(maxwritecount) # sequential writes happen at same time, in series
-		print "Total tone writes:" + str(totaltonewrites)
-		print "Total vol writes:" + str(totalvolwrites)
-		print "Total wait commands:" + str(totalwaitcommands)
-		print "Write dictionary contains " + str(len(writedictionary)) + " unique entries"
-		print "Wait dictionary contains " + str(len(waitdictionary)) + " unique entries"
-		print "Tone dictionary contains " + str(len(tonedictionary)) + " unique entries"
-		print "Largest Tone Data Write value was " + str(maxtonedata)
-		print "Number of Tone Data writes was " + str(numtonedatawrites)
-		print "Number of unhandled commands was " + str(unhandledcommands)
+		print >>self.log, "Number of commands in data file: " + str(num_commands)
+		print >>self.log, "Total samples in data file: " + str(total_samples) + " (" + str(total_samples*1000/self.VGM_FREQUENCY) + " ms)"
+		print >>self.log, "Smallest wait time was: " + str(minwait) + " samples"
+		print >>self.log, "Smallest waitN time was: " + str(minwaitn) + " samples"
+		print >>self.log, "ClockSpeed:" + str(clockspeed) + " SampleRate:" + str(samplerate) + " CyclesPerSample:" + str(cyclespersample) + " CyclesPerWrite:" + str(cyclespersample*minwait)
+		print >>self.log, "Updates Per Second:" + str(clockspeed/(cyclespersample*minwait))
+		print >>self.log, "Total register writes:" + str(totalwritecount) + " Max Sequential Writes:" + str(maxwritecount) # sequential writes happen at same time, in series
+		print >>self.log, "Total tone writes:" + str(totaltonewrites)
+		print >>self.log, "Total vol writes:" + str(totalvolwrites)
+		print >>self.log, "Total wait commands:" + str(totalwaitcommands)
+		print >>self.log, "Write dictionary contains " + str(len(writedictionary)) + " unique entries"
+		print >>self.log, "Wait dictionary contains " + str(len(waitdictionary)) + " unique entries"
+		print >>self.log, "Tone dictionary contains " + str(len(tonedictionary)) + " unique entries"
+		print >>self.log, "Largest Tone Data Write value was " + str(maxtonedata)
+		print >>self.log, "Number of Tone Data writes was " + str(numtonedatawrites)
+		print >>self.log, "Number of unhandled commands was " + str(unhandledcommands)
 
 
 		estimatedfilesize = totalwritecount + totalwaitcommands
 
-		print "Estimated file size is " + str(estimatedfilesize) + " bytes, assuming 1 byte per command can be achieved"
+		print >>self.log, "Estimated file size is " + str(estimatedfilesize) + " bytes, assuming 1 byte per command can be achieved"
 
 
-		print ""
+		print >>self.log, ""
 
-		print "num t0 events: " + str(len(eventlist_t0)) + " (" + str(len(eventlist_t0)*3) + " bytes)"
-		print "num t1 events: " + str(len(eventlist_t1)) + " (" + str(len(eventlist_t1)*3) + " bytes)"
-		print "num t2 events: " + str(len(eventlist_t2)) + " (" + str(len(eventlist_t2)*3) + " bytes)"
-		print "num t3 events: " + str(len(eventlist_t3)) + " (" + str(len(eventlist_t3)*3) + " bytes)"
-		print "num v0 events: " + str(len(eventlist_v0)) + " (" + str(len(eventlist_v0)*3) + " bytes)"
-		print "num v1 events: " + str(len(eventlist_v1)) + " (" + str(len(eventlist_v1)*3) + " bytes)"
-		print "num v2 events: " + str(len(eventlist_v2)) + " (" + str(len(eventlist_v2)*3) + " bytes)"
-		print "num v3 events: " + str(len(eventlist_v3)) + " (" + str(len(eventlist_v3)*3) + " bytes)"
+		print >>self.log, "num t0 events: " + str(len(eventlist_t0)) + " (" + str(len(eventlist_t0)*3) + " bytes)"
+		print >>self.log, "num t1 events: " + str(len(eventlist_t1)) + " (" + str(len(eventlist_t1)*3) + " bytes)"
+		print >>self.log, "num t2 events: " + str(len(eventlist_t2)) + " (" + str(len(eventlist_t2)*3) + " bytes)"
+		print >>self.log, "num t3 events: " + str(len(eventlist_t3)) + " (" + str(len(eventlist_t3)*3) + " bytes)"
+		print >>self.log, "num v0 events: " + str(len(eventlist_v0)) + " (" + str(len(eventlist_v0)*3) + " bytes)"
+		print >>self.log, "num v1 events: " + str(len(eventlist_v1)) + " (" + str(len(eventlist_v1)*3) + " bytes)"
+		print >>self.log, "num v2 events: " + str(len(eventlist_v2)) + " (" + str(len(eventlist_v2)*3) + " bytes)"
+		print >>self.log, "num v3 events: " + str(len(eventlist_v3)) + " (" + str(len(eventlist_v3)*3) + " bytes)"
 
 		total_volume_events = len(eventlist_v0) + len(eventlist_v1) + len(eventlist_v2) + len(eventlist_v3)
 		total_tone_events = len(eventlist_t0) + len(eventlist_t1) + len(eventlist_t2) + len(eventlist_t3)
 		size_volume_events = (total_volume_events * 4 / 8) + total_volume_events*2 / 4
 		size_tone_events = (total_tone_events * 10 / 8) + total_tone_events*2
 
-		print "total_volume_events = " + str(total_volume_events) + " (" + str(size_volume_events) + " bytes)"
-		print "total_tone_events = " + str(total_tone_events) + " (" + str(size_tone_events) + " bytes)"
+		print >>self.log, "total_volume_events = " + str(total_volume_events) + " (" + str(size_volume_events) + " bytes)"
+		print >>self.log, "total_tone_events = " + str(total_tone_events) + " (" + str(size_tone_events) + " bytes)"
 
 
 		# seems you can playback at any frequency, by simply processing the VGM data stream to catchup with the simulated/real time
@@ -2187,9 +3073,9 @@ class VgmStream:
 
 	def insights(self):
 	
-		print "--------------------------------------"
-		print "insights"
-		print "--------------------------------------"
+		print >>self.log, "--------------------------------------"
+		print >>self.log, "insights"
+		print >>self.log, "--------------------------------------"
 
 		packet_dict = []
 		volume_packet_dict = []
@@ -2218,15 +3104,15 @@ class VgmStream:
 		tone_value = 0
 		
 		tone_latch_write = False 
-		for q in self.command_list:
+		commands = self.command_list.commands
+		command_data = self.command_list.data
+		for i in range(len(commands)):
 			
-			command = q["command"]
-			if command == struct.pack('B', 0x50):
+			if commands[i] == 0x50:
 	
-				data = q['data']	
-				packet_block.extend(data)
+				w = command_data[i]
+				packet_block.append(w)
 				
-				w = int(binascii.hexlify(data), 16)		
 				
 				# gather volume data
 				if w & (128+16) == (128+16):
@@ -2237,7 +3123,7 @@ class VgmStream:
 						if tone_value not in tone_dict:
 							tone_dict.append(tone_value)
 							
-					volume_packet_block.extend(data)
+					volume_packet_block.append(w)
 					volume_write_count += 1
 					if w not in volume_dict:
 						volume_dict.append(w)
@@ -2246,7 +3132,7 @@ class VgmStream:
 						
 				# gather tone latch data
 				if w & (128+16) == 128:
-					tone_packet_block.extend(data)
+					tone_packet_block.append(w)
 					tone_latch_write_count += 1
 					
 					# handle tones where only one write occurred
@@ -2263,8 +3149,8 @@ class VgmStream:
 				# gather tone data
 				if (w & 128) == 0:
 					if tone_latch_write == False:
-						print "ERROR: UNEXPECTED tone data write with no previous latch write"
-					tone_packet_block.extend(data)
+						print >>self.log, "ERROR: UNEXPECTED tone data write with no previous latch write"
+					tone_packet_block.append(w)
 					tone_data_write_count += 1
 					tone_latch_write = False
 					tone_value |= (w & 63) << 4
@@ -2351,10 +3237,10 @@ class VgmStream:
 				
 #		print " Found " + str(common_packets) + " common packets out of total " + str(packet_count) + " packets"
 
-		print " There were " + str(len(packet_dict)) + " unique packets out of total "+ str(packet_count) + " packets"
-		print " There were " + str(len(volume_packet_dict)) + " unique volume packets out of total "+ str(packet_count) + " packets"
-		print " There were " + str(len(tone_packet_dict)) + " unique tone packets out of total "+ str(packet_count) + " packets"
-		print ""
+		print >>self.log, " There were " + str(len(packet_dict)) + " unique packets out of total "+ str(packet_count) + " packets"
+		print >>self.log, " There were " + str(len(volume_packet_dict)) + " unique volume packets out of total "+ str(packet_count) + " packets"
+		print >>self.log, " There were " + str(len(tone_packet_dict)) + " unique tone packets out of total "+ str(packet_count) + " packets"
+		print >>self.log, ""
 		
 		def get_packet_dict_size(dict):
 			sz = 0
@@ -2362,59 +3248,59 @@ class VgmStream:
 				sz += len(p)
 			return sz
 			
-		print " Packet dictionary size " + str(get_packet_dict_size(packet_dict)) + " bytes"
-		print " Volume dictionary size " + str(get_packet_dict_size(volume_packet_dict)) + " bytes"
-		print "   Tone dictionary size " + str(get_packet_dict_size(tone_packet_dict)) + " bytes"
-		print ""
+		print >>self.log, " Packet dictionary size " + str(get_packet_dict_size(packet_dict)) + " bytes"
+		print >>self.log, " Volume dictionary size " + str(get_packet_dict_size(volume_packet_dict)) + " bytes"
+		print >>self.log, "   Tone dictionary size " + str(get_packet_dict_size(tone_packet_dict)) + " bytes"
+		print >>self.log, ""
 		
-		print " Number of unique volumes " + str(len(volume_dict)) + " (max 64)"	# should max out at 64 (4x16)
-		print " Number of volume writes " + str(volume_write_count)
-		print ""
-		print " Number of unique tones " + str(len(tone_dict))
-		print " Number of tone latch writes " + str(tone_latch_write_count)
-		print " Number of tone data writes " + str(tone_data_write_count)
-		print " Total 16-bit tone data writes " + str(tone_latch_write_count+tone_data_write_count)
-		print " Number of single tone latch writes " + str(tone_single_write_count)
-		print ""
-		print " Packet size distributions (0-11 bytes):"
+		print >>self.log, " Number of unique volumes " + str(len(volume_dict)) + " (max 64)"	# should max out at 64 (4x16)
+		print >>self.log, " Number of volume writes " + str(volume_write_count)
+		print >>self.log, ""
+		print >>self.log, " Number of unique tones " + str(len(tone_dict))
+		print >>self.log, " Number of tone latch writes " + str(tone_latch_write_count)
+		print >>self.log, " Number of tone data writes " + str(tone_data_write_count)
+		print >>self.log, " Total 16-bit tone data writes " + str(tone_latch_write_count+tone_data_write_count)
+		print >>self.log, " Number of single tone latch writes " + str(tone_single_write_count)
+		print >>self.log, ""
+		print >>self.log, " Packet size distributions (0-11 bytes):"
 
 		t = 0
 		for i in range(0,12):
 			t += packet_size_counts[i]
-		print packet_size_counts, t
+		print >>self.log, packet_size_counts, t
 			
 
-		print ""
-		print " Unique Packet dict distributions (0-11 bytes):"
+		print >>self.log, ""
+		print >>self.log, " Unique Packet dict distributions (0-11 bytes):"
 		t = 0
 		for i in range(0,12):
 			t += packet_dict_counts[i]
-		print packet_dict_counts, t
+		print >>self.log, packet_dict_counts, t
 
-		print ""
-		print " Byte cost distributions (0-11 bytes):"
+		print >>self.log, ""
+		print >>self.log, " Byte cost distributions (0-11 bytes):"
 		o = "[ "
 		t = 0
 		for i in range(0,12):
 			n = (packet_dict_counts[i]) * (i)
 			t += n
 			o += str(n) + ", "
-		print o + "]", t
+		print >>self.log, o + "]", t
 
 
-		print ""
-		print " Byte saving distributions (0-11 bytes):"
+		print >>self.log, ""
+		print >>self.log, " Byte saving distributions (0-11 bytes):"
 		t = 0
 		o = "[ "
 		for i in range(0,12):
 			n = (packet_size_counts[i] - packet_dict_counts[i]) * (i)
 			t += n
 			o += str(n) + ", "
-		print o + "]", t
+		print >>self.log, o + "]", t
 
 
 
-		print ""
+		print >>self.log, ""
 		tp = 0
 		bs = 0
 		size = 1
@@ -2423,25 +3309,26 @@ class VgmStream:
 			bs += n * size
 			size += 1
 			
-		print " (total packets " + str(tp) + ")"
-		print " (total stream bytesize " + str(bs) + ")"
-		print " (write count byte size " + str(volume_write_count+tone_latch_write_count+tone_data_write_count+packet_count) + ")"
+		print >>self.log, " (total packets " + str(tp) + ")"
+		print >>self.log, " (total stream bytesize " + str(bs) + ")"
+		print >>self.log, " (write count byte size " + str(volume_write_count+tone_latch_write_count+tone_data_write_count+packet_count) + ")"
 
-		print " Volume writes represent " + str( volume_write_count * 100 / (bs-packet_count) ) + " % of filesize"
-		print "   Tone writes represent " + str( (tone_latch_write_count+tone_data_write_count) * 100 / (bs-packet_count) ) + " % of filesize"
+		print >>self.log, " Volume writes represent " + str( volume_write_count * 100 / (bs-packet_count) ) + " % of filesize"
+		print >>self.log, "   Tone writes represent " + str( (tone_latch_write_count+tone_data_write_count) * 100 / (bs-packet_count) ) + " % of filesize"
 		
-		print " Filesize using packet LUT " + str( packet_count*2 + get_packet_dict_size(packet_dict))
-		print " Filesize using vol/tone packet LUT " + str( packet_count*4 + get_packet_dict_size(volume_packet_dict) + get_packet_dict_size(tone_packet_dict) )
-		print "--------------------------------------"
+		print >>self.log, " Filesize using packet LUT " + str( packet_count*2 + get_packet_dict_size(packet_dict))
+		print >>self.log, " Filesize using vol/tone packet LUT " + str( packet_count*4 + get_packet_dict_size(volume_packet_dict) + get_packet_dict_size(tone_packet_dict) )
+		print >>self.log, "--------------------------------------"
 	
 	#--------------------------------------------------------------------------------------------------------------
 
 	# Apply a sliding window dictionary compression to the packet data
-	def compress_packets(self):
+	# filename is the compressed packet stream output, the packet dictionary is written alongside it as <name>_dict<ext>
+	def compress_packets(self, filename):
 	
-		print "--------------------------------------"
-		print "packet compression"
-		print "--------------------------------------"
+		print >>self.log, "--------------------------------------"
+		print >>self.log, "packet compression"
+		print >>self.log, "--------------------------------------"
 
 		packet_list = []
 		packet_dict = []
@@ -2451,13 +3338,13 @@ class VgmStream:
 		
 		packet_block = bytearray()
 
-		for q in self.command_list:
+		commands = self.command_list.commands
+		command_data = self.command_list.data
+		for i in range(len(commands)):
 			
-			command = q["command"]
-			if command == struct.pack('B', 0x50):
+			if commands[i] == 0x50:
 	
-				data = q['data']	
-				packet_block.extend(data)
+				packet_block.append(command_data[i])
 
 			else:
 				packet_list.append(packet_block)
@@ -2466,7 +3353,7 @@ class VgmStream:
 				packet_block = bytearray()
 
 
-		print "Found " + str(len(packet_list)) + " packets"
+		print >>self.log, "Found " + str(len(packet_list)) + " packets"
 
 
 		# approach:
@@ -2513,7 +3400,7 @@ class VgmStream:
 						if window_ptr+packet_size > window_size:
 							window_ptr = 0
 
-						print "New packet added to window index " + str(window_ptr)
+						print >>self.log, "New packet added to window index " + str(window_ptr)
 						for j in range(packet_size):
 							window_data[window_ptr+j] = packet[j]
 
@@ -2525,12 +3412,12 @@ class VgmStream:
 					output_stream.append(packet_size)
 					output_stream.extend(packet)
 				else:
-					print "Found packet at index " + str(packet_index)
+					print >>self.log, "Found packet at index " + str(packet_index)
 					output_stream.extend(struct.pack('h', packet_index))
 
 
-			print "Output stream size " + str(len(output_stream))
-			bin_file = open("xxx.bin", 'wb')
+			print >>self.log, "Output stream size " + str(len(output_stream))
+			bin_file = open(filename, 'wb')
 			bin_file.write(output_stream)
 			bin_file.close()				
 		else:
@@ -2570,20 +3457,21 @@ class VgmStream:
 				output_stream.extend(struct.pack('h', packet_index))
 
 
-			print "Unique packets " + str(total_new_packets)
-			print "Dict stream size " + str(len(dict_stream))
-			print "Output stream size " + str(len(output_stream))
+			print >>self.log, "Unique packets " + str(total_new_packets)
+			print >>self.log, "Dict stream size " + str(len(dict_stream))
+			print >>self.log, "Output stream size " + str(len(output_stream))
 
 
 			# write to output file
-			bin_file = open("xxx.bin", 'wb')
+			bin_file = open(filename, 'wb')
 			bin_file.write(output_stream)
 			bin_file.close()	
-			bin_file = open("xxx2.bin", 'wb')
+			name, ext = os.path.splitext(filename)
+			bin_file = open(name + "_dict" + ext, 'wb')
 			bin_file.write(dict_stream)
 			bin_file.close()			
 
-		print "--------------------------------------"
+		print >>self.log, "--------------------------------------"
 
 
 
@@ -2593,96 +3481,152 @@ class VgmStream:
 	
 	#--------------------------------------------------------------------------------------------------------------	
 	
-	def write_binary(self, filename, rawheader = True):
-		print "   VGM Processing : Output binary file "
+	# output can be a filename, '-' for stdout or a binary file object
+	def write_binary(self, output, rawheader = True):
+		bin_file = self.open_output(output)
+		print >>self.log, "   VGM Processing : Output binary file "
 		
 		# debug data to dump out information about the packet stream
 		#self.insights()
-		#self.compress_packets()
+		#self.compress_packets("packets.bin")
+
+		self.run_writer(self.write_binary_stage, bin_file, rawheader)
+
+	# returns the raw binary data for the processed VGM, or None if it can't be output
+	def get_binary_data(self, rawheader = True):
+		bin_data = ByteBuffer()
+		self.write_binary(bin_data, rawheader)
+		self.finish()
+		if bin_data.tell() == 0:
+			return None
+		return bin_data.getvalue()
+
+	# writer stage for write_binary(), writes to a VgmOutput
+	# the packets are written as they are received, and the packet count and duration in the header are filled in at the end.
+	def write_binary_stage(self, commands, bin_file, rawheader):
 		
 		byte_size = 1
 		packet_size = 0
 		play_rate = self.metadata['rate']
 		play_interval = self.VGM_FREQUENCY / play_rate
 		data_block = bytearray()
-		packet_block = bytearray()
 
 		packet_count = 0
+
+		# output the header, the packet count and duration are filled in at the end
+		output_length = 0
+		if rawheader:
+			header_block = self.build_binary_header(0)
+			bin_file.write(bytes(header_block))
+			output_length += len(header_block)
+
+		failed = False
 		
-		# emit the packet data
-		for q in self.command_list:
-			
-			command = q["command"]
-			if command != struct.pack('B', 0x50):
+		# emit the packet data, one packet for each time slot
+		for writes, item in vgm_time_slots(commands):
+			for write in writes:
+				yield write
+
+			# any writes after the last command are not output
+			if item is None:
+				break
+			yield item
+			if failed:
+				continue
 			
-				# non-write command, so flush any pending packet data
-				if self.VERBOSE: print "Packet length " + str(len(packet_block))
+			command, data, time = item
 
-				data_block.append(struct.pack('B', len(packet_block)))
-				data_block.extend(packet_block)
-				packet_count += 1
-				
-				#if packet_count > 30*play_rate:
-				#	break
+			# the writes of the time slot
+			if self.VERBOSE:
+				for write in writes:
+					print >>self.log, "Data " + format(write[0], '02x')
+			packet_block = bytearray(write[1] for write in writes)
 
-				# start new packet
-				packet_block = bytearray()
-				
-				if self.VERBOSE: print "Command " + str(binascii.hexlify(command))
-				
-				
+			# non-write command, so flush the packet data
+			if self.VERBOSE: print >>self.log, "Packet length " + str(len(packet_block))
+
+			data_block.append(len(packet_block))
+			data_block.extend(packet_block)
+			packet_count += 1
+			
+			#if packet_count > 30*play_rate:
+			#	break
+			
+			if self.VERBOSE: print >>self.log, "Command " + format(command, '02x')
+			
+			
 
-				# see if command is a wait longer than one interval and emit empty packets to compensate
-				wait = 0
-				if command == struct.pack('B', 0x61):
-					t = int(binascii.hexlify(q["data"]), 16)
-					wait = ((t & 255) * 256) + (t>>8)
+			# see if command is a wait longer than one interval and emit empty packets to compensate
+			wait = 0
+			if command in (0x61, 0x62, 0x63):
+				wait = VGM_COMMAND_WAIT_SAMPLES[command]
+				if wait < 0:
+					wait = data
+				
+			if wait != 0:	
+				intervals = wait / (self.VGM_FREQUENCY / play_rate)
+				if intervals == 0:
+					print >>self.log, "ERROR in data stream, wait value (" + str(wait) + ") was not divisible by play_rate (" + str((self.VGM_FREQUENCY / play_rate)) + "), bailing"
+					failed = True
+					continue
 				else:
-					if command == struct.pack('B', 0x62):
-						wait = 735
-					else:
-						if command == struct.pack('B', 0x63):
-							wait = 	882
+					if self.VERBOSE: print >>self.log, "WAIT " + str(intervals) + " intervals"
 					
-				if wait != 0:	
-					intervals = wait / (self.VGM_FREQUENCY / play_rate)
-					if intervals == 0:
-						print "ERROR in data stream, wait value (" + str(wait) + ") was not divisible by play_rate (" + str((self.VGM_FREQUENCY / play_rate)) + "), bailing"
-						return
-					else:
-						if self.VERBOSE: print "WAIT " + str(intervals) + " intervals"
-						
-					# emit empty packet headers to simulate wait commands
+				# emit empty packet headers to simulate wait commands
+				intervals -= 1
+				while intervals > 0:
+					data_block.append(0)
+					if self.VERBOSE: print >>self.log, "Packet length 0"
 					intervals -= 1
-					while intervals > 0:
-						data_block.append(0)
-						if self.VERBOSE: print "Packet length 0"
-						intervals -= 1
-						packet_count += 1
+					packet_count += 1
 
-				
-				
-			else:
-				if self.VERBOSE: print "Data " + str(binascii.hexlify(command))			
-				packet_block.extend(q['data'])
+			
+			
+			if len(data_block) >= 65536:
+				bin_file.write(bytes(data_block))
+				output_length += len(data_block)
+				data_block = bytearray()
+
+		# the output file is not written if the stream is bad
+		if failed:
+			bin_file.discard()
+			return
 
 		# eof
 		data_block.append(0x00)	# append one last wait
 		data_block.append(0xFF)	# signal EOF
-		
+		bin_file.write(bytes(data_block))
+		output_length += len(data_block)
+
+		# go back and fill in the header now we know the number of packets
+		print >>self.log, "play rate is " + str(play_rate)
+		print >>self.log, "    Num packets " + str(packet_count)
+		duration = packet_count / play_rate
+		duration_mm = int(duration / 60.0)
+		duration_ss = int(duration % 60.0)
+		print >>self.log, "    Song duration " + str(duration) + " seconds, " + str(duration_mm) + "m" + str(duration_ss) + "s"
+		if rawheader:
+			bin_file.write_header(bytes(self.build_binary_header(packet_count)))
+
+		bin_file.close()
+
+		print >>self.log, "Compressed VGM is " + str(output_length) + " bytes long"
+
+	#-------------------------------------------------------------------------------------------------
+
+	# build the header of a raw binary file with the given number of packets, returns a bytearray
+	def build_binary_header(self, packet_count):
+		play_rate = self.metadata['rate']
 		
 		header_block = bytearray()
 		# emit the play rate
-		print "play rate is " + str(play_rate)
 		header_block.append(struct.pack('B', play_rate & 0xff))
 		header_block.append(struct.pack('B', packet_count & 0xff))		
 		header_block.append(struct.pack('B', (packet_count >> 8) & 0xff))	
 
-		print "    Num packets " + str(packet_count)
 		duration = packet_count / play_rate
 		duration_mm = int(duration / 60.0)
 		duration_ss = int(duration % 60.0)
-		print "    Song duration " + str(duration) + " seconds, " + str(duration_mm) + "m" + str(duration_ss) + "s"
 		header_block.append(struct.pack('B', duration_mm))	# minutes		
 		header_block.append(struct.pack('B', duration_ss))	# seconds
 		
@@ -2717,20 +3661,1505 @@ class VgmStream:
 		output_block.extend(author)
 		output_block.append(struct.pack('B', 0))				# zero terminator
 		
-		# send data with or without header
-		if rawheader:
-			output_block.extend(data_block)
-		else:
-			output_block = data_block
+		return output_block
 		
-		# write file
-		print "Compressed VGM is " + str(len(output_block)) + " bytes long"
+#------------------------------------------------------------------------------------------
+# VGM Catalog
+#------------------------------------------------------------------------------------------
+
+# file extensions that are picked up when a directory of VGMs is scanned or converted
+VGM_FILE_EXTENSIONS = ('.vgm', '.vgz')
+
+# find all of the VGM files at the given path, which can be a file or a directory
+def find_vgm_files(path):
+	if not os.path.isdir(path):
+		return [path]
+
+	filenames = []
+	for root, dirs, files in os.walk(path):
+		dirs.sort()
+		for f in sorted(files):
+			if os.path.splitext(f)[1].lower() in VGM_FILE_EXTENSIONS:
+				filenames.append(os.path.join(root, f))
+	return filenames
+
+# An on-disk SQLite index of VGM file metadata (header and GD3 tag), for quickly finding tunes
+# by duration, clock or author without parsing each file.
+# Files are keyed by path, and are only re-scanned when their size or modification time changes.
+class VgmCatalog(object):
+
+	# log is the file object that messages about files that can't be read are printed to, defaults to stdout
+	def __init__(self, db_filename, log = None):
+		if log is None:
+			log = sys.stdout
+		self.log = log
+		self.db = sqlite3.connect(db_filename)
+		self.db.execute("""
+			CREATE TABLE IF NOT EXISTS vgm_files (
+				path TEXT PRIMARY KEY,
+				size INTEGER,
+				mtime REAL,
+				version INTEGER,
+				sn76489_clock INTEGER,
+				rate INTEGER,
+				total_samples INTEGER,
+				duration REAL,
+				loop_offset INTEGER,
+				loop_samples INTEGER,
+				title TEXT,
+				game TEXT,
+				system TEXT,
+				author TEXT,
+				date TEXT,
+				vgm_creator TEXT,
+				notes TEXT,
+				error TEXT
+			)""")
+		self.db.commit()
+
+	def close(self):
+		self.db.close()
+
+	# add or update the catalog entries for all VGM files found at the given paths (files or directories)
+	# unchanged files are skipped, and entries for files that have been deleted from a scanned directory are removed
+	# returns a tuple of (number of files scanned, number of unchanged files, number of entries removed)
+	def scan(self, paths):
+		scanned_count = 0
+		unchanged_count = 0
+		removed_count = 0
+
+		for path in paths:
+			seen = set()
+			for filename in find_vgm_files(path):
+				filename = os.path.abspath(filename)
+				seen.add(filename)
+				try:
+					st = os.stat(filename)
+				except OSError as e:
+					# eg. a missing file, or a wildcard that matched nothing
+					self.db.execute("INSERT OR REPLACE INTO vgm_files VALUES (" + ", ".join(["?"] * 18) + ")", self.get_error_row(filename, None, e))
+					scanned_count += 1
+					continue
+
+				row = self.db.execute("SELECT size, mtime FROM vgm_files WHERE path = ?", (filename,)).fetchone()
+				if row is not None and row[0] == st.st_size and row[1] == st.st_mtime:
+					unchanged_count += 1
+					continue
+
+				self.db.execute("INSERT OR REPLACE INTO vgm_files VALUES (" + ", ".join(["?"] * 18) + ")", self.scan_file(filename, st))
+				scanned_count += 1
+
+			# remove any entries for files that no longer exist in a scanned directory
+			if os.path.isdir(path):
+				root = os.path.join(os.path.abspath(path), '')
+				for (filename,) in self.db.execute("SELECT path FROM vgm_files WHERE substr(path, 1, ?) = ?", (len(root), root)).fetchall():
+					if filename not in seen:
+						self.db.execute("DELETE FROM vgm_files WHERE path = ?", (filename,))
+						removed_count += 1
+
+		self.db.commit()
+		return (scanned_count, unchanged_count, removed_count)
+
+	# read the header and GD3 tag of a single VGM file, returns a catalog row
+	def scan_file(self, filename, st):
+		def gd3_text(field):
+			return vgm_stream.gd3_data[field].decode("utf_16_le", "replace")
+
+		vgm_stream = None
+		try:
+			vgm_stream = VgmStream(filename, header_only = True, log = self.log)
+			header = vgm_stream.metadata
+			return (filename, st.st_size, st.st_mtime,
+				header.version, header.sn76489_clock, header.rate,
+				header.total_samples, float(header.total_samples) / VgmStream.VGM_FREQUENCY,
+				header.loop_offset, header.loop_samples,
+				gd3_text('title_eng'), gd3_text('game_eng'), gd3_text('console_eng'), gd3_text('artist_eng'),
+				gd3_text('date'), gd3_text('vgm_creator'), gd3_text('notes'),
+				None)
+		except (ValueError, FatalError, EnvironmentError, struct.error) as e:
+			return self.get_error_row(filename, st, e)
+		finally:
+			if vgm_stream is not None:
+				vgm_stream.close()
+
+	# returns a catalog row for a file that can't be read, reporting the error
+	# the row is kept so that the file isn't rescanned until it changes, st is None if the file couldn't be found
+	def get_error_row(self, filename, st, e):
+		error = str(e) or e.__class__.__name__
+		print >>self.log, "ERROR: '" + filename + "' " + error
+		if st is None:
+			return (filename, None, None) + (None,) * 14 + (error,)
+		return (filename, st.st_size, st.st_mtime) + (None,) * 14 + (error,)
+
+	# search the catalog, returns a list of (path, duration, sn76489_clock, title, author) tuples
+	# durations are in seconds, author is matched as a case insensitive substring
+	def query(self, min_duration = None, max_duration = None, clock = None, author = None):
+		sql = "SELECT path, duration, sn76489_clock, title, author FROM vgm_files WHERE error IS NULL"
+		args = []
+		if min_duration is not None:
+			sql += " AND duration >= ?"
+			args.append(min_duration)
+		if max_duration is not None:
+			sql += " AND duration <= ?"
+			args.append(max_duration)
+		if clock is not None:
+			sql += " AND sn76489_clock = ?"
+			args.append(clock)
+		if author is not None:
+			sql += " AND author LIKE ?"
+			args.append('%' + author + '%')
+		sql += " ORDER BY path"
+		return self.db.execute(sql, args).fetchall()
+
+
+#------------------------------------------------------------------------------------------
+# VGM Cache
+#------------------------------------------------------------------------------------------
+
+# hash of this script, so that cached conversions are not used once the converter changes
+converter_version = None
+
+def get_converter_version():
+	global converter_version
+	if converter_version is None:
+		script_filename = os.path.splitext(os.path.abspath(__file__))[0] + '.py'
+		script_file = open(script_filename, 'rb')
+		converter_version = hashlib.sha1(script_file.read()).hexdigest()
+		script_file.close()
+	return converter_version
+
+# An on-disk cache of conversion results, so that converting the same VGM with the same options again
+# just returns the previous outputs, without parsing or processing anything.
+# Entries are keyed by a hash of the source data, the conversion options and the converter version,
+# and each is a file holding the processed VGM and raw outputs.
+# The cache also holds checkpoints of the processing passes (see VgmStream), so that when only the later
+# options change (eg. the quantize rate), the conversion carries on from the last pass that is the same.
+# The cache is kept under max_size bytes by removing the least recently used entries, using the
+# modification time of each entry, which is updated whenever it is used. The size of the cache is kept as a
+# running total as entries are stored, and the cache directory is only scanned again when that goes over max_size
+# (or every RESCAN_PUTS entries, to take in those stored by other processes). Entries are written to
+# a temporary file and renamed into place, so a cache directory can be shared between processes.
+class VgmCache(object):
+
+	ENTRY_EXTENSION = '.cache'
+
+	# flags before each output in an entry
+	OUTPUT_NONE = 0		# output wasn't requested
+	OUTPUT_DATA = 1		# output data follows
+	OUTPUT_FAILED = 2	# output couldn't be produced
+
+	STRUCT_OUTPUT = struct.Struct('<BI')
+
+	# number of entries stored between rescans of the cache directory, which pick up the entries stored by other processes
+	RESCAN_PUTS = 100
+
+	# fraction of max_size that entries are removed down to, so that a full cache isn't scanned again for every entry stored
+	EVICT_TARGET = 0.9
+
+	def __init__(self, cache_dir, max_size = 256*1024*1024):
+		self.cache_dir = cache_dir
+		self.max_size = max_size
+
+		# running total of the size of the cache, None until the cache directory has been scanned
+		self.total_size = None
+		self.puts_since_scan = 0
+
+	# returns the key for the given source data and options (a dict)
+	def make_key(self, data, options):
+		key = hashlib.sha1(get_converter_version())
+		key.update(repr(sorted(options.items())))
+		key.update(data)
+		return key.hexdigest()
+
+	def get_path(self, key):
+		return os.path.join(self.cache_dir, key[0:2], key + self.ENTRY_EXTENSION)
+
+	# returns the key of a processing pass checkpoint, from the key of the one before it and the pass options (a dict)
+	def make_stage_key(self, previous_key, name, options):
+		return hashlib.sha1(previous_key + name + repr(sorted(options.items()))).hexdigest()
+
+	# look up a cached conversion, returns a tuple of (vgm data, raw data) or None if there isn't one
+	# the raw data is None if it wasn't output, and an empty string if it couldn't be output
+	def get(self, key):
+		entry = self.get_data(key)
+		if entry is None:
+			return None
+
+		outputs = []
+		position = 0
+		try:
+			for i in range(2):
+				flag, size = self.STRUCT_OUTPUT.unpack_from(entry, position)
+				position += self.STRUCT_OUTPUT.size
+				if flag == self.OUTPUT_NONE:
+					outputs.append(None)
+				elif flag == self.OUTPUT_FAILED:
+					outputs.append(b'')
+				else:
+					outputs.append(entry[position:position+size])
+				position += size
+		except struct.error:
+			# a damaged entry is just ignored
+			return None
+
+		return tuple(outputs)
+
+	# store a conversion, outputs are as returned by get()
+	def put(self, key, vgm_data, raw_data):
+		entry = bytearray()
+		for data in (vgm_data, raw_data):
+			if data is None:
+				entry.extend(self.STRUCT_OUTPUT.pack(self.OUTPUT_NONE, 0))
+			elif len(data) == 0:
+				entry.extend(self.STRUCT_OUTPUT.pack(self.OUTPUT_FAILED, 0))
+			else:
+				entry.extend(self.STRUCT_OUTPUT.pack(self.OUTPUT_DATA, len(data)))
+				entry.extend(data)
+		self.put_data(key, bytes(entry))
+
+	# read the entry with the given key, returns None if there isn't one
+	def get_data(self, key):
+		path = self.get_path(key)
+		try:
+			entry_file = open(path, 'rb')
+			entry = entry_file.read()
+			entry_file.close()
+			os.utime(path, None)
+		except EnvironmentError:
+			return None
+		return entry
+
+	# store an entry
+	def put_data(self, key, entry):
+		path = self.get_path(key)
+		temp_path = path + '.' + str(os.getpid()) + '.tmp'
+		make_directory(os.path.dirname(path))
+		entry_file = open(temp_path, 'wb')
+		entry_file.write(entry)
+		entry_file.close()
+		try:
+			replaced_size = os.path.getsize(path)
+		except OSError:
+			replaced_size = 0
+		try:
+			os.rename(temp_path, path)
+		except OSError:
+			# another process stored the same entry first
+			os.remove(temp_path)
+			replaced_size = len(entry)
+
+		# the cache directory is only scanned again once the running total is over the maximum size
+		self.puts_since_scan += 1
+		if self.total_size is None or self.puts_since_scan >= self.RESCAN_PUTS:
+			self.evict()
+		else:
+			self.total_size += len(entry) - replaced_size
+			if self.total_size > self.max_size:
+				self.evict()
+
+	# scan the cache directory for its size, and if it is over its maximum size, remove the least recently used entries
+	# until it is under EVICT_TARGET of it
+	def evict(self):
+		self.puts_since_scan = 0
+		entries = []
+		total_size = 0
+		for root, dirs, files in os.walk(self.cache_dir):
+			for f in files:
+				if f.endswith(self.ENTRY_EXTENSION):
+					path = os.path.join(root, f)
+					try:
+						st = os.stat(path)
+					except OSError:
+						continue
+					entries.append((st.st_mtime, st.st_size, path))
+					total_size += st.st_size
+
+		if total_size > self.max_size:
+			entries.sort()
+			for mtime, size, path in entries:
+				try:
+					os.remove(path)
+				except OSError:
+					pass
+				total_size -= size
+				if total_size <= self.max_size * self.EVICT_TARGET:
+					break
+
+		self.total_size = total_size
+
+
+#------------------------------------------------------------------------------------------
+# VGM Converter
+#------------------------------------------------------------------------------------------
+
+# A file object that discards everything written to it, for converting without any progress messages
+class NullOutput(object):
+	def write(self, text):
+		pass
+
+	def flush(self):
+		pass
+
+# The fixed sequence of processing applied to a VGM, with the options given once up front so that
+# the same converter can be used for any number of files.
+#  transpose - target clock type, 'ntsc', 'pal' or 'bbc', or a clock speed in Hz
+#  quantize - playback rate in Hz, defaults to 60 if a raw file is output
+#  filter - string of channels to strip eg. '13'
+#  rawheader - include the header in raw file output
+#  start, length - time window of the source VGM to convert, in seconds (0 for all of it)
+#  stream - process the VGM as a stream (see VgmStream)
+#  verbose - emit debug information
+#  quiet - no progress messages, otherwise they are printed to log (or stdout)
+#  cache - a VgmCache to reuse previous conversions from
+#  chunk - split VGMs longer than this many seconds into chunks of about this length, which are processed in parallel 
+#   (see process_chunks), 0 to process the whole VGM at once
+#  workers - number of processes to process the chunks on, defaults to the number of CPUs
+class VgmConverter(object):
+
+	def __init__(self, transpose = None, quantize = None, filter = None, rawheader = True, start = 0, length = 0, stream = False, verbose = False, quiet = False, log = None, cache = None, chunk = 0, workers = None):
+		self.transpose = transpose
+		self.quantize = quantize
+		self.filter = filter
+		self.rawheader = rawheader
+		self.start = start
+		self.length = length
+		self.stream = stream
+		self.verbose = verbose
+		if quiet:
+			log = NullOutput()
+		self.log = log
+		self.cache = cache
+		self.chunk = chunk
+		self.workers = workers
+
+	# convert the given source VGM, writing the processed VGM to output_filename and/or raw binary to raw_filename if given
+	# the source and outputs can also be '-' for stdin/stdout or file objects, and the source can be VGM data (see VgmStream)
+	# the source VGM data can also be given as data, when source_filename is only the VGM filename, or None
+	# returns the processed VgmStream, which only has the header of the output VGM if it came from the cache
+	def convert(self, source_filename, output_filename = None, raw_filename = None, data = None):
+		if self.cache != None:
+			return self.convert_cached(source_filename, output_filename, raw_filename, data)
+		return self.process(source_filename, output_filename, raw_filename, data)
+
+	# the options that affect the output, for the cache key
+	def get_output_options(self, raw):
+		quantize = self.quantize
+		if raw and quantize == None:
+			quantize = 60
+		return {
+			'transpose' : str(self.transpose).lower() if self.transpose != None else None,
+			'quantize' : int(quantize) if quantize != None else None,
+			'filter' : "".join(c for c in "0123" if self.filter != None and c in self.filter),
+			'rawheader' : self.rawheader if raw else None,
+			'start' : float(self.start),
+			'length' : float(self.length),
+			'stream' : self.stream
+		}
+
+	# convert using the cache, the outputs are held in memory so that they can be stored
+	def convert_cached(self, source, output_filename, raw_filename, data = None):
+		# read the source, so that it can be hashed
+		source_name = None
+		if data != None:
+			data = bytes(data)
+			source_name = source
+		elif isinstance(source, memoryview):
+			data = source.tobytes()
+		elif isinstance(source, bytearray):
+			data = bytes(source)
+		elif source == '-':
+			data = sys.stdin.read()
+		elif hasattr(source, 'read'):
+			data = source.read()
+			source_name = getattr(source, 'name', None)
+		else:
+			source_file = open(source, 'rb')
+			data = source_file.read()
+			source_file.close()
+			source_name = source
+
+		key = self.cache.make_key(data, self.get_output_options(raw_filename != None))
+		outputs = self.cache.get(key)
+
+		# an entry without a raw output can't be used if one is needed now
+		if outputs != None and (raw_filename == None or outputs[1] != None):
+			vgm_data, raw_data = outputs
+			vgm_stream = VgmStream(None, header_only = True, log = self.log, data = vgm_data)
+			print >>self.log, "   VGM Processing : Using cached conversion"
+		else:
+			output_file = ByteBuffer()
+			raw_file = ByteBuffer() if raw_filename != None else None
+
+			vgm_stream = self.process(source_name, output_file, raw_file, data)
+
+			vgm_data = output_file.getvalue()
+			raw_data = raw_file.getvalue() if raw_file != None else None
+			self.cache.put(key, vgm_data, raw_data)
+
+		if output_filename != None:
+			vgm_file = VgmOutput(output_filename)
+			vgm_file.write(vgm_data)
+			vgm_file.close()
+
+		# the raw file is not written if the VGM can't be output in that format
+		if raw_filename != None and len(raw_data) > 0:
+			bin_file = VgmOutput(raw_filename)
+			bin_file.write(raw_data)
+			bin_file.close()
+
+		return vgm_stream
+
+	# the processing passes before quantizing, as a list of (name, options, function) tuples
+	# the options are those the pass depends on, for the checkpoint keys
+	def get_passes(self):
+		passes = []
+		if self.filter != None:
+			passes.append(('filter', { 'filter' : "".join(c for c in "0123" if c in self.filter) }, self.filter_pass))
+		passes.append(('optimize', {}, self.optimize_pass))
+		if self.transpose != None:
+			passes.append(('transpose', { 'transpose' : str(self.transpose).lower() }, self.transpose_pass))
+		return passes
+
+	# apply channel filters
+	def filter_pass(self, vgm_stream):
+		if self.filter.find('0') != -1:
+			vgm_stream.filter_channel(0)
+		if self.filter.find('1') != -1:
+			vgm_stream.filter_channel(1)
+		if self.filter.find('2') != -1:
+			vgm_stream.filter_channel(2)
+		if self.filter.find('3') != -1:
+			vgm_stream.filter_channel(3)
+
+	def optimize_pass(self, vgm_stream):
+		# Fixed optimization - non-lossy. Only removes duplicate register writes that are wholly unnecessary		
+		vgm_stream.optimize()
+
+		# Second optimization - for each update interval, eliminate redundant register writes 
+		# and sort the writes for each interval so that volumes are set before tones.
+		# This is in principle 'lossy' since the output VGM will be different to the source, but 
+		# technically it will not influence the output audio stream.
+		vgm_stream.optimize2()		
+			
+		# Run first optimization again to take advantage of any redundancy from last optimization
+		vgm_stream.optimize()	
+			
+	# apply transpose
+	def transpose_pass(self, vgm_stream):
+		vgm_stream.transpose(self.transpose)
+
+	# run the processing, see convert()
+	# checkpoints are used if the source data is given as data and there is a cache
+	def process(self, source_filename, output_filename = None, raw_filename = None, data = None):
+
+		passes = self.get_passes()
+		use_checkpoints = data != None and self.cache != None and not self.stream
+
+		if use_checkpoints:
+			# the key for each checkpoint depends on all of the passes before it
+			keys = [self.cache.make_key(data, { 'start' : float(self.start), 'length' : float(self.length) })]
+			for name, options, function in passes:
+				keys.append(self.cache.make_stage_key(keys[-1], name, options))
+
+			# carry on from the last checkpoint there is
+			vgm_stream = None
+			for index in reversed(range(len(keys))):
+				checkpoint = self.cache.get_data(keys[index])
+				if checkpoint != None:
+					vgm_stream = VgmStream(source_filename, header_only = True, log = self.log, data = data)
+					vgm_stream.restore_checkpoint(checkpoint)
+					print >>self.log, "   VGM Processing : Resuming from " + (passes[index-1][0] if index > 0 else "parse") + " checkpoint"
+					passes = passes[index:]
+					keys = keys[index+1:]
+					break
+
+			if vgm_stream == None:
+				vgm_stream = VgmStream(source_filename, start = self.start, length = self.length, log = self.log, data = data)
+				self.cache.put_data(keys.pop(0), vgm_stream.get_checkpoint())
+		else:
+			vgm_stream = VgmStream(source_filename, start = self.start, length = self.length, stream = self.stream, log = self.log, data = data)
+
+		# turn on verbose mode if required
+		if self.verbose:
+			vgm_stream.set_verbose(True)
+
+		# if rawfile output is specified, but no quantization option given, force a default quantization of 60Hz (NTSC)
+		quantize = self.quantize
+		if raw_filename != None and quantize == None:
+			quantize = 60
+
+		# long VGMs can be processed in chunks, up to and including quantizing
+		chunked = self.chunk > 0 and not self.stream and self.process_chunks(vgm_stream, passes, quantize)
+
+		if not chunked:
+			for index, (name, options, function) in enumerate(passes):
+				function(vgm_stream)
+				if use_checkpoints:
+					self.cache.put_data(keys[index], vgm_stream.get_checkpoint())
+
+		# quantize the VGM if required
+		if quantize != None:
+			hz = int(quantize)
+			if not chunked:
+				vgm_stream.quantize(hz)
+			
+			# optimize the stream
+			vgm_stream.optimize()
+			# optimize the packets
+			vgm_stream.optimize2()
+			# optimize the stream again, since packet optimization may have reduced data set further
+			vgm_stream.optimize()
+
+		# emit a raw binary file if required
+		if raw_filename != None:
+			vgm_stream.write_binary(raw_filename, self.rawheader)
+
+		# write out the processed VGM if required
+		if output_filename != None:
+			vgm_stream.write_vgm(output_filename)
+
+		# in streaming mode, all of the above happens here
+		vgm_stream.finish()
+
+		return vgm_stream
+
+	# the steps of each pass (as in the pass functions above), for process_chunks()
+	PASS_STEPS = { 'filter' : ['filter'], 'optimize' : ['optimize', 'optimize2', 'optimize'], 'transpose' : ['transpose'] }
+
+	# run the given passes, then quantize (unless quantize is None), on chunks of the VGM in parallel worker processes.
+	# Each chunk starts with the register state at that point in the VGM (see VgmStream.get_chunks), so the output is 
+	# the same as processing the whole VGM. optimize2() can leave the registers in a different state to its input,
+	# so the steps after it are run as a second phase, on chunks seeded with the register state of its output.
+	# When transposing a tuned periodic noise that starts in a chunk corrects the last channel 2 tone write of 
+	# an earlier chunk, that is done as the chunks are joined.
+	# When quantizing, the writes of each chunk are joined to the chunk before with the waits that quantizing 
+	# the whole VGM would have output. Any optimizing after quantizing is left for the whole VGM.
+	# returns False if the VGM is not long enough to split into chunks, or has DATA writes that the chunks can't be seeded
+	# for (see VgmStream.has_unpaired_data_writes), in which case nothing is done.
+	# Also returns False when run on a worker process of a pool (eg. for a batch or the server), which can't start its own workers.
+	def process_chunks(self, vgm_stream, passes, quantize):
+		if multiprocessing.current_process().daemon:
+			return False
+
+		interval = 1
+		if quantize != None:
+			# leave invalid rates for quantize() to report
+			if VgmStream.VGM_FREQUENCY % int(quantize) != 0:
+				return False
+			quantize = int(quantize)
+			interval = VgmStream.VGM_FREQUENCY / quantize
+
+		chunk_samples = int(self.chunk * VgmStream.VGM_FREQUENCY)
+		chunks = vgm_stream.get_chunks(chunk_samples, interval)
+		if len(chunks) < 2:
+			return False
+
+		# the chunks are seeded with the register state of the chip, which is only the state the processing
+		# stages would have at the start of each chunk if every DATA write is paired with a tone LATCH write
+		if vgm_stream.has_unpaired_data_writes():
+			print >>self.log, "   VGM Processing : VGM has DATA writes without a tone LATCH write, so it is not processed in chunks"
+			return False
+
+		# split the steps into phases
+		phases = [[]]
+		for name, options, function in passes:
+			for step in self.PASS_STEPS[name]:
+				phases[-1].append(step)
+				if step == 'optimize2':
+					phases.append([])
+		if quantize != None:
+			phases[-1].append('quantize')
+
+		workers = self.workers or multiprocessing.cpu_count()
+		print >>self.log, "   VGM Processing : Processing " + str(len(chunks)) + " chunks on " + str(workers) + " workers"
+
+		pool = multiprocessing.Pool(workers)
+		try:
+			for steps in phases:
+				if len(steps) > 0:
+					self.process_chunk_phase(vgm_stream, pool, vgm_stream.get_chunks(chunk_samples, interval), steps, quantize)
+		finally:
+			pool.close()
+			pool.join()
+
+		return True
+
+	# run the given steps on each of the chunks, on the worker pool, and join the processed chunks back together
+	def process_chunk_phase(self, vgm_stream, pool, chunks, steps, quantize):
+		header = bytes(vgm_stream.buffer[0:0x40])
+		options = { 'transpose' : self.transpose, 'filter' : self.filter }
+		total_samples = vgm_stream.metadata['total_samples']
+
+		# the register writes to restore the state at the start of each chunk
+		seeds = []
+		command_data = vgm_stream.command_list.data
+		state = Sn76489State()
+		for first, last, start_time, boundary in chunks:
+			seeds.append(state.get_writes())
+			i = vgm_stream.find_next_command(0x50, first)
+			while 0 <= i < last:
+				state.write(command_data[i])
+				i = vgm_stream.find_next_command(0x50, i + 1)
+
+		# the chunk checkpoints are only made as they are sent to the workers
+		def get_job(index, volumes = None):
+			first, last, start_time, boundary = chunks[index]
+			checkpoint = vgm_stream.get_chunk(first, last, seeds[index], start_time)
+			end_time = chunks[index+1][2] if index + 1 < len(chunks) else total_samples
+			return (header, checkpoint, steps, options, quantize, start_time, end_time, volumes)
+
+		wait_samples = VGM_COMMAND_WAIT_SAMPLES
+		command_list = VgmCommandList()
+		# time of the last write output from the chunks so far
+		output_time = 0
+		# the volumes transpose() had at the end of the chunk before
+		end_volumes = None
+
+		jobs = (get_job(index) for index in range(len(chunks)))
+		for index, result in enumerate(pool.imap(convert_chunk_job, jobs)):
+			first, last, start_time, boundary = chunks[index]
+
+			# if the chunk started with different volumes to those the chunk before ended with, it is processed again
+			# carrying on from them (which is rare, as any channel 2 volume write in the chunk before puts them right)
+			if end_volumes != None and result[2] != end_volumes:
+				result = convert_chunk_job(get_job(index, end_volumes))
+			checkpoint, seed_tone2, seed_volumes, end_volumes, diagnostics = result
+			vgm_stream.diagnostics.merge(diagnostics)
+
+			chunk = VgmStream(None, header_only = True, log = NullOutput(), data = header)
+			chunk.restore_checkpoint(checkpoint)
+
+			if seed_tone2 != None:
+				self.retune_tone2(command_list, seed_tone2)
+
+			if 'quantize' not in steps:
+				# the commands before the start time are the seed of the chunk
+				index = bisect.bisect_left(chunk.command_list.times, start_time)
+				command_list.commands.extend(chunk.command_list.commands[index:])
+				command_list.data.extend(chunk.command_list.data[index:])
+				command_list.times.extend(chunk.command_list.times[index:])
+				continue
+
+			# skip the seed writes, and the waits from them up to the first writes of the chunk,
+			# which are replaced by the waits from the last writes of the chunk before
+			seeded = True
+			for command, data, time in chunk.command_list:
+				if command == 0x66:
+					if seeded:
+						time = output_time
+				elif seeded:
+					if time < boundary or wait_samples[command] != 0:
+						continue
+					seeded = False
+					command_list.extend(vgm_stream.quantize_waits(time - output_time, output_time, quantize))
+
+				command_list.append(command, data, time)
+				if wait_samples[command] == 0:
+					output_time = time
+
+		# the state changed by the steps (eg. the target clock), apart from the length of the chunk
+		for name in VgmStream.CHECKPOINT_STATE:
+			setattr(vgm_stream, name, getattr(chunk, name))
+		for field in VgmHeader.__slots__:
+			if field not in ('vgm_ident', 'total_samples'):
+				vgm_stream.metadata[field] = chunk.metadata[field]
+
+		vgm_stream.command_list = command_list
+
+		# the warnings from the chunks are reported together, as they would be without chunks
+		if 'transpose' in steps:
+			vgm_stream.diagnostics.report(self.log)
+
+	# set the last channel 2 tone write in the command list (and the DATA write after it, if there is one) to the given tone
+	@staticmethod
+	def retune_tone2(command_list, tone):
+		commands = command_list.commands
+		command_data = command_list.data
+		for i in reversed(range(len(commands))):
+			if commands[i] == 0x50 and (command_data[i] & 0b11110000) == 0b11000000:
+				command_data[i] = (command_data[i] & 0b11110000) | (tone & 0b00001111)
+				n = commands.find(chr(0x50), i + 1)
+				if n >= 0 and (command_data[n] & 128) == 0:
+					command_data[n] = (tone>>4) & 0b00111111
+				return
+
+# process a chunk of a VGM for VgmConverter.process_chunks() in a worker process
+# returns a tuple of a checkpoint of the processed chunk, the retuned tone for the channel 2 tone write before the chunk 
+# (or None), the volumes transpose() had at the start and end of the chunk (None if it wasn't transposed), and its warnings
+def convert_chunk_job(job):
+	header, checkpoint, steps, options, quantize, start_time, end_time, volumes = job
+	vgm_converter = VgmConverter(quiet = True, **options)
+
+	vgm_stream = VgmStream(None, header_only = True, log = vgm_converter.log, data = header)
+	vgm_stream.restore_checkpoint(checkpoint)
+	vgm_stream.seed_time = start_time
+	vgm_stream.seed_volumes = volumes
+	# quantizing stops at the end of the chunk
+	vgm_stream.metadata['total_samples'] = end_time
+
+	for step in steps:
+		if step == 'filter':
+			vgm_converter.filter_pass(vgm_stream)
+		elif step == 'transpose':
+			vgm_converter.transpose_pass(vgm_stream)
+		elif step == 'quantize':
+			vgm_stream.quantize(quantize)
+		else:
+			getattr(vgm_stream, step)()
+
+	return (vgm_stream.get_checkpoint(), vgm_stream.seed_tone2, vgm_stream.seed_volumes, vgm_stream.end_volumes, vgm_stream.diagnostics)
+
+# convert a single VGM, options are as for VgmConverter
+# eg. convert("tune.vgm", "tune_bbc.vgm", transpose = 'bbc', quantize = 50, quiet = True)
+# the source VGM data can be given as data instead, see VgmConverter.convert()
+def convert(source_filename, output_filename = None, raw_filename = None, data = None, **options):
+	return VgmConverter(**options).convert(source_filename, output_filename, raw_filename, data)
+
+
+#------------------------------------------------------------------------------------------
+# VGM Variants
+#------------------------------------------------------------------------------------------
+
+# Convert one VGM into several variants (eg. BBC 50Hz raw, BBC 60Hz raw, PAL VGM) in one go.
+# The source is only parsed and optimized once for each different channel filter, and the checkpoints
+# from that (see VgmCache) are shared by the variants, which are then converted on a pool of worker processes.
+# Each variant is a dict of VgmConverter options, plus 'output' and 'rawfile' for the output filenames.
+# If no cache is given, a temporary one is used for the checkpoints.
+class VgmVariants(object):
+
+	# variant spec option names, as used on the command line
+	VARIANT_OPTIONS = {
+		't' : 'transpose', 'transpose' : 'transpose',
+		'q' : 'quantize', 'quantize' : 'quantize',
+		'f' : 'filter', 'filter' : 'filter',
+		'o' : 'output', 'output' : 'output',
+		'r' : 'rawfile', 'rawfile' : 'rawfile',
+		'n' : 'norawheader', 'norawheader' : 'norawheader',
+	}
+
+	# options are VgmConverter options shared by all of the variants
+	# progress is printed to log (or stdout), unless quiet is True
+	def __init__(self, options, variants, workers = None, cache = None, quiet = False, log = None):
+		self.options = options
+		self.variants = variants
+		self.workers = workers or multiprocessing.cpu_count()
+		self.cache = cache
+		if log is None:
+			log = sys.stdout
+		if quiet:
+			log = NullOutput()
+		self.log = log
+
+	# parse a variant spec from the command line, eg. "t=bbc,q=50,r=tune50.bin"
+	# returns a variant dict
+	@staticmethod
+	def parse_variant(spec):
+		variant = {}
+		for item in spec.split(','):
+			name, separator, value = item.partition('=')
+			option = VgmVariants.VARIANT_OPTIONS.get(name.strip().lower())
+			if option == None:
+				raise FatalError("Unknown variant option '" + name + "' in '" + spec + "'")
+			if option == 'norawheader':
+				variant['rawheader'] = False
+			else:
+				variant[option] = value.strip()
+		return variant
+
+	# convert all of the variants of the given source, printing progress and a summary
+	# returns a list of (variant name, error) tuples, where error is None if the variant was converted
+	def run(self, source_filename):
+		start_time = time.time()
+
+		# the source is read once, and the workers are given the data
+		if source_filename == '-':
+			data = sys.stdin.read()
+		else:
+			source_file = open(source_filename, 'rb')
+			data = source_file.read()
+			source_file.close()
+
+		# checkpoints can't be taken when streaming
+		options = dict(self.options)
+		options.pop('cache', None)
+		options['stream'] = False
+
+		cache = self.cache
+		temp_dir = None
+		if cache == None:
+			temp_dir = tempfile.mkdtemp(prefix = 'vgmconverter')
+			cache = VgmCache(temp_dir, sys.maxsize)
+
+		jobs = []
+		for variant in self.variants:
+			job_options = dict(options)
+			job_options.update(variant)
+			job_options['cache'] = cache
+			output_filename = job_options.pop('output', None)
+			raw_filename = job_options.pop('rawfile', None)
+			jobs.append((source_filename, data, output_filename, raw_filename, job_options))
+
+		print >>self.log, "Preparing " + str(len(jobs)) + " variants of '" + source_filename + "'"
+
+		results = []
+		try:
+			# parse & optimize once for each filter, to make the shared checkpoints
+			filters = []
+			for job in jobs:
+				if job[4].get('filter') not in filters:
+					filters.append(job[4].get('filter'))
+			# with no outputs, quantizing or transposing, processing stops once the optimize checkpoint is stored
+			for channel_filter in filters:
+				base_options = dict(options)
+				base_options['filter'] = channel_filter
+				base_options['transpose'] = None
+				base_options['quantize'] = None
+				VgmConverter(cache = cache, quiet = True, **base_options).process(self.get_source_name(source_filename), data = data)
+
+			print >>self.log, "Converting " + str(len(jobs)) + " variants with " + str(self.workers) + " workers"
+
+			pool = multiprocessing.Pool(self.workers)
+			try:
+				for name, error in pool.imap(convert_variant_job, jobs):
+					if error != None:
+						print >>self.log, "ERROR: variant '" + name + "' " + error
+					else:
+						print >>self.log, "Converted variant '" + name + "'"
+					results.append((name, error))
+			finally:
+				pool.terminate()
+				pool.join()
+		finally:
+			if temp_dir != None:
+				shutil.rmtree(temp_dir, True)
+
+		failed_count = len([error for name, error in results if error != None])
+		print >>self.log, ""
+		print >>self.log, "Variants complete: " + str(len(results) - failed_count) + " converted, " + str(failed_count) + " failed, in " + "%.1f" % (time.time() - start_time) + " seconds"
+		return results
+
+	# the VGM filename of the source data, which is None for stdin
+	@staticmethod
+	def get_source_name(source_filename):
+		if source_filename == '-':
+			return None
+		return source_filename
+
+# convert one variant, on a worker process
+# job is a tuple of (source filename, source data, output filename, raw filename, VgmConverter options)
+# returns a tuple of (variant name, error)
+def convert_variant_job(job):
+	source_filename, data, output_filename, raw_filename, options = job
+	name = ", ".join(path for path in (output_filename, raw_filename) if path != None)
+	try:
+		vgm_stream = VgmConverter(quiet = True, **options).convert(VgmVariants.get_source_name(source_filename), output_filename, raw_filename, data)
+		vgm_stream.close()
+
+		# the raw file is not written if the VGM can't be output in that format
+		if raw_filename != None and raw_filename != '-' and not os.path.exists(raw_filename):
+			return (name, "could not be output as a raw file")
+		return (name, None)
+	except Exception as e:
+		# a bad variant must not stop the others
+		return (name, str(e) or e.__class__.__name__)
+
+
+#------------------------------------------------------------------------------------------
+# VGM Batch
+#------------------------------------------------------------------------------------------
+
+# Convert lots of VGMs with the same options, spread over a pool of worker processes.
+# Sources can be VGM files, directories (converted recursively), glob patterns, or manifest files
+# given as @<filename> that list one source per line (blank lines and lines starting with # are skipped).
+# Outputs are written to output_dir and/or raw_dir with the same name as the source, keeping
+# the layout of any subdirectories below a source directory.
+# A failure on one file doesn't stop the batch, and results are reported in the order the sources were given.
+#
+# On slow (eg. network) storage, prefetch can be set to the number of files to read ahead. The files are
+# then read (and inflated) on a separate thread, and the outputs written on another, so that
+# the workers are kept busy converting rather than waiting on the storage.
+class VgmBatch(object):
+
+	# extension used for raw binary outputs
+	RAW_EXTENSION = '.bin'
+
+	# options are as for VgmConverter, workers is the number of processes and defaults to the number of CPUs
+	# progress is printed to log (or stdout), unless quiet is True
+	def __init__(self, options, output_dir = None, raw_dir = None, workers = None, prefetch = 0, quiet = False, log = None):
+		self.options = options
+		self.output_dir = output_dir
+		self.raw_dir = raw_dir
+		self.workers = workers or multiprocessing.cpu_count()
+		self.prefetch = prefetch
+		if log is None:
+			log = sys.stdout
+		if quiet:
+			log = NullOutput()
+		self.log = log
+
+	# returns True if the given source names more than one file
+	@staticmethod
+	def is_batch_source(source):
+		return source.startswith('@') or glob.has_magic(source) or os.path.isdir(source)
+
+	# expand the given sources to a list of (filename, output name) tuples,
+	# where the output name is the filename relative to the output directories, without extension
+	def find_sources(self, sources):
+		found = []
+		for source in sources:
+			if source.startswith('@'):
+				manifest = open(source[1:], 'r')
+				lines = [line.strip() for line in manifest]
+				manifest.close()
+				found.extend(self.find_sources([line for line in lines if line and not line.startswith('#')]))
+			elif glob.has_magic(source):
+				found.extend(self.find_sources(sorted(glob.glob(source))))
+			elif os.path.isdir(source):
+				for filename in find_vgm_files(source):
+					found.append((filename, os.path.splitext(os.path.relpath(filename, source))[0]))
+			else:
+				found.append((source, os.path.splitext(basename(source))[0]))
+		return found
+
+	# make the conversion jobs for the given (filename, output name) tuples from find_sources()
+	# returns a tuple of (jobs, skipped), where skipped is a list of (filename, error) tuples for the sources that can't be converted,
+	# because they have the same output name as an earlier one, or their output would be written over the source
+	def make_jobs(self, found):
+		jobs = []
+		outputs = set()
+		skipped = []
+		for filename, name in found:
+			output_filename = None
+			raw_filename = None
+			if self.output_dir != None:
+				output_filename = os.path.join(self.output_dir, name + '.vgm')
+			if self.raw_dir != None:
+				raw_filename = os.path.join(self.raw_dir, name + self.RAW_EXTENSION)
+
+			# two sources with the same name would overwrite each others output
+			if name in outputs and (output_filename != None or raw_filename != None):
+				skipped.append((filename, "has the same name as another source"))
+				continue
+
+			# the source is read by the worker while the outputs are written
+			source_path = os.path.realpath(filename)
+			if source_path in [os.path.realpath(path) for path in (output_filename, raw_filename) if path != None]:
+				skipped.append((filename, "would be written over itself"))
+				continue
+
+			outputs.add(name)
+			jobs.append((filename, output_filename, raw_filename, self.options))
+		return (jobs, skipped)
+
+	# convert all of the given sources, printing progress and a summary
+	# returns a list of (filename, error) tuples, where error is None if the file was converted
+	def run(self, sources):
+		start_time = time.time()
+
+		jobs, skipped = self.make_jobs(self.find_sources(sources))
+
+		print >>self.log, "Converting " + str(len(jobs)) + " files with " + str(self.workers) + " workers"
+
+		results = []
+		pool = VgmWorkerPool(self.workers)
+		try:
+			if self.prefetch > 0:
+				self.run_prefetched(pool, jobs, results)
+			else:
+				# all of the jobs are queued up front, and the results taken in order
+				pending = [(job, pool.submit(convert_batch_job, (job,))) for job in jobs]
+				for job, result in pending:
+					filename, error = pool.get(result, (job[0], VgmWorkerPool.DIED_ERROR))
+					self.add_result(results, filename, error)
+		finally:
+			pool.close()
+
+		for filename, error in skipped:
+			print >>self.log, "ERROR: '" + filename + "' " + error + ", skipped"
+			results.append((filename, error))
+
+		failed_count = len([error for filename, error in results if error != None])
+		print >>self.log, ""
+		print >>self.log, "Batch complete: " + str(len(results) - failed_count) + " converted, " + str(failed_count) + " failed, in " + "%.1f" % (time.time() - start_time) + " seconds"
+		return results
+
+	def add_result(self, results, filename, error):
+		if error != None:
+			print >>self.log, "ERROR: '" + filename + "' " + error
+		else:
+			print >>self.log, "Converted '" + filename + "'"
+		results.append((filename, error))
+
+	# run the jobs with the reads and writes overlapped with the conversions
+	# a reader thread keeps up to self.prefetch files loaded ahead of the workers, and a writer thread
+	# writes the outputs in order as they come back. At most self.prefetch conversions are in flight,
+	# so memory use is bounded however many files there are.
+	def run_prefetched(self, pool, jobs, results):
+		read_queue = Queue.Queue(self.prefetch)
+		write_queue = Queue.Queue(self.prefetch)
+
+		def reader():
+			for job in jobs:
+				data, error = read_batch_source(job[0])
+				read_queue.put((job, data, error))
+			read_queue.put(None)
+
+		def writer():
+			while True:
+				item = write_queue.get()
+				if item is None:
+					return
+				(filename, output_filename, raw_filename, options), error, output_data, raw_data = item
+				if error == None:
+					try:
+						for path, data in ((output_filename, output_data), (raw_filename, raw_data)):
+							if path != None:
+								make_directory(os.path.dirname(path))
+								output_file = open(path, 'wb')
+								output_file.write(data)
+								output_file.close()
+					except EnvironmentError as e:
+						error = str(e)
+				self.add_result(results, filename, error)
+
+		threads = [threading.Thread(target = reader), threading.Thread(target = writer)]
+		for thread in threads:
+			thread.daemon = True
+			thread.start()
+
+		# results are taken in order, waiting on the oldest conversion once the limit is reached
+		pending = []
+		while True:
+			item = read_queue.get()
+			if item is None:
+				break
+			pending.append((item[0], pool.submit(convert_batch_data_job, item)))
+			if len(pending) >= self.prefetch:
+				write_queue.put(self.get_data_result(pool, *pending.pop(0)))
+
+		for job, result in pending:
+			write_queue.put(self.get_data_result(pool, job, result))
+		write_queue.put(None)
+		threads[1].join()
+
+	# returns the result of a convert_batch_data_job() for the given job
+	@staticmethod
+	def get_data_result(pool, job, result):
+		return pool.get(result, (job, VgmWorkerPool.DIED_ERROR, None, None))
+
+# read the data for one file of a batch, inflating it if it's gzipped
+# returns a tuple of (data, error), where error is the error message if the file can't be read
+def read_batch_source(filename):
+	try:
+		source_file = open(filename, 'rb')
+		data = source_file.read()
+		source_file.close()
+	except EnvironmentError as e:
+		return (None, str(e))
+
+	if data[0:2] == VgmStream.gzip_magic_number:
+		try:
+			data = VgmStream.inflate(data)
+		except zlib.error:
+			# left for the conversion to report
+			pass
+	return (data, None)
+
+# convert one prefetched file of a batch, on a worker process
+# job is as for convert_batch_job, data and error are from read_batch_source()
+# returns a tuple of (job, error, vgm data, raw data)
+def convert_batch_data_job(job, data, error):
+	filename, output_filename, raw_filename, options = job
+	if error != None:
+		return (job, error, None, None)
+
+	try:
+		source = ByteBuffer(data)
+		source.name = filename
+
+		output_file = ByteBuffer() if output_filename != None else None
+		raw_file = ByteBuffer() if raw_filename != None else None
+		vgm_stream = VgmConverter(quiet = True, **options).convert(source, output_file, raw_file)
+		vgm_stream.close()
+
+		output_data = output_file.getvalue() if output_file != None else None
+		raw_data = raw_file.getvalue() if raw_file != None else None
+
+		# the raw output is empty if the VGM can't be output in that format
+		if raw_file != None and len(raw_data) == 0:
+			return (job, "could not be output as a raw file", None, None)
+		return (job, None, output_data, raw_data)
+	except Exception as e:
+		# a bad file must not stop the batch
+		return (job, str(e) or e.__class__.__name__, None, None)
+
+# convert one file of a batch, on a worker process
+# job is a tuple of (filename, output filename, raw filename, VgmConverter options), returns a tuple of (filename, error)
+def convert_batch_job(job):
+	filename, output_filename, raw_filename, options = job
+	try:
+		for path in (output_filename, raw_filename):
+			if path != None:
+				make_directory(os.path.dirname(path))
+
+		vgm_stream = VgmConverter(quiet = True, **options).convert(filename, output_filename, raw_filename)
+		vgm_stream.close()
+
+		# the raw file is removed if the VGM can't be output in that format
+		if raw_filename != None and not os.path.exists(raw_filename):
+			return (filename, "could not be output as a raw file")
+		return (filename, None)
+	except Exception as e:
+		# a bad file must not stop the batch
+		return (filename, str(e) or e.__class__.__name__)
+
+# A pool of worker processes for batch conversions.
+# If a worker process dies part way through a job (eg. killed by the OS when out of memory, or by a crash),
+# multiprocessing.Pool replaces the worker but the job is lost, and waiting on its result would never return.
+# So each job reports the process it was started on, and waiting on a job gives up once that process has gone.
+class VgmWorkerPool(object):
+
+	# error reported for a job whose worker process died
+	DIED_ERROR = "worker process died"
+
+	# seconds between checks that a job's worker process is still running
+	CHECK_INTERVAL = 0.5
+
+	def __init__(self, workers):
+		# (job index, process id) for each job as it starts
+		self.started = SimpleQueue()
+		self.pool = multiprocessing.Pool(workers, init_worker_pool, (self.started,))
+		self.job_count = 0
+		self.job_pids = {}
+
+	# start function(*args) on a worker, returns a result for get()
+	def submit(self, function, args):
+		index = self.job_count
+		self.job_count += 1
+		return (index, self.pool.apply_async(run_worker_job, (index, function, args)))
+
+	# wait for a job submitted with submit(), returns its result, or died if its worker process died
+	def get(self, job, died):
+		index, result = job
+		while not result.ready():
+			result.wait(self.CHECK_INTERVAL)
+			while not self.started.empty():
+				started_index, pid = self.started.get()
+				self.job_pids[started_index] = pid
+
+			pid = self.job_pids.get(index)
+			if pid != None and pid not in [process.pid for process in multiprocessing.active_children()]:
+				# the result may have been sent just before the process ended
+				result.wait(self.CHECK_INTERVAL)
+				if not result.ready():
+					return died
+		self.job_pids.pop(index, None)
+		return result.get()
+
+	def close(self):
+		self.pool.terminate()
+		self.pool.join()
+
+# the queue used to report jobs starting on this worker process, see VgmWorkerPool
+worker_started = None
+
+def init_worker_pool(started):
+	global worker_started
+	worker_started = started
+
+# run function(*args) for job number index on a worker process of a VgmWorkerPool
+def run_worker_job(index, function, args):
+	worker_started.put((index, os.getpid()))
+	return function(*args)
+
+# create a directory (and any parents) if it doesn't already exist
+def make_directory(path):
+	if path and not os.path.isdir(path):
+		try:
+			os.makedirs(path)
+		except OSError:
+			# another worker may have just created it
+			if not os.path.isdir(path):
+				raise
+
+
+# Watch the sources of a batch, and convert files as they are added or changed.
+# The sources are polled for changes, and a changed file is converted once it has stopped changing for
+# SETTLE_TIME, so that a file that is still being written (or saved repeatedly) is only converted once.
+# Files are only converted if their content has actually changed, and when watching starts, files
+# that have outputs newer than themselves are taken to be up to date.
+# The worker pool is kept for the whole time, so each conversion starts straight away.
+class VgmWatcher(object):
+
+	POLL_INTERVAL = 1.0		# seconds between checks for changes
+	SETTLE_TIME = 0.5		# seconds a file must be unchanged for before it is converted
+
+	def __init__(self, batch, sources):
+		self.batch = batch
+		self.sources = sources
+
+		# state of each file being watched, as a dict of filename to [(size, mtime), time last changed, hash of last conversion]
+		# time last changed is None once the change has been dealt with
+		self.files = {}
+
+	# watch until interrupted
+	def run(self):
+		print >>self.batch.log, "Watching for changes, press Ctrl-C to stop"
+		pool = VgmWorkerPool(self.batch.workers)
+		try:
+			self.poll(pool, True)
+			while True:
+				time.sleep(self.POLL_INTERVAL)
+				self.poll(pool, False)
+		except KeyboardInterrupt:
+			pass
+		finally:
+			pool.close()
+
+	# check the sources for changes, and convert any changed files
+	def poll(self, pool, starting):
+		now = time.time()
+		jobs, skipped = self.batch.make_jobs(self.batch.find_sources(self.sources))
+
+		# forget files that have gone
+		filenames = set(job[0] for job in jobs)
+		for filename in list(self.files.keys()):
+			if filename not in filenames:
+				del self.files[filename]
+
+		ready = []
+		for job in jobs:
+			filename = job[0]
+			try:
+				st = os.stat(filename)
+			except OSError:
+				continue
+			file_stat = (st.st_size, st.st_mtime)
+
+			state = self.files.get(filename)
+			if state is None:
+				state = self.files[filename] = [file_stat, now, None]
+				if starting and self.is_up_to_date(job, st):
+					state[1] = None
+					state[2] = self.hash_file(filename)
+				continue
+
+			if state[0] != file_stat:
+				state[0] = file_stat
+				state[1] = now
+				continue
+
+			if state[1] is None or now - state[1] < self.SETTLE_TIME:
+				continue
+			state[1] = None
+
+			# saving a file without changing it doesn't need a conversion
+			file_hash = self.hash_file(filename)
+			if file_hash == state[2]:
+				continue
+			state[2] = file_hash
+			ready.append(job)
+
+		if len(ready) == 0:
+			return
+
+		results = []
+		pending = [(job, pool.submit(convert_batch_job, (job,))) for job in ready]
+		for job, result in pending:
+			filename, error = pool.get(result, (job[0], VgmWorkerPool.DIED_ERROR))
+			self.batch.add_result(results, filename, error)
+			# try again next time it changes
+			if error != None:
+				self.files[filename][2] = None
+
+	# returns True if all of the outputs of a job are newer than its source
+	def is_up_to_date(self, job, st):
+		outputs = [path for path in job[1:3] if path != None]
+		for path in outputs:
+			if not os.path.exists(path) or os.path.getmtime(path) < st.st_mtime:
+				return False
+		return len(outputs) > 0
+
+	@staticmethod
+	def hash_file(filename):
+		file_hash = hashlib.sha1()
+		source_file = open(filename, 'rb')
+		while True:
+			data = source_file.read(1024*1024)
+			if not data:
+				break
+			file_hash.update(data)
+		source_file.close()
+		return file_hash.hexdigest()
+
+
+#------------------------------------------------------------------------------------------
+# VGM Server
+#------------------------------------------------------------------------------------------
+
+# A long running conversion server on a Unix domain socket, so that tools which convert tunes often
+# don't pay for process startup each time. Each connection is handled on its own thread, and the
+# conversions themselves are run on a pool of worker processes that stay loaded between jobs.
+#
+# Messages are sent as frames, each a 4 byte little endian length followed by that many bytes.
+# A request is two frames:
+#  options - JSON object of VgmConverter options, plus "output" (default true) and "rawfile" (default false)
+#            to choose which outputs are returned
+#  vgm - the source VGM (or .vgz) data
+# and the response is three frames:
+#  report - JSON object with "error" (null if the conversion worked), "log" (the progress messages),
+#           "time" (seconds spent converting), "warnings" (see VgmDiagnostics.get_summary()) and the sizes & length of the output
+#  vgm - the processed VGM data, empty if not requested or the conversion failed
+#  raw - the raw binary data, empty if not requested or the conversion failed
+# Any number of requests can be sent on one connection.
+class VgmServer(object):
+
+	# largest frame that will be accepted
+	MAX_FRAME_SIZE = 256*1024*1024
+
+	# workers is the number of conversion processes, defaults to the number of CPUs
+	# cache is a VgmCache to use for all conversions, if required
+	def __init__(self, socket_path, workers = None, cache = None):
+		self.socket_path = socket_path
+		self.workers = workers or multiprocessing.cpu_count()
+		self.cache = cache
+
+	# run the server until interrupted
+	def serve_forever(self):
+
+		# a socket left behind by a server that didn't shut down cleanly would stop us binding
+		if os.path.exists(self.socket_path) and stat.S_ISSOCK(os.stat(self.socket_path).st_mode):
+			os.remove(self.socket_path)
+
+		pool = multiprocessing.Pool(self.workers)
+		server = VgmSocketServer(self.socket_path, VgmRequestHandler)
+		server.pool = pool
+		server.cache = self.cache
+
+		print "VGM server listening on '" + self.socket_path + "' with " + str(self.workers) + " workers"
+		try:
+			server.serve_forever()
+		except KeyboardInterrupt:
+			pass
+		finally:
+			server.server_close()
+			pool.terminate()
+			pool.join()
+			os.remove(self.socket_path)
+			print "VGM server stopped"
+
+	# read one frame from a socket, returns None if the connection was closed
+	@staticmethod
+	def read_frame(sock):
+		header = VgmServer.read_bytes(sock, 4)
+		if header is None:
+			return None
+		size = STRUCT_UINT32.unpack(header)[0]
+		if size > VgmServer.MAX_FRAME_SIZE:
+			raise ValueError("Frame of " + str(size) + " bytes is too large")
+		data = VgmServer.read_bytes(sock, size)
+		if data is None:
+			raise ValueError("Connection closed part way through a frame")
+		return data
+
+	@staticmethod
+	def read_bytes(sock, size):
+		chunks = []
+		while size > 0:
+			chunk = sock.recv(min(size, 1024*1024))
+			if not chunk:
+				return None
+			chunks.append(chunk)
+			size -= len(chunk)
+		return b''.join(chunks)
+
+	@staticmethod
+	def write_frame(sock, data):
+		sock.sendall(STRUCT_UINT32.pack(len(data)) + data)
+
+# Unix socket server with a thread per connection, with the worker pool & cache attached by VgmServer
+class VgmSocketServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+	daemon_threads = True
+
+class VgmRequestHandler(SocketServer.BaseRequestHandler):
+
+	def handle(self):
+		sock = self.request
+		try:
+			while True:
+				options = VgmServer.read_frame(sock)
+				if options is None:
+					return
+				vgm_data = VgmServer.read_frame(sock)
+				if vgm_data is None:
+					return
+
+				report, output_data, raw_data = self.server.pool.apply(convert_job, (vgm_data, options, self.server.cache))
+
+				VgmServer.write_frame(sock, json.dumps(report).encode('utf_8'))
+				VgmServer.write_frame(sock, output_data)
+				VgmServer.write_frame(sock, raw_data)
+		except (ValueError, EnvironmentError):
+			# bad frames, or the client went away
+			return
+
+# run one conversion job from the server, on a worker process
+# options is the JSON options text, returns a tuple of (report, vgm data, raw data)
+def convert_job(vgm_data, options, cache = None):
+	start_time = time.time()
+	log = ByteBuffer()
+	report = { 'error' : None }
+	output_data = b''
+	raw_data = b''
+	try:
+		options = json.loads(options)
+		if not isinstance(options, dict):
+			raise ValueError("Options must be a JSON object")
+		output = options.pop('output', True)
+		rawfile = options.pop('rawfile', False)
+		options['cache'] = cache
+
+		output_file = ByteBuffer() if output else None
+		raw_file = ByteBuffer() if rawfile else None
+
+		converter = VgmConverter(log = log, **dict((str(k), v) for k, v in options.items()))
+		vgm_stream = converter.convert(None, output_file, raw_file, data = vgm_data)
+
+		if output_file is not None:
+			output_data = output_file.getvalue()
+		if raw_file is not None:
+			raw_data = raw_file.getvalue()
+
+		report['total_samples'] = vgm_stream.metadata['total_samples']
+		report['duration'] = float(vgm_stream.metadata['total_samples']) / VgmStream.VGM_FREQUENCY
+		report['warnings'] = vgm_stream.diagnostics.get_summary()
+		vgm_stream.close()
+	except Exception as e:
+		# a bad job must not take down the worker
+		report['error'] = str(e) or e.__class__.__name__
+
+	report['log'] = log.getvalue()
+	report['vgm_size'] = len(output_data)
+	report['raw_size'] = len(raw_data)
+	report['time'] = time.time() - start_time
+	return (report, output_data, raw_data)
+
+# send a conversion job to a VgmServer, options are as for VgmConverter plus output/rawfile (see VgmServer)
+# returns a tuple of (report, vgm data, raw data)
+def convert_remote(socket_path, vgm_data, **options):
+	sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+	try:
+		sock.connect(socket_path)
+		VgmServer.write_frame(sock, json.dumps(options).encode('utf_8'))
+		VgmServer.write_frame(sock, bytes(vgm_data))
+		report = json.loads(VgmServer.read_frame(sock))
+		output_data = VgmServer.read_frame(sock)
+		raw_data = VgmServer.read_frame(sock)
+	finally:
+		sock.close()
+	return (report, output_data, raw_data)
+
 
-		# write to output file
-		bin_file = open(filename, 'wb')
-		bin_file.write(output_block)
-		bin_file.close()		
-		
 #------------------------------------------------------------------------------------------
 # Main
 #------------------------------------------------------------------------------------------
@@ -2768,213 +5197,315 @@ if False:
 
 #------------------------------------------------------------------------------------------
 
-if my_command_line != None:
-	argv = my_command_line.split()
-else:
-	argv = sys.argv
-
-argc = len(argv)
-
-if argc < 2:
-	print "VGM Conversion Utility for VGM files based on TI SN76849 sound chips"
-	print " Supports gzipped VGM or .vgz files."
-	print ""
-	print " Usage:"
-	print "  vgmconverter <vgmfile> [-transpose <n>] [-quantize <n>] [-filter <n>] [-rawfile <filename>] [-output <filename>] [-length] [-norawheader] [-dump] [-verbose]"
-	print ""
-	print "   where:"
-	print "    <vgmfile> is the source VGM file to be processed. Wildcards are not yet supported."
-	print ""
-	print "   options:"
-	print "    [-transpose <n>, -t <n>] transpose the source VGM to a new frequency. For <n> Specify 'ntsc' (3.57MHz), 'pal' (4.2MHz) or 'bbc' (4.0MHz)"
-	print "    [-quantize <n>, -q <n>] quantize the VGM to a specific playback update interval. For <n> specify an integer Hz value"
-	print "    [-filter <n>, -n <n>] strip one or more output channels from the VGM. For <n> specify a string of channels to filter eg. '0123' or '13' etc."
-	print "    [-rawfile <filename>, -r <filename>] output a raw binary file version of the chip data within the source VGM. A default quantization of 60Hz will be applied if not specified with -q"
-	print "    [-output <filename>, -o <filename>] specifies the filename to output a processed VGM. Optional."
-	print "    [-length <secs>, -l <secs>] limits output to <secs> seconds. Optional."	
-	print "    [-norawheader, -n] removes header from raw file output. Optional."	
+def main(argv):
+
+	if my_command_line != None:
+		argv = my_command_line.split()
+
+	argc = len(argv)
+
+	if argc < 2:
+		print "VGM Conversion Utility for VGM files based on TI SN76849 sound chips"
+		print " Supports gzipped VGM or .vgz files."
+		print ""
+		print " Usage:"
+		print "  vgmconverter <vgmfile> [-transpose <n>] [-quantize <n>] [-filter <n>] [-rawfile <filename>] [-output <filename>] [-start <secs>] [-length <secs>] [-norawheader] [-stream] [-dump] [-verbose]"
+		print "  vgmconverter -server <socket> [-workers <n>]"
+		print ""
+		print "   where:"
+		print "    <vgmfile> is the source VGM file to be processed, or '-' to read it from stdin."
+		print "     It can also be a directory, a wildcard, several files or @<manifest> (a file listing one source per line), in which case"
+		print "     the files are converted in parallel, and -output and -rawfile give the directories to write the converted files to."
+		print ""
+		print "   options:"
+		print "    [-transpose <n>, -t <n>] transpose the source VGM to a new frequency. For <n> Specify 'ntsc' (3.57MHz), 'pal' (4.2MHz) or 'bbc' (4.0MHz), or a clock speed in Hz (or MHz) eg. 3546893"
+		print "    [-quantize <n>, -q <n>] quantize the VGM to a specific playback update interval. For <n> specify an integer Hz value"
+		print "    [-filter <n>, -n <n>] strip one or more output channels from the VGM. For <n> specify a string of channels to filter eg. '0123' or '13' etc."
+		print "    [-rawfile <filename>, -r <filename>] output a raw binary file version of the chip data within the source VGM. A default quantization of 60Hz will be applied if not specified with -q. Use '-' for stdout."
+		print "    [-output <filename>, -o <filename>] specifies the filename to output a processed VGM, or '-' for stdout. Optional."
+		print "    [-start <secs>, -s <secs>] starts output <secs> seconds into the source VGM. Optional."	
+		print "    [-length <secs>, -l <secs>] limits output to <secs> seconds. Optional."	
+		print "    [-norawheader, -n] removes header from raw file output. Optional."	
+		print "    [-stream] process the VGM as a stream, so memory use does not grow with the length of the VGM. Optional."	
+		print "    [-tag <field>=<text>] set a GD3 tag field, eg. -tag \"title_eng=My Tune\". Can be repeated. Only the GD3 tag is rewritten, to the -output file or in place, no conversion is done."
+		print "    [-catalog <dbfile>, -c <dbfile>] scan the header & GD3 tag of <vgmfile> (or every VGM in a <vgmfile> directory) into a SQLite catalog, no conversion is done."
 	
-	print "    [-dump] output human readable version of the VGM"
-	print "    [-verbose] enable debug information"
-	exit()
-
-# pre-process argv to merge quoted arguments
-argi = 0
-inquotes = False
-outargv = []
-quotedarg = []
-#print argv
-for s in argv:
-	#print "s=" + s
-	#print "quotedarg=" + str(quotedarg)
+		print "    [-server <socket>] run as a conversion server on the Unix domain socket <socket>, no <vgmfile> is needed. See VgmServer for the protocol."
+		print "    [-workers <n>] number of conversion processes for -server or a batch of files, defaults to the number of CPUs."
+		print "    [-cache <dir>] keep converted files in the cache directory <dir>, and reuse them when the same VGM is converted again with the same options."
+		print "    [-cachesize <n>] maximum size of the -cache directory in MB, the least recently used conversions are removed to keep within it. Defaults to 256."
+		print "    [-watch] keep watching the source files or directories, and convert files whenever they are added or changed."
+		print "    [-variant <spec>] output a variant of the VGM, can be repeated to convert several variants from one parse of the VGM."
+		print "     <spec> is a list of options eg. \"t=bbc,q=50,r=tune50.bin\", using t (transpose), q (quantize), f (filter), o (output), r (rawfile) and n (norawheader)."
+		print "     Options not given in a variant are taken from the command line."
+		print "    [-prefetch <n>] when converting a batch of files, read up to <n> files ahead and write outputs in the background. Useful on slow storage."
+		print "    [-chunk <secs>] split a long VGM into chunks of about <secs> seconds, which are processed in parallel on -workers processes."
+		print "    [-dump] output human readable version of the VGM"
+		print "    [-verbose] enable debug information"
+		print "    [-quiet] don't print any progress messages"
+		return
+
+	# pre-process argv to merge quoted arguments
+	argi = 0
+	inquotes = False
+	outargv = []
+	quotedarg = []
+	#print argv
+	for s in argv:
+		#print "s=" + s
+		#print "quotedarg=" + str(quotedarg)
 	
-	if s.startswith('"') and s.endswith('"'):
-		outargv.append(s[1:-1])	
-		continue
+		if s.startswith('"') and s.endswith('"'):
+			outargv.append(s[1:-1])	
+			continue
 	
-	if not inquotes and s.startswith('"'):
-		inquotes = True
-		quotedarg.append(s[1:] + ' ')
-		continue
+		if not inquotes and s.startswith('"'):
+			inquotes = True
+			quotedarg.append(s[1:] + ' ')
+			continue
 	
-	if inquotes and s.endswith('"'):
-		inquotes = False
-		quotedarg.append(s[:-1])
-		outargv.append("".join(quotedarg))
-		quotedarg = []
-		continue
+		if inquotes and s.endswith('"'):
+			inquotes = False
+			quotedarg.append(s[:-1])
+			outargv.append("".join(quotedarg))
+			quotedarg = []
+			continue
 		
-	if inquotes:
-		quotedarg.append(s + ' ')	
-		continue
+		if inquotes:
+			quotedarg.append(s + ' ')	
+			continue
 		
-	outargv.append(s)
+		outargv.append(s)
 
-if inquotes:
-	print "Error parsing command line " + str(" ".join(argv))
-	exit()
+	if inquotes:
+		print "Error parsing command line " + str(" ".join(argv))
+		return
 
-argv = outargv
+	argv = outargv
 	
-# validate source file	
-source_filename = None
-if argv[1][0] != '-':
-	source_filename = argv[1]
-
-# setup option defaults
-option_verbose = None
-option_outputfile = None
-option_transpose = None
-option_quantize = None
-option_filter = None
-option_rawfile = None
-option_dump = None
-option_length = None
-option_rawheader = True		# determines if header added to raw output
-
-# process command line
-for i in range(2, len(argv)):
-	arg = argv[i]
-	if arg[0] == '-':
-		option = arg[1:].lower()
-		if option == 'o' or option == 'output':
-			option_outputfile = argv[i+1]
-		else:
-			if option == 't' or option == 'transpose':
-				option_transpose = argv[i+1]
+	# validate source file	
+	# there can be more than one source (eg. from a shell wildcard), which are converted as a batch
+	source_filenames = []
+	for arg in argv[1:]:
+		if arg[0] == '-' and arg != '-':
+			break
+		source_filenames.append(arg)
+
+	source_filename = None
+	if len(source_filenames) > 0:
+		source_filename = source_filenames[0]
+
+	# setup option defaults
+	option_verbose = None
+	option_outputfile = None
+	option_transpose = None
+	option_quantize = None
+	option_filter = None
+	option_rawfile = None
+	option_dump = None
+	option_start = None
+	option_length = None
+	option_rawheader = True		# determines if header added to raw output
+	option_catalog = None
+	option_tags = []
+	option_stream = False
+	option_server = None
+	option_workers = None
+	option_prefetch = 0
+	option_cache = None
+	option_cachesize = 256		# MB
+	option_watch = False
+	option_variants = []
+	option_chunk = 0
+	option_quiet = False
+
+	# process command line, the source filename is not needed when running a server
+	for i in range(1 + len(source_filenames), len(argv)):
+		arg = argv[i]
+		if arg[0] == '-' and arg != '-':
+			option = arg[1:].lower()
+			if option == 'o' or option == 'output':
+				option_outputfile = argv[i+1]
 			else:
-				if option == 'q' or option == 'quantize':
-					option_quantize = argv[i+1]
+				if option == 't' or option == 'transpose':
+					option_transpose = argv[i+1]
 				else:
-					if option == 'f' or option == 'filter':
-						option_filter = argv[i+1]
+					if option == 'q' or option == 'quantize':
+						option_quantize = argv[i+1]
 					else:
-						if option == 'r' or option == 'rawfile':
-							option_rawfile = argv[i+1]
+						if option == 'f' or option == 'filter':
+							option_filter = argv[i+1]
 						else:
-							if option == 'd' or option == 'dump':
-								option_dump = True
+							if option == 'r' or option == 'rawfile':
+								option_rawfile = argv[i+1]
 							else:
-								if option == 'v' or option == 'verbose':
-									option_verbose = True
+								if option == 'd' or option == 'dump':
+									option_dump = True
 								else:
-									if option == 'l' or option == 'length':
-										option_length = argv[i+1]
+									if option == 'v' or option == 'verbose':
+										option_verbose = True
 									else:
-										if option == 'n' or option == 'norawheader':
-											option_rawheader = False
+										if option == 'l' or option == 'length':
+											option_length = argv[i+1]
 										else:
-											print "ERROR: Unrecognised option '" + arg + "'"
-
-# load the VGM
-if source_filename == None:
-	print "ERROR: No source <filename> provided."
-	exit()
-
-# if rawfile output is specified, but no quantization option given, force a default quantization of 60Hz (NTSC)
-if option_rawfile != None:
-	if option_quantize == None:
-		option_quantize = 60
-	
-# debug code	
-if False:
-	print "source " + str(source_filename)
-	print "verbose " + str(option_verbose)
-	print "output " + str(option_outputfile)
-	print "transpose " + str(option_transpose)
-	print "quantize " + str(option_quantize)
-	print "filter " + str(option_filter)
-	print "rawfile " + str(option_rawfile)
-	print "dump " + str(option_dump)
-	print ""
-
+											if option == 's' or option == 'start':
+												option_start = argv[i+1]
+											else:
+												if option == 'n' or option == 'norawheader':
+													option_rawheader = False
+												else:
+													if option == 'c' or option == 'catalog':
+														option_catalog = argv[i+1]
+													else:
+														if option == 'tag':
+															option_tags.append(argv[i+1])
+														else:
+															if option == 'stream':
+																option_stream = True
+															else:
+																if option == 'server':
+																	option_server = argv[i+1]
+																else:
+																	if option == 'workers':
+																		option_workers = int(argv[i+1])
+																	else:
+																		if option == 'prefetch':
+																			option_prefetch = int(argv[i+1])
+																		else:
+																			if option == 'cache':
+																				option_cache = argv[i+1]
+																			else:
+																				if option == 'cachesize':
+																					option_cachesize = int(argv[i+1])
+																				else:
+																					if option == 'watch':
+																						option_watch = True
+																					else:
+																						if option == 'variant':
+																							option_variants.append(argv[i+1])
+																						else:
+																							if option == 'chunk':
+																								option_chunk = float(argv[i+1])
+																							else:
+																								if option == 'quiet':
+																									option_quiet = True
+																								else:
+																									print "ERROR: Unrecognised option '" + arg + "'"
+
+	# the dump needs the fully processed VGM, so can't come from the cache
+	vgm_cache = None
+	if option_cache != None:
+		if option_dump != None:
+			print "WARNING: -dump cannot be used with -cache, cache disabled"
+		else:
+			vgm_cache = VgmCache(option_cache, option_cachesize * 1024 * 1024)
+
+	# run as a conversion server if required
+	if option_server != None:
+		VgmServer(option_server, option_workers, vgm_cache).serve_forever()
+		return
+
+	# load the VGM
+	if source_filename == None:
+		print "ERROR: No source <filename> provided."
+		return
+
+	# update the catalog instead of converting if required
+	if option_catalog != None:
+		vgm_catalog = VgmCatalog(option_catalog)
+		scanned_count, unchanged_count, removed_count = vgm_catalog.scan(source_filenames)
+		vgm_catalog.close()
+		print >>vgm_catalog.log, "Catalog '" + option_catalog + "' updated: " + str(scanned_count) + " files scanned, " + str(unchanged_count) + " unchanged, " + str(removed_count) + " removed"
+		return
+
+	# rewrite the GD3 tag instead of converting if required
+	if len(option_tags) > 0:
+		vgm_stream = VgmStream(source_filename, header_only = True)
+		for tag in option_tags:
+			field, separator, text = tag.partition('=')
+			vgm_stream.set_gd3_field(field, text)
+		if option_outputfile != None:
+			vgm_stream.write_gd3(option_outputfile)
+		else:
+			vgm_stream.write_gd3(source_filename)
+		return
+
+	# the dump needs the whole command list
+	if option_stream and option_dump != None:
+		print "WARNING: -dump cannot be used with -stream, streaming disabled"
+		option_stream = False
+
+	# chunks need the whole command list too
+	if option_stream and option_chunk > 0:
+		print "WARNING: -chunk cannot be used with -stream, chunks disabled"
+		option_chunk = 0
+
+	# debug code	
+	if False:
+		print "source " + str(source_filename)
+		print "verbose " + str(option_verbose)
+		print "output " + str(option_outputfile)
+		print "transpose " + str(option_transpose)
+		print "quantize " + str(option_quantize)
+		print "filter " + str(option_filter)
+		print "rawfile " + str(option_rawfile)
+		print "dump " + str(option_dump)
+		print ""
 
-	
-vgm_stream = VgmStream(source_filename)
 
-# turn on verbose mode if required
-if option_verbose == True:
-	vgm_stream.set_verbose(True)
-	
-# Apply output length if provided
-if option_length != None:
-	vgm_stream.set_length(option_length)
-
-
-# apply channel filters
-if option_filter != None:
-	if option_filter.find('0') != -1:
-		vgm_stream.filter_channel(0)
-	if option_filter.find('1') != -1:
-		vgm_stream.filter_channel(1)
-	if option_filter.find('2') != -1:
-		vgm_stream.filter_channel(2)
-	if option_filter.find('3') != -1:
-		vgm_stream.filter_channel(3)
-
-# Fixed optimization - non-lossy. Only removes duplicate register writes that are wholly unnecessary		
-vgm_stream.optimize()
-
-# Second optimization - for each update interval, eliminate redundant register writes 
-# and sort the writes for each interval so that volumes are set before tones.
-# This is in principle 'lossy' since the output VGM will be different to the source, but 
-# technically it will not influence the output audio stream.
-vgm_stream.optimize2()		
-	
-# Run first optimization again to take advantage of any redundancy from last optimization
-vgm_stream.optimize()	
-	
-# apply transpose
-if option_transpose != None:
-	vgm_stream.transpose(option_transpose)
-
-# quantize the VGM if required
-if option_quantize != None:
-	hz = int(option_quantize)
-	vgm_stream.quantize(hz)
-	
-	# optimize the stream
-	vgm_stream.optimize()
-	# optimize the packets
-	vgm_stream.optimize2()
-	# optimize the stream again, since packet optimization may have reduced data set further
-	vgm_stream.optimize()
 
+	# only load the required time window of the VGM if a start or length is provided
+	window_start = 0
+	window_length = 0
+	if option_start != None:
+		window_start = float(option_start)
+	if option_length != None:
+		window_length = float(option_length)
+
+	options = { 'transpose' : option_transpose, 'quantize' : option_quantize, 'filter' : option_filter, 'rawheader' : option_rawheader,
+		'start' : window_start, 'length' : window_length, 'stream' : option_stream, 'verbose' : option_verbose == True, 'cache' : vgm_cache }
+
+	# batches and variants are already converted in parallel
+	if option_chunk > 0 and (len(option_variants) > 0 or len(source_filenames) > 1 or VgmBatch.is_batch_source(source_filename) or option_watch):
+		print "WARNING: -chunk is only used when converting a single file, ignored"
+
+	# convert several variants of the file if required
+	if len(option_variants) > 0:
+		vgm_variants = VgmVariants(options, [VgmVariants.parse_variant(spec) for spec in option_variants], option_workers, vgm_cache, option_quiet)
+		results = vgm_variants.run(source_filename)
+		if len([error for name, error in results if error != None]) > 0:
+			return 1
+		return
+
+	# convert a batch of files if required, -output and -rawfile are directories in this case
+	if len(source_filenames) > 1 or VgmBatch.is_batch_source(source_filename) or option_watch:
+		if option_dump != None:
+			print "WARNING: -dump cannot be used when converting more than one file, ignored"
+		vgm_batch = VgmBatch(options, option_outputfile, option_rawfile, option_workers, option_prefetch, option_quiet)
+		if option_watch:
+			VgmWatcher(vgm_batch, source_filenames).run()
+			return
+		results = vgm_batch.run(source_filenames)
+		if len([error for filename, error in results if error != None]) > 0:
+			return 1
+		return
 
-# emit a raw binary file if required, rawheader is on by default
-if option_rawfile != None:
-	vgm_stream.write_binary(option_rawfile, option_rawheader)
+	# messages go to stderr if the output is going to stdout
+	log = sys.stdout
+	if option_outputfile == '-' or option_rawfile == '-':
+		log = sys.stderr
 
-# write out the processed VGM if required
-if option_outputfile != None:
-	vgm_stream.write_vgm(option_outputfile)
+	vgm_converter = VgmConverter(log = log, quiet = option_quiet, chunk = option_chunk, workers = option_workers, **options)
+	vgm_stream = vgm_converter.convert(source_filename, option_outputfile, option_rawfile)
 
-# dump the processed VGM
-if option_dump != None:
-	vgm_stream.analyse()
+	# dump the processed VGM
+	if option_dump != None:
+		vgm_stream.analyse()
 
-# all done
-print ""
-print "Processing complete."
+	# all done
+	print >>vgm_converter.log, ""
+	print >>vgm_converter.log, "Processing complete."
 
 
+if __name__ == "__main__":
+	sys.exit(main(sys.argv))